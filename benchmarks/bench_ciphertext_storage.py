@@ -0,0 +1,99 @@
+"""Benchmark for the binary ciphertext format and pre-encryption compression.
+
+Stores the same credentials three ways in throwaway SQLite vaults: as
+legacy Fernet token text, in the binary format (shared.ciphertext), and in
+the binary format with plaintexts of at least --compress-min-size bytes
+compressed first. Most credentials are short passwords; every
+--note-every'th one is a long secure note (a slice of this repository's
+README, repeated to --note-size bytes). For each layout it reports the
+ciphertext bytes per row, the database file size after VACUUM, the size of
+the sync feed's JSON for all rows, and the time to read and decrypt the
+whole vault.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_ciphertext_storage --credentials 20000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy.orm import Session
+
+from shared.ciphertext import to_text
+from shared.encryption import EncryptionManager
+from shared.models import Credential, User, bulk_insert_credentials, init_engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _plaintexts(count, note_every, note_size):
+    with open(os.path.join(ROOT, 'README.md'), encoding='utf-8') as f:
+        text = f.read()
+    note = (text * (note_size // len(text) + 1))[:note_size]
+    rng = random.Random(1)
+    return [note[:rng.randint(note_size // 2, note_size)] if i % note_every == 0
+            else f"user{i}:{rng.getrandbits(96):024x}" for i in range(count)]
+
+def _build(path, plaintexts, encrypt):
+    engine = init_engine(f"sqlite:///{path}")
+    with Session(engine) as session:
+        user = User(username='bench', email='bench@example.com', password_hash='x')
+        session.add(user)
+        session.commit()
+        for start in range(0, len(plaintexts), 5000):
+            chunk = plaintexts[start:start + 5000]
+            bulk_insert_credentials(session, user.id, [{'name': f'site-{start + i}', 'encrypted_data': data}
+                                                       for i, data in enumerate(encrypt(chunk))])
+            session.commit()
+    return engine
+
+def _measure(engine, path, manager):
+    with Session(engine) as session:
+        start = time.perf_counter()
+        rows = [row.encrypted_data for row in session.query(Credential.encrypted_data)]
+        manager.decrypt_many(rows)
+        read_time = time.perf_counter() - start
+    feed = len(json.dumps([{'data': to_text(value)} for value in rows]))
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    stored = conn.execute('SELECT SUM(LENGTH(encrypted_data)) FROM credentials').fetchone()[0]
+    conn.execute('VACUUM')
+    conn.close()
+    return stored / len(rows), os.path.getsize(path), feed, read_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--credentials', type=int, default=20000)
+    parser.add_argument('--note-every', type=int, default=10)
+    parser.add_argument('--note-size', type=int, default=8192)
+    parser.add_argument('--compress-min-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    key = EncryptionManager.generate_key()
+    plaintexts = _plaintexts(args.credentials, args.note_every, args.note_size)
+    plain = EncryptionManager(key, executor='thread')
+    compressing = EncryptionManager(key, executor='thread', compress_min_size=args.compress_min_size)
+    layouts = [
+        ('token text', lambda chunk: [to_text(value) for value in plain.encrypt_many(chunk)]),
+        ('binary', plain.encrypt_many),
+        ('binary+zlib', compressing.encrypt_many),
+    ]
+    print(f"{args.credentials} credentials, one in {args.note_every} a note of up to {args.note_size} bytes")
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, encrypt in layouts:
+            path = os.path.join(tmp, f"{label.replace(' ', '_').replace('+', '_')}.db")
+            engine = _build(path, plaintexts, encrypt)
+            per_row, file_size, feed, read_time = _measure(engine, path, plain)
+            baseline = baseline or file_size
+            print(f"  {label:<12} {per_row:8.1f} bytes/row  file {file_size:>11} bytes ({file_size / baseline:6.1%})"
+                  f"  sync feed {feed:>11} bytes  read+decrypt {read_time * 1000:8.1f}ms")
+    plain.close()
+    compressing.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Startup benchmark and regression guard for data-vault-cli.
+
+Runs the CLI in fresh interpreters, the way a shell script calling it in a
+loop does, and reports:
+
+  * the cumulative import time of data_vault_cli.cli, read from
+    `python -X importtime` (best of --runs),
+  * the wall time of `generate-password`, which needs no database, and of
+    opening the local vault's engine and session the way the database
+    commands do (median of --runs),
+  * whether SQLAlchemy, cryptography or requests were loaded by
+    generate-password, which should import none of them.
+
+Exits with status 1 if the import time exceeds --budget-ms or one of those
+modules was loaded, so it can run as a check before merging.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cli_startup --runs 10 --budget-ms 150
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('sqlalchemy', 'cryptography', 'requests')
+
+def _run(args, env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + args
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=ROOT, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, result.stderr
+
+def _imports(stderr):
+    # "import time: self [us] | cumulative | imported package" lines
+    cumulative = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line[len('import time:'):].split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+    return cumulative
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help='Maximum cumulative import time of data_vault_cli.cli')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=ROOT, LOCAL_DB_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                   DATA_VAULT_AGENT_SOCK=os.path.join(tmp, 'agent.sock'))
+        cli = ['-m', 'data_vault_cli.cli']
+
+        import_times, loaded = [], set()
+        for _ in range(args.runs):
+            _, stderr = _run(['-c', 'import data_vault_cli.cli'], env, importtime=True)
+            import_times.append(_imports(stderr)['data_vault_cli.cli'] / 1000)
+            _, stderr = _run(cli + ['generate-password'], env, importtime=True)
+            loaded.update(name for name in _imports(stderr) if name in HEAVY_MODULES)
+
+        open_vault = ['-c', "from data_vault_cli.cli import VaultState; VaultState()['session']"]
+        timings = {'open vault, new file': _run(open_vault, env)[0] * 1000}
+        for label, command in (('generate-password', cli + ['generate-password']),
+                               ('open vault, schema cached', open_vault)):
+            timings[label] = statistics.median(_run(command, env)[0] for _ in range(args.runs)) * 1000
+
+    import_ms = min(import_times)
+    print(f"import data_vault_cli.cli: {import_ms:8.1f}ms (budget {args.budget_ms:.0f}ms)")
+    for label, elapsed in timings.items():
+        print(f"{label:<26} {elapsed:8.1f}ms wall")
+    if loaded:
+        print(f"generate-password imported: {', '.join(sorted(loaded))}")
+
+    if import_ms > args.budget_ms or loaded:
+        print('Startup budget exceeded.')
+        sys.exit(1)
+    print('Startup within budget.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark for response compression and the JSON encoder.
+
+Fills a throwaway vault with credentials, then fetches the full listing
+(GET /api/credentials) and the sync feed (GET /api/get_credentials) with
+each JSON encoder and each Accept-Encoding the server offers. For every
+combination it reports the bytes on the wire and the CPU time per request,
+measured with time.process_time around the Flask test client (which runs
+the request in-process, so the figure is the server's work plus a small
+constant client overhead).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_compression --credentials 5000 --requests 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_vault_web'))
+
+import compression
+import streaming
+
+def _make_client(tmp, credentials):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        RATELIMIT_ENABLED = False
+
+    cwd = os.getcwd()
+    os.chdir(tmp)  # create_app writes its log file under ./logs
+    try:
+        client = create_app(BenchConfig).test_client()
+    finally:
+        os.chdir(cwd)
+    client.post('/auth/register', json={'username': 'bench', 'email': 'bench@example.com', 'password': 'bench'})
+    token = client.post('/auth/login', json={'username': 'bench', 'password': 'bench'}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    batch_size = client.application.config['CREDENTIALS_BATCH_MAX_ITEMS']
+    for start in range(0, credentials, batch_size):
+        operations = [{'op': 'create', 'name': f'site-{i}.example.com',
+                       'data': f'{{"username": "user{i}", "password": "correct horse battery {i}"}}'}
+                      for i in range(start, min(start + batch_size, credentials))]
+        client.post('/api/credentials/batch', json={'operations': operations}, headers=headers)
+    return client, headers
+
+def _measure(client, path, headers, requests):
+    size = 0
+    start = time.process_time()
+    for _ in range(requests):
+        size = len(client.get(path, headers=headers).get_data())
+    return size, (time.process_time() - start) / requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--credentials', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    encodings = ['identity', 'gzip'] + (['zstd'] if compression.zstandard is not None else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        client, headers = _make_client(tmp, args.credentials)
+        for path in ('/api/credentials', '/api/get_credentials'):
+            print(f"GET {path} ({args.credentials} credentials)")
+            baseline = None
+            for encoder in sorted(streaming.JSON_ENCODERS):
+                streaming._dumps = streaming.JSON_ENCODERS[encoder]
+                for encoding in encodings:
+                    size, cpu = _measure(client, path, dict(headers, **{'Accept-Encoding': encoding}), args.requests)
+                    baseline = baseline or size
+                    print(f"  {encoder:<7} {encoding:<9} {size:>10} bytes ({size / baseline:6.1%})"
+                          f"  {cpu * 1000:8.2f}ms CPU per request")
+
+if __name__ == '__main__':
+    main()
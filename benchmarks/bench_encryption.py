@@ -0,0 +1,69 @@
+"""Microbenchmark for EncryptionManager.encrypt_many / decrypt_many.
+
+Times each batch size inline, on a thread pool and on a process pool and
+reports where the pools start to beat the inline loop. The crossover is
+what EncryptionManager.PARALLEL_THRESHOLD should be set to on the box.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_encryption --sizes 256 1024 4096 16384
+"""
+import argparse
+import os
+import time
+
+from shared.encryption import EncryptionManager
+
+def _best_of(repeat, func):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256, 1024, 4096, 16384, 65536])
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    key = EncryptionManager.generate_key()
+    strategies = {
+        'inline': EncryptionManager(key, parallel_threshold=float('inf')),
+        'thread': EncryptionManager(key, executor='thread', max_workers=args.workers, parallel_threshold=0),
+        'process': EncryptionManager(key, executor='process', max_workers=args.workers, parallel_threshold=0),
+    }
+    payload = 'x' * args.payload_bytes
+
+    # Start the pools before timing so the first size does not pay for it.
+    for manager in strategies.values():
+        manager.encrypt_many([payload] * 2)
+
+    print(f"cpus={os.cpu_count()} workers={args.workers} payload={args.payload_bytes}B (best of {args.repeat})")
+    print(f"{'op':<8}{'items':>8}" + ''.join(f"{name:>12}" for name in strategies) + f"{'winner':>10}")
+    crossover = {}
+    for op in ('encrypt', 'decrypt'):
+        for size in sorted(args.sizes):
+            items = [payload] * size
+            if op == 'decrypt':
+                items = strategies['inline'].encrypt_many(items)
+            timings = {name: _best_of(args.repeat, lambda m=manager: getattr(m, f'{op}_many')(items))
+                       for name, manager in strategies.items()}
+            winner = min(timings, key=timings.get)
+            # The crossover is the smallest size from which a pool keeps winning.
+            if winner == 'inline':
+                crossover.pop(op, None)
+            else:
+                crossover.setdefault(op, size)
+            print(f"{op:<8}{size:>8}" + ''.join(f"{timings[name] * 1000:>10.1f}ms" for name in strategies) + f"{winner:>10}")
+
+    for op in ('encrypt', 'decrypt'):
+        print(f"{op} crossover: {crossover.get(op, 'none within tested sizes')}")
+    for manager in strategies.values():
+        manager.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark for the shared rate limiter in data_vault_web/ratelimit.py.
+
+Reports three things:
+
+* the cost of one sliding-window hit against memory:// and against the
+  SQLite storage,
+* whether a limit holds across processes: several processes hit the same
+  key and the total number of allowed hits is compared with the limit,
+* the added latency per request, timing a protected route through the
+  Flask test client with the limiter enabled and disabled.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_ratelimit --hits 20000 --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_vault_web'))
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import SlidingWindowCounterRateLimiter
+
+from ratelimit import SQLiteStorage
+
+def _storage(uri):
+    # The app's storage for sqlite://, the limits package's for the rest
+    return SQLiteStorage(uri) if uri.startswith('sqlite://') else storage_from_string(uri)
+
+def _time_hits(uri, hits):
+    limiter = SlidingWindowCounterRateLimiter(_storage(uri))
+    item = parse(f"{hits * 10} per hour")
+    start = time.perf_counter()
+    for _ in range(hits):
+        limiter.hit(item, 'bench')
+    return (time.perf_counter() - start) / hits
+
+def _hammer(uri, limit, attempts, results):
+    limiter = SlidingWindowCounterRateLimiter(_storage(uri))
+    item = parse(f"{limit} per hour")
+    results.put(sum(limiter.hit(item, 'shared') for _ in range(attempts)))
+
+def _allowed_across_processes(uri, processes, limit):
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_hammer, args=(uri, limit, limit, results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    allowed = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return allowed
+
+def _request_latency(tmp, enabled, requests):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, f'app-{enabled}.db')}"
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        RATELIMIT_ENABLED = enabled
+        RATELIMIT_DEFAULT = f"{requests * 10} per hour"
+        RATELIMIT_STORAGE_URI = f"sqlite:///{os.path.join(tmp, 'requests.db')}"
+
+    cwd = os.getcwd()
+    os.chdir(tmp)  # create_app writes its log file under ./logs
+    try:
+        client = create_app(BenchConfig).test_client()
+    finally:
+        os.chdir(cwd)
+    client.post('/auth/register', json={'username': 'bench', 'email': 'bench@example.com', 'password': 'bench'})
+    token = client.post('/auth/login', json={'username': 'bench', 'password': 'bench'}).json['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/auth/protected', headers=headers)
+    return (time.perf_counter() - start) / requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hits', type=int, default=20000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_uri = f"sqlite:///{os.path.join(tmp, 'limits.db')}"
+        for name, uri in (('memory://', 'memory://'), ('sqlite', sqlite_uri)):
+            print(f"{name:<10} {_time_hits(uri, args.hits) * 1e6:8.1f}us per hit")
+
+        print(f"\n{args.processes} processes x {args.limit} attempts against a limit of {args.limit}:")
+        for name, uri in (('memory://', 'memory://'), ('sqlite', sqlite_uri)):
+            allowed = _allowed_across_processes(uri, args.processes, args.limit)
+            print(f"{name:<10} {allowed:8d} allowed")
+
+        disabled = _request_latency(tmp, False, args.requests)
+        enabled = _request_latency(tmp, True, args.requests)
+        print(f"\nGET /auth/protected: {disabled * 1e6:.0f}us without the limiter, "
+              f"{enabled * 1e6:.0f}us with it ({(enabled - disabled) * 1e6:+.0f}us per request)")
+
+if __name__ == '__main__':
+    main()
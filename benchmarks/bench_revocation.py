@@ -0,0 +1,61 @@
+"""Microbenchmark for the JWT blocklist check in data_vault_web/revocation.py.
+
+Fills a throwaway SQLite database with revoked tokens, loads them into a
+RevocationStore and times is_revoked for unknown and revoked jtis. For
+comparison it also times the indexed database query a naive blocklist
+loader would run on every request.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_revocation --revoked 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import timeit
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_vault_web'))
+
+from sqlalchemy.orm import sessionmaker
+
+from shared.models import RevokedToken, init_engine
+from revocation import RevocationStore
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--revoked', type=int, default=100000)
+    parser.add_argument('--number', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = init_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Session = sessionmaker(bind=engine)
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+        jtis = [str(uuid.uuid4()) for _ in range(args.revoked)]
+        with Session() as session:
+            session.bulk_insert_mappings(RevokedToken, [{'jti': jti, 'expires_at': expires_at} for jti in jtis])
+            session.commit()
+
+        store = RevocationStore(refresh_interval=3600)
+        store._session_factory = Session
+        start = time.perf_counter()
+        store.refresh(force=True)
+        print(f"initial load of {args.revoked} revoked tokens: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        unknown, revoked = str(uuid.uuid4()), jtis[len(jtis) // 2]
+        for label, jti in (('unknown jti', unknown), ('revoked jti', revoked)):
+            seconds = timeit.timeit(lambda: store.is_revoked(jti), number=args.number)
+            print(f"is_revoked, {label}: {seconds / args.number * 1e9:8.0f}ns per check")
+
+        number = min(args.number, 20000)
+        with Session() as session:
+            query = lambda: session.query(RevokedToken.id).filter_by(jti=unknown).first()
+            seconds = timeit.timeit(query, number=number)
+        print(f"database lookup, unknown jti: {seconds / number * 1e9:8.0f}ns per check")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark for write throughput over sharded SQLite databases.
+
+Spreads --users users over 1, 2, 4... SQLite files with the server's
+ShardRouter (shared.sharding) and has --writers processes add credentials
+for random users for --seconds, one credential per transaction as the API
+does. SQLite lets one transaction write to a file at a time, so on a
+single database the writers queue behind each other's commits; with
+shards, writers for users on different shards commit side by side. For
+each shard count it reports the writes per second over all writers and the
+time the slowest tenth of them took.
+
+Whether throughput grows with the shard count depends on what the commit
+waits for: run it with --synchronous FULL (every commit reaches the disk)
+and as many writers as the machine has cores to see the effect of the
+write lock; with one core the writers mostly wait for the CPU instead.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_shard_writes --shards 1,2,4 --writers 8 --synchronous FULL
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from shared.encryption import EncryptionManager
+from shared.models import Credential, User, init_engine
+from shared.sharding import ShardRouter
+
+def _router(directory_url, urls, pragmas):
+    directory = init_engine(directory_url, sqlite_pragmas=pragmas)
+    shards = [directory if url == directory_url else init_engine(url, sqlite_pragmas=pragmas) for url in urls]
+    return ShardRouter(directory, shards, placement_ttl=3600)
+
+def _setup(directory_url, urls, pragmas, users):
+    router = _router(directory_url, urls, pragmas)
+    Session = router.sessionmaker()
+    user_ids = []
+    for i in range(users):
+        with Session() as session:
+            user = User(username=f'bench{i}', email=f'bench{i}@example.com', password_hash='x')
+            router.place(session, user)
+            session.add(user)
+            session.commit()
+            user_ids.append(user.id)
+    placed = [0] * len(urls)
+    for user_id in user_ids:
+        placed[router.locate(user_id)] += 1
+    return user_ids, placed
+
+def _writer(directory_url, urls, pragmas, user_ids, payload, seconds, seed, start, results):
+    router = _router(directory_url, urls, pragmas)
+    Session = router.sessionmaker()
+    rng = random.Random(seed)
+    latencies = []
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        user_id = rng.choice(user_ids)
+        began = time.perf_counter()
+        with Session() as session:
+            router.route(session, user_id)
+            session.add(Credential(name=f'site-{rng.getrandbits(32):08x}', encrypted_data=payload, user_id=user_id))
+            session.commit()
+        latencies.append(time.perf_counter() - began)
+    results.put(latencies)
+
+def _run(tmp, count, args, pragmas, payload):
+    directory_url = f"sqlite:///{os.path.join(tmp, f'{count}_shard_0.db')}"
+    urls = [directory_url] + [f"sqlite:///{os.path.join(tmp, f'{count}_shard_{i}.db')}" for i in range(1, count)]
+    user_ids, placed = _setup(directory_url, urls, pragmas, args.users)
+    start = multiprocessing.Barrier(args.writers + 1)
+    results = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=_writer, args=(directory_url, urls, pragmas, user_ids, payload, args.seconds,
+                                                             seed, start, results))
+               for seed in range(args.writers)]
+    for writer in writers:
+        writer.start()
+    start.wait()
+    latencies = sorted(latency for _ in writers for latency in results.get())
+    for writer in writers:
+        writer.join()
+    return len(latencies) / args.seconds, latencies[int(len(latencies) * 0.9)], placed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', default='1,2,4', help='Comma separated shard counts')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'])
+    args = parser.parse_args()
+
+    pragmas = {'synchronous': args.synchronous}
+    encryption = EncryptionManager(EncryptionManager.generate_key(), executor='thread')
+    payload = encryption.encrypt_data(os.urandom(30).hex())
+    encryption.close()
+    print(f"{args.writers} writers, {args.users} users, {args.seconds}s per run, synchronous={args.synchronous}, "
+          f"{os.cpu_count()} CPUs")
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in [int(c) for c in args.shards.split(',')]:
+            rate, p90, placed = _run(tmp, count, args, pragmas, payload)
+            baseline = baseline or rate
+            print(f"  {count} shard(s) {rate:9.0f} writes/s ({rate / baseline:5.2f}x)  "
+                  f"p90 {p90 * 1000:7.2f}ms  users per shard {placed}")
+
+if __name__ == '__main__':
+    main()
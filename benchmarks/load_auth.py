@@ -0,0 +1,89 @@
+"""Load test: credential read latency while /auth/login is saturated.
+
+Measures GET /api/credentials latency twice, first with readers alone and
+then while a second group of threads hammers /auth/login. With password
+hashing in its bounded pool, the read p99 should stay roughly flat and
+excess logins should come back as fast 503s rather than queueing.
+
+Start the server with rate limiting off so the limiter does not absorb the
+storm, e.g.
+
+    RATELIMIT_ENABLED=false gunicorn --threads 8 -w 2 'app:create_app()'
+
+then, from the repository root:
+
+    python -m benchmarks.load_auth --url http://127.0.0.1:8000 \\
+        --username alice --password '...' --duration 20
+"""
+import argparse
+import statistics
+import threading
+import time
+from collections import Counter
+
+import requests
+
+def _percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def _reader(url, token, stop, latencies):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {token}'
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = session.get(f'{url}/api/credentials', params={'limit': 50, 'fields': 'id,name'})
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+
+def _login_storm(url, username, password, stop, statuses):
+    session = requests.Session()
+    while not stop.is_set():
+        response = session.post(f'{url}/auth/login', json={'username': username, 'password': password})
+        statuses[response.status_code] += 1
+
+def _phase(args, token, storm):
+    stop = threading.Event()
+    latencies, statuses = [], Counter()
+    threads = [threading.Thread(target=_reader, args=(args.url, token, stop, latencies))
+               for _ in range(args.read_threads)]
+    if storm:
+        threads += [threading.Thread(target=_login_storm, args=(args.url, args.username, args.password, stop, statuses))
+                    for _ in range(args.login_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--read-threads', type=int, default=4)
+    parser.add_argument('--login-threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    login = requests.post(f'{args.url}/auth/login', json={'username': args.username, 'password': args.password})
+    login.raise_for_status()
+    token = login.json()['access_token']
+
+    print(f"{'phase':<14}{'reads':>8}{'p50':>10}{'p99':>10}{'mean':>10}  logins")
+    for name, storm in (('baseline', False), ('login storm', True)):
+        latencies, statuses = _phase(args, token, storm)
+        mean = statistics.mean(latencies) if latencies else float('nan')
+        print(f"{name:<14}{len(latencies):>8}{_percentile(latencies, 50) * 1000:>8.1f}ms"
+              f"{_percentile(latencies, 99) * 1000:>8.1f}ms{mean * 1000:>8.1f}ms  {dict(statuses)}")
+
+    stats = requests.get(f'{args.url}/api/stats', headers={'Authorization': f'Bearer {token}'})
+    if stats.status_code == 200:
+        print('password hasher:', stats.json()['password_hasher'])
+
+if __name__ == '__main__':
+    main()
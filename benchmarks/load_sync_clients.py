@@ -0,0 +1,225 @@
+"""Load test: many sync clients against the WSGI and the ASGI server.
+
+Seeds a throwaway SQLite vault with one user per client, then starts each
+server in turn on it (gunicorn with threaded workers, then uvicorn running
+data_vault_web/asgi.py, the same number of worker processes each) and opens
+--clients keep-alive connections at once. Every client behaves like a CLI
+polling for changes: a conditional GET /api/get_credentials?since=<cursor>
+(mostly answered 304), every --write-every'th round a one-item
+POST /api/sync_credentials, and --think seconds of idle time in between.
+For each server it reports completed requests, throughput, latency
+percentiles, failed requests, and how many clients got no answer at all.
+
+Rate limiting is turned off for the run. Needs gunicorn, uvicorn and
+aiosqlite (pip install .[asgi] gunicorn), and a file descriptor limit above
+twice --clients. Run from the repository root:
+
+    python -m benchmarks.load_sync_clients --clients 1000 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEB = os.path.join(ROOT, 'data_vault_web')
+
+SERVERS = {
+    'wsgi': '-m gunicorn -k gthread -w {workers} --threads {threads} --backlog 4096 --keep-alive 75 '
+            '-b 127.0.0.1:{port} app:create_app()',
+    'asgi': '-m uvicorn --factory asgi:create_asgi_app --workers {workers} --backlog 4096 --timeout-keep-alive 75 '
+            '--log-level warning --host 127.0.0.1 --port {port}',
+}
+
+def _seed(env, clients, credentials):
+    # One user per client with a few credentials each; returns their tokens
+    os.environ.update(env)
+    sys.path.insert(0, WEB)
+    from app import create_app
+    from flask_jwt_extended import create_access_token
+    from shared.ciphertext import to_text
+    from shared.models import User, bulk_insert_credentials
+
+    app = create_app()
+    session = app.db_session
+    users = [User(username=f'load{i}', email=f'load{i}@example.com', password_hash='x') for i in range(clients)]
+    session.add_all(users)
+    session.commit()
+    data = app.encryption_manager.encrypt_data('correct horse battery staple')
+    for user in users:
+        bulk_insert_credentials(session, user.id, [{'name': f'site-{n}', 'encrypted_data': data}
+                                                   for n in range(credentials)])
+    session.commit()
+    with app.app_context():
+        tokens = [create_access_token(identity=user.public_id, expires_delta=False) for user in users]
+    app.db_session.remove()
+    app.encryption_manager.close()
+    return tokens, to_text(data)
+
+async def _request(reader, writer, method, path, headers, body=b''):
+    head = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1', f'Content-Length: {len(body)}']
+    head += [f'{name}: {value}' for name, value in headers.items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    response_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    if response_headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            chunks.append(chunk[:-2])
+        payload = b''.join(chunks)
+    else:
+        payload = await reader.readexactly(int(response_headers.get('content-length', 0)))
+    return status, response_headers, payload
+
+async def _client(index, port, token, data, args, deadline, latencies, statuses):
+    auth = {'Authorization': f'Bearer {token}'}
+    rng = random.Random(index)
+    cursor, etag, served, connection = 0, None, 0, None
+
+    async def send(method, path, headers, body=b''):
+        # Like an HTTP client library, retries once on a fresh connection
+        # when the server has dropped an idle keep-alive one.
+        nonlocal connection
+        for attempt in range(2):
+            reused = connection is not None
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return await _request(*connection, method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                connection = None
+                if not reused or attempt:
+                    raise
+
+    # Spread the connects out a little, as real clients would arrive
+    await asyncio.sleep(rng.random() * min(args.think, 1.0))
+    round_number = 0
+    while time.monotonic() < deadline:
+        round_number += 1
+        start = time.perf_counter()
+        try:
+            if round_number % args.write_every == 0:
+                change = {'name': f'site-{rng.randrange(args.credentials)}', 'data': data,
+                          'last_modified': datetime.now(timezone.utc).isoformat()}
+                body = json.dumps({'changes': [change]}).encode()
+                status, headers, _ = await asyncio.wait_for(
+                    send('POST', '/api/sync_credentials', dict(auth, **{'Content-Type': 'application/json'}), body),
+                    args.timeout)
+            else:
+                status, headers, payload = await asyncio.wait_for(
+                    send('GET', f'/api/get_credentials?since={cursor}&limit=100',
+                         dict(auth, **({'If-None-Match': etag} if etag else {}))), args.timeout)
+                if status == 200:
+                    cursor = json.loads(payload)['cursor']
+                    etag = headers.get('etag')
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+            served += 1
+            if headers.get('connection', '').lower() == 'close':
+                connection[1].close()
+                connection = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+            statuses['error'] += 1
+            if connection is not None:
+                connection[1].close()
+            connection = None
+        await asyncio.sleep(args.think * (0.5 + rng.random()))
+    if connection is not None:
+        connection[1].close()
+    return served
+
+async def _load(port, tokens, data, args):
+    deadline = time.monotonic() + args.duration
+    latencies, statuses = [], Counter()
+    served = await asyncio.gather(*(_client(i, port, token, data, args, deadline, latencies, statuses)
+                                    for i, token in enumerate(tokens)))
+    return latencies, statuses, sum(1 for count in served if not count)
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with status {process.returncode}')
+        try:
+            asyncio.run(asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 1))
+            return
+        except (OSError, asyncio.TimeoutError):
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+def _percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else float('nan')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think', type=float, default=1.0, help='Mean idle seconds between a client\'s requests')
+    parser.add_argument('--write-every', type=int, default=10)
+    parser.add_argument('--credentials', type=int, default=20, help='Credentials per user')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds before a request counts as failed')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--servers', default='wsgi,asgi')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            'DATABASE_URL': f"sqlite:///{os.path.join(tmp, 'vault.db')}",
+            'RATELIMIT_ENABLED': 'false',
+            'RATELIMIT_STORAGE_URI': f"sqlite:///{os.path.join(tmp, 'ratelimit.db')}",
+            'SECRET_KEY': 'load-test',
+            'JWT_SECRET_KEY': 'load-test-jwt-secret-of-at-least-32-bytes',
+            'ENCRYPTION_SECRET': 'nDjp1zY8bbe5VxtjqNUpe0ZNT_R1fN7dwxtFgUyY2D8=',
+        }
+        print(f"seeding {args.clients} users x {args.credentials} credentials ...")
+        tokens, data = _seed(env, args.clients, args.credentials)
+
+        print(f"{args.clients} clients, {args.duration:.0f}s, think {args.think}s, "
+              f"a write every {args.write_every} requests, {args.workers} workers")
+        print(f"{'server':<8}{'requests':>10}{'req/s':>9}{'p50':>10}{'p99':>10}{'max':>10}"
+              f"{'failed':>8}{'starved':>9}  statuses")
+        for name in args.servers.split(','):
+            command = SERVERS[name].format(workers=args.workers, threads=args.threads, port=args.port)
+            # Run in the scratch directory, which also receives the servers' logs/
+            server = subprocess.Popen([sys.executable] + shlex.split(command), cwd=tmp,
+                                      env=dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, WEB]), **env),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _wait_for_port(args.port, server)
+                latencies, statuses, starved = asyncio.run(_load(args.port, tokens, data, args))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            failed = statuses.pop('error', 0)
+            print(f"{name:<8}{len(latencies):>10}{len(latencies) / args.duration:>9.0f}"
+                  f"{_percentile(latencies, 50) * 1000:>8.1f}ms{_percentile(latencies, 99) * 1000:>8.1f}ms"
+                  f"{(latencies[-1] if latencies else float('nan')) * 1000:>8.1f}ms"
+                  f"{failed:>8}{starved:>9}  {dict(statuses)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# data_vault_cli/agent.py
+#
+# A small ssh-agent style helper: `data-vault-cli unlock` derives the vault
+# key once and hands it to a background process, which serves encrypt and
+# decrypt requests over a Unix socket only the current user can open. Later
+# CLI invocations talk to the agent instead of running PBKDF2 again.
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from shared.ciphertext import from_text, to_text
+
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+
+class AgentError(Exception):
+    pass
+
+def agent_available() -> bool:
+    return hasattr(socket, 'AF_UNIX')
+
+def default_socket_path() -> str:
+    if os.environ.get('DATA_VAULT_AGENT_SOCK'):
+        return os.environ['DATA_VAULT_AGENT_SOCK']
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.data_vault')
+    return os.path.join(base, 'data-vault-agent.sock')
+
+class AgentServer:
+    def __init__(self, username: str, key: bytes, socket_path: str, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 compress_min_size: int = None):
+        # Imported here: only the agent process itself needs cryptography
+        from shared.encryption import EncryptionManager
+        self.username = username
+        self.manager = EncryptionManager(key, compress_min_size=compress_min_size)
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self._running = False
+        self._lock = threading.Lock()
+
+    def _bind(self) -> socket.socket:
+        directory = os.path.dirname(self.socket_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket file as 0600 so there is no window in which
+        # another user could connect.
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(8)
+        return sock
+
+    def _peer_allowed(self, conn: socket.socket) -> bool:
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+        return int.from_bytes(creds[4:8], sys.byteorder) == os.getuid()
+
+    def serve_forever(self):
+        sock = self._bind()
+        sock.settimeout(1)
+        self._running = True
+        self._last_activity = time.monotonic()
+        self._active = 0
+        try:
+            while self._running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    # Idle for too long with nobody connected: drop the key.
+                    if not self._active and time.monotonic() - self._last_activity > self.idle_timeout:
+                        break
+                    continue
+                if not self._peer_allowed(conn):
+                    conn.close()
+                    continue
+                with self._lock:
+                    self._active += 1
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.manager = None
+
+    def _serve_connection(self, conn: socket.socket):
+        conn.settimeout(self.idle_timeout)
+        stream = conn.makefile('rwb')
+        try:
+            for line in stream:
+                self._last_activity = time.monotonic()
+                try:
+                    response = self.handle(json.loads(line))
+                except Exception as e:
+                    response = {'ok': False, 'msg': str(e)}
+                stream.write(json.dumps(response).encode() + b'\n')
+                stream.flush()
+                if not self._running:
+                    break
+        except (socket.timeout, OSError):
+            pass
+        finally:
+            stream.close()
+            conn.close()
+            with self._lock:
+                self._active -= 1
+                self._last_activity = time.monotonic()
+
+    def handle(self, request: dict) -> dict:
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'username': self.username}
+        if op == 'lock':
+            self._running = False
+            return {'ok': True}
+        if op == 'encrypt':
+            return {'ok': True, 'results': [to_text(value) for value in self.manager.encrypt_many(request['items'])]}
+        if op == 'decrypt':
+            results = self.manager.decrypt_many((from_text(item) for item in request['items']), errors='return')
+            errors = {index: type(result).__name__ for index, result in enumerate(results) if isinstance(result, Exception)}
+            return {'ok': True,
+                    'results': [None if index in errors else result for index, result in enumerate(results)],
+                    'errors': errors}
+        return {'ok': False, 'msg': f"Unknown operation: {op}"}
+
+class AgentClient:
+    # Mirrors the EncryptionManager methods the CLI uses, so callers do not
+    # care whether the key lives in this process or in the agent.
+
+    def __init__(self, socket_path: str = None, timeout: float = 10):
+        self.socket_path = socket_path or default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.socket_path)
+        self.stream = self.sock.makefile('rwb')
+
+    @classmethod
+    def connect(cls, username: str = None, socket_path: str = None):
+        if not agent_available():
+            return None
+        try:
+            client = cls(socket_path)
+            info = client._call('ping')
+        except (OSError, AgentError, ValueError):
+            return None
+        if username is not None and info.get('username') != username:
+            client.close()
+            return None
+        return client
+
+    def _call(self, op: str, **payload) -> dict:
+        self.stream.write(json.dumps(dict(payload, op=op)).encode() + b'\n')
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise AgentError("Agent closed the connection")
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise AgentError(response.get('msg', 'Agent request failed'))
+        return response
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def lock(self):
+        self._call('lock')
+        self.close()
+
+    def encrypt_many(self, items, errors: str = 'raise') -> list:
+        items = [item.decode() if isinstance(item, bytes) else item for item in items]
+        return [from_text(value) for value in self._call('encrypt', items=items)['results']]
+
+    def decrypt_many(self, items, errors: str = 'raise') -> list:
+        # Ciphertext travels over the socket in its text form
+        items = [to_text(item) for item in items]
+        response = self._call('decrypt', items=items)
+        results = response['results']
+        for index, error in response['errors'].items():
+            if errors == 'raise':
+                raise AgentError(f"Item {index}: {error}")
+            results[int(index)] = AgentError(error)
+        return results
+
+    def encrypt_data(self, data: str) -> bytes:
+        return self.encrypt_many([data])[0]
+
+    def decrypt_data(self, encrypted_data) -> str:
+        return self.decrypt_many([encrypted_data])[0]
+
+def start_agent(username: str, key: bytes, socket_path: str = None,
+                idle_timeout: float = DEFAULT_IDLE_TIMEOUT, wait: float = 5, compress_min_size: int = None) -> int:
+    socket_path = socket_path or default_socket_path()
+    existing = AgentClient.connect(socket_path=socket_path)
+    if existing is not None:
+        existing.lock()
+
+    pid = os.fork()
+    if pid == 0:
+        # Detach from the terminal so the agent outlives this command.
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            AgentServer(username, key, socket_path, idle_timeout, compress_min_size).serve_forever()
+        finally:
+            os._exit(0)
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        client = AgentClient.connect(username, socket_path)
+        if client is not None:
+            client.close()
+            return pid
+        time.sleep(0.05)
+    raise AgentError("Agent did not start")
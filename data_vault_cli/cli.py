@@ -1,17 +1,22 @@
 import click
-from sqlalchemy.orm import sessionmaker
 from getpass import getpass
-from shared.models import User, Credential, init_db
-from sqlalchemy.exc import IntegrityError
-from shared.encryption import hash_password, verify_password, generate_key, encrypt_data, decrypt_data
 from colorama import Fore, Style
 import re
 import sys
 import secrets
 import string
-from shared.db_sync import DatabaseSynchronizer
+import time
+from data_vault_cli.agent import AgentClient, AgentError, agent_available, start_agent, DEFAULT_IDLE_TIMEOUT
+from data_vault_cli.transfer import FORMATS, RecordWriter, chunked, detect_format, read_records
+import contextlib
+import hashlib
+import itertools
 import os
 
+# SQLAlchemy, cryptography and requests are imported inside the commands
+# that use them, so commands like generate-password start without loading
+# any of them. bench_cli_startup guards this.
+
 def validate_password_strength(password):
     if len(password) < 12:
         return False
@@ -29,19 +34,36 @@ def generate_strong_password(length=16):
     alphabet = string.ascii_letters + string.digits + string.punctuation
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
+class VaultState(dict):
+    # ctx.obj for every command. The engine and session are created the
+    # first time a command asks for them, so commands that never touch the
+    # local database don't pay for opening it.
+
+    def __missing__(self, key):
+        if key == 'engine':
+            from shared.models import init_engine
+            self[key] = init_engine(os.getenv('LOCAL_DB_URL', 'sqlite:///data_vault_local.db'))
+        elif key == 'session':
+            from sqlalchemy.orm import sessionmaker
+            self[key] = sessionmaker(bind=self['engine'])()
+        else:
+            raise KeyError(key)
+        return self[key]
+
 @click.group()
 @click.pass_context
 def cli(ctx):
-    ctx.ensure_object(dict)
-    ctx.obj['engine'] = init_db()
-    Session = sessionmaker(bind=ctx.obj['engine'])
-    ctx.obj['session'] = Session()
+    ctx.obj = VaultState(ctx.obj or {})
 
 @cli.command()
 @click.option('--username', prompt=True, help='Your username')
+@click.option('--email', prompt=True, help='Your email address')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='Your password')
 @click.pass_context
-def register(ctx, username, password):
+def register(ctx, username, email, password):
+    from sqlalchemy.exc import IntegrityError
+    from werkzeug.security import generate_password_hash
+    from shared.models import User
     if not username or len(username) < 3:
         click.echo(Fore.RED + 'Username must be at least 3 characters long.' + Style.RESET_ALL)
         return
@@ -51,20 +73,23 @@ def register(ctx, username, password):
         return
     
     try:
-        hashed_password, salt = hash_password(password)
-        encryption_key = generate_key()
         session = ctx.obj['session']
-        new_user = User(username=username, password=hashed_password, salt=salt, encryption_key=encryption_key)
+        # The vault key is derived from the password and this salt on login
+        new_user = User(username=username, email=email, password_hash=generate_password_hash(password),
+                        kdf_salt=os.urandom(16))
         session.add(new_user)
         session.commit()
         click.echo(Fore.GREEN + 'User registered successfully!' + Style.RESET_ALL)
     except IntegrityError:
-        click.echo(Fore.RED + 'Username already exists. Please choose a different username.' + Style.RESET_ALL)
+        session.rollback()
+        click.echo(Fore.RED + 'Username or email already exists. Please choose a different one.' + Style.RESET_ALL)
     except Exception as e:
         click.echo(Fore.RED + f'An unexpected error occurred: {str(e)}' + Style.RESET_ALL)
         sys.exit(1)
 
-def print_menu():
+def print_menu(sync_status=None):
+    if sync_status:
+        click.echo("\n" + Style.DIM + f"Sync: {sync_status}" + Style.RESET_ALL)
     click.echo("\n" + Fore.CYAN + "Options:" + Style.RESET_ALL)
     click.echo("1. View Credentials")
     click.echo("2. Add Credential")
@@ -74,70 +99,162 @@ def print_menu():
     click.echo("6. Sync Databases")
     click.echo("7. Logout")
 
+def compress_min_size():
+    # Plaintexts of at least this many bytes are compressed before
+    # encryption; 0 turns it off
+    return int(os.getenv('ENCRYPTION_COMPRESS_MIN_SIZE', '1024')) or None
+
+def open_vault(session, username, password):
+    # Returns (user, encryption) for the vault, or (None, None) if the
+    # credentials are wrong. An unlocked agent already holds the vault key,
+    # so neither the password check nor the PBKDF2 derivation has to run
+    # again.
+    from shared.encryption import EncryptionManager
+    from shared.models import User
+    user = session.query(User).filter_by(username=username).first()
+    encryption = AgentClient.connect(username)
+    if encryption is None:
+        if password is None:
+            password = click.prompt('Password', hide_input=True)
+        key = derive_vault_key(session, user, password)
+        if key is None:
+            return None, None
+        encryption = EncryptionManager(key, compress_min_size=compress_min_size())
+    if user is None:
+        return None, None
+    return user, encryption
+
+def derive_vault_key(session, user, password):
+    # The user's vault key, or None if the password is wrong
+    from werkzeug.security import check_password_hash
+    from shared.encryption import generate_key
+    if not (user and check_password_hash(user.password_hash, password)):
+        return None
+    if user.kdf_salt is None:
+        # A user added before the salt was stored, e.g. by a sync
+        user.kdf_salt = os.urandom(16)
+        session.commit()
+    key, _ = generate_key(password, user.kdf_salt)
+    return key
+
+def make_synchronizer(session):
+    from shared.db_sync import DatabaseSynchronizer
+    remote_url = os.getenv('REMOTE_DB_URL', 'http://example.com/api')
+    api_key = os.getenv('API_KEY', 'your-api-key')
+    chunk_size = int(os.getenv('SYNC_CHUNK_SIZE', '200'))
+    return DatabaseSynchronizer(session, remote_url, api_key, chunk_size=chunk_size)
+
 @cli.command()
 @click.option('--username', prompt=True, help='Your username')
-@click.option('--password', prompt=True, hide_input=True, help='Your password')
+@click.option('--password', help='Your password (not needed while the vault is unlocked)')
+@click.option('--watch', is_flag=True, help='Pull changes made on other devices as soon as the server has them')
 @click.pass_context
-def login(ctx, username, password):
+def login(ctx, username, password, watch):
+    from data_vault_cli.interactive import BackgroundSync, CredentialCache, DEFAULT_DEBOUNCE
     try:
         session = ctx.obj['session']
-        user = session.query(User).filter_by(username=username).first()
+        user, encryption = open_vault(session, username, password)
 
-        if user and verify_password(password, user.password, user.salt):
+        if user:
             click.echo(Fore.GREEN + f'Logged in as {username}' + Style.RESET_ALL)
             ctx.obj['user'] = user
+            ctx.obj['encryption'] = encryption
+            ctx.obj['cache'] = CredentialCache(session, user.id)
 
-            # Initialize DatabaseSynchronizer
-            remote_url = os.getenv('REMOTE_DB_URL', 'http://example.com/api')
-            api_key = os.getenv('API_KEY', 'your-api-key')
-            ctx.obj['syncer'] = DatabaseSynchronizer(session, remote_url, api_key)
-
-            # Perform initial sync
-            click.echo(Fore.CYAN + "Syncing with remote database..." + Style.RESET_ALL)
-            ctx.obj['syncer'].perform_full_sync(user)
-            click.echo(Fore.GREEN + "Sync completed." + Style.RESET_ALL)
+            # The initial sync and every push run in the background, so the
+            # menu is usable right away even if the server is slow or down.
+            debounce = float(os.getenv('SYNC_DEBOUNCE', DEFAULT_DEBOUNCE))
+            ctx.obj['sync'] = BackgroundSync(ctx.obj['engine'], user.id, make_synchronizer,
+                                             debounce=debounce, on_pull=ctx.obj['cache'].invalidate, watch=watch)
+            ctx.obj['sync'].start()
+            try:
+                while True:
+                    print_menu(sync_status(ctx))
+                    option = click.prompt("\nSelect an option", type=click.Choice(['1', '2', '3', '4', '5', '6', '7']))
 
-            while True:
-                print_menu()
-                option = click.prompt("\nSelect an option", type=click.Choice(['1', '2', '3', '4', '5', '6', '7']))
-
-                if option == '1':
-                    view_credentials(ctx)
-                elif option == '2':
-                    add_credential(ctx)
-                elif option == '3':
-                    update_credential(ctx)
-                elif option == '4':
-                    delete_credential(ctx)
-                elif option == '5':
-                    generate_password(ctx)
-                elif option == '6':
-                    sync_databases(ctx)
-                elif option == '7':
-                    click.echo(Fore.CYAN + "\nGoodbye!" + Style.RESET_ALL)
-                    break
+                    if option == '1':
+                        view_credentials(ctx)
+                    elif option == '2':
+                        add_credential(ctx)
+                    elif option == '3':
+                        update_credential(ctx)
+                    elif option == '4':
+                        delete_credential(ctx)
+                    elif option == '5':
+                        generate_password(ctx)
+                    elif option == '6':
+                        sync_databases(ctx)
+                    elif option == '7':
+                        break
+            finally:
+                finish_sync(ctx)
+            click.echo(Fore.CYAN + "\nGoodbye!" + Style.RESET_ALL)
         else:
             click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL)
     except Exception as e:
         click.echo(Fore.RED + f'Error: {str(e)}' + Style.RESET_ALL)
 
 def sync_databases(ctx):
-    click.echo(Fore.CYAN + "Syncing with remote database..." + Style.RESET_ALL)
-    ctx.obj['syncer'].perform_full_sync(ctx.obj['user'])
-    click.echo(Fore.GREEN + "Sync completed." + Style.RESET_ALL)
+    ctx.obj['sync'].request_sync()
+    click.echo(Fore.CYAN + "Sync started in the background; its progress is shown above the menu." + Style.RESET_ALL)
 
-def view_credentials(ctx):
-    user = ctx.obj['user']
-    credentials = ctx.obj['session'].query(Credential).filter_by(user=user).all()
-    if credentials:
-        click.echo(Fore.CYAN + 'Your credentials:' + Style.RESET_ALL)
-        for credential in credentials:
-            decrypted_data = decrypt_data(credential.data, user.encryption_key)
-            click.echo(f'{credential.id}. {credential.name}: {decrypted_data}')
-    else:
+def sync_status(ctx):
+    from shared.db_sync import outbox_counts
+    counts = outbox_counts(ctx.obj['session'], ctx.obj['user'].id)
+    status = ctx.obj['sync'].status()
+    if counts['pending']:
+        status += f"; {counts['pending']} changes pending"
+        if counts['failed']:
+            status += f" ({counts['failed']} failed, retrying with backoff)"
+    return status
+
+def finish_sync(ctx):
+    from shared.db_sync import outbox_counts
+    sync = ctx.obj['sync']
+    if sync.pending():
+        click.echo(Fore.CYAN + "Finishing sync..." + Style.RESET_ALL)
+    sync.stop(timeout=float(os.getenv('SYNC_EXIT_TIMEOUT', '30')))
+    counts = outbox_counts(ctx.obj['session'], ctx.obj['user'].id)
+    if counts['pending']:
+        click.echo(Fore.YELLOW + f"{counts['pending']} changes have not reached the server yet; "
+                   "they will be pushed on the next sync." + Style.RESET_ALL)
+
+def show_credentials(entries, values=None, heading='Your credentials:'):
+    # entries are (id, name) pairs; values maps ids to decrypted data, and
+    # is None when only the names are listed.
+    if not entries:
         click.echo(Fore.YELLOW + 'No credentials found.' + Style.RESET_ALL)
+        return False
+    click.echo(Fore.CYAN + heading + Style.RESET_ALL)
+    for credential_id, name in entries:
+        if values is None:
+            click.echo(f'{credential_id}. {name}')
+            continue
+        decrypted_data = values.get(credential_id)
+        if decrypted_data is None or isinstance(decrypted_data, Exception):
+            decrypted_data = Fore.RED + '<unable to decrypt>' + Style.RESET_ALL
+        click.echo(f'{credential_id}. {name}: {decrypted_data}')
+    return True
+
+def view_credentials(ctx):
+    entries = ctx.obj['cache'].entries()
+    values = ctx.obj['cache'].decrypt(ctx.obj['encryption'], [credential_id for credential_id, _ in entries])
+    return show_credentials(entries, values)
+
+def find_credentials(ctx):
+    # Lists ids and names to pick a credential to change from; nothing is
+    # decrypted. A search term narrows the list to the matches.
+    from shared.models import search_credentials
+    query = click.prompt(Fore.CYAN + "Search by name (leave empty to list all)" + Style.RESET_ALL,
+                         default='', show_default=False)
+    if not query.strip():
+        return show_credentials(ctx.obj['cache'].entries())
+    matches = search_credentials(ctx.obj['session'], ctx.obj['user'].id, query)
+    return show_credentials([(credential.id, credential.name) for credential in matches],
+                            heading='Matching credentials:')
 
 def add_credential(ctx):
+    from shared.models import Credential
     user = ctx.obj['user']
     name = click.prompt(Fore.CYAN + "Enter service name" + Style.RESET_ALL)
     if not name or len(name) < 1:
@@ -148,17 +265,20 @@ def add_credential(ctx):
         click.echo(Fore.RED + 'Credential data cannot be empty.' + Style.RESET_ALL)
         return
     try:
-        encrypted_data = encrypt_data(data, user.encryption_key)
-        new_credential = Credential(name=name, data=encrypted_data, user=user)
+        encrypted_data = ctx.obj['encryption'].encrypt_data(data)
+        new_credential = Credential(name=name, encrypted_data=encrypted_data, user=user)
         ctx.obj['session'].add(new_credential)
         ctx.obj['session'].commit()
+        ctx.obj['cache'].put(new_credential)
         click.echo(Fore.GREEN + 'Credential added successfully!' + Style.RESET_ALL)
-        ctx.obj['syncer'].sync_to_remote(user)
+        ctx.obj['sync'].request_push()
     except Exception as e:
         click.echo(Fore.RED + f'An error occurred while adding the credential: {str(e)}' + Style.RESET_ALL)
 
 def update_credential(ctx):
-    view_credentials(ctx)
+    from shared.models import Credential
+    if not find_credentials(ctx):
+        return
     credential_id = click.prompt(Fore.CYAN + "Enter the ID of the credential to update" + Style.RESET_ALL, type=int)
     credential = ctx.obj['session'].query(Credential).filter_by(id=credential_id, user=ctx.obj['user']).first()
     if credential:
@@ -167,18 +287,20 @@ def update_credential(ctx):
             click.echo(Fore.RED + 'Credential data cannot be empty.' + Style.RESET_ALL)
             return
         try:
-            encrypted_data = encrypt_data(new_data, ctx.obj['user'].encryption_key)
-            credential.data = encrypted_data
+            encrypted_data = ctx.obj['encryption'].encrypt_data(new_data)
+            credential.encrypted_data = encrypted_data
             ctx.obj['session'].commit()
             click.echo(Fore.GREEN + 'Credential updated successfully!' + Style.RESET_ALL)
-            ctx.obj['syncer'].sync_to_remote(ctx.obj['user'])
+            ctx.obj['sync'].request_push()
         except Exception as e:
             click.echo(Fore.RED + f'An error occurred while updating the credential: {str(e)}' + Style.RESET_ALL)
     else:
         click.echo(Fore.RED + 'Credential not found.' + Style.RESET_ALL)
 
 def delete_credential(ctx):
-    view_credentials(ctx)
+    from shared.models import Credential
+    if not find_credentials(ctx):
+        return
     credential_id = click.prompt(Fore.CYAN + "Enter the ID of the credential to delete" + Style.RESET_ALL, type=int)
     credential = ctx.obj['session'].query(Credential).filter_by(id=credential_id, user=ctx.obj['user']).first()
     if credential:
@@ -187,8 +309,9 @@ def delete_credential(ctx):
             try:
                 ctx.obj['session'].delete(credential)
                 ctx.obj['session'].commit()
+                ctx.obj['cache'].discard(credential_id)
                 click.echo(Fore.GREEN + 'Credential deleted successfully!' + Style.RESET_ALL)
-                ctx.obj['syncer'].sync_to_remote(ctx.obj['user'])
+                ctx.obj['sync'].request_push()
             except Exception as e:
                 click.echo(Fore.RED + f'An error occurred while deleting the credential: {str(e)}' + Style.RESET_ALL)
         else:
@@ -196,6 +319,239 @@ def delete_credential(ctx):
     else:
         click.echo(Fore.RED + 'Credential not found.' + Style.RESET_ALL)
 
+@cli.command()
+@click.option('--username', prompt=True, help='Your username')
+@click.option('--password', prompt=True, hide_input=True, help='Your password')
+@click.option('--timeout', default=DEFAULT_IDLE_TIMEOUT, show_default=True, help='Lock again after this many idle seconds')
+@click.pass_context
+def unlock(ctx, username, password, timeout):
+    from shared.models import User
+    if not agent_available():
+        click.echo(Fore.RED + 'The unlock agent needs Unix domain sockets, which this platform lacks.' + Style.RESET_ALL)
+        return
+    session = ctx.obj['session']
+    user = session.query(User).filter_by(username=username).first()
+    key = derive_vault_key(session, user, password)
+    if key is None:
+        click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL)
+        return
+    try:
+        start_agent(username, key, idle_timeout=timeout, compress_min_size=compress_min_size())
+    except (AgentError, OSError) as e:
+        click.echo(Fore.RED + f'Could not start the agent: {str(e)}' + Style.RESET_ALL)
+        sys.exit(1)
+    click.echo(Fore.GREEN + f'Vault unlocked for {username}; locks after {timeout} idle seconds.' + Style.RESET_ALL)
+
+@cli.command()
+def lock():
+    agent = AgentClient.connect()
+    if agent is None:
+        click.echo(Fore.YELLOW + 'No unlock agent is running.' + Style.RESET_ALL)
+        return
+    agent.lock()
+    click.echo(Fore.GREEN + 'Vault locked.' + Style.RESET_ALL)
+
+def _open_stream(path, mode):
+    if path == '-':
+        return contextlib.nullcontext(click.get_text_stream('stdin' if mode == 'r' else 'stdout'))
+    if mode == 'w':
+        # Exports may hold plaintext secrets: never create them world-readable.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        return os.fdopen(fd, 'w', newline='', encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
+
+def _import_checkpoint(session, user, path, restart):
+    # Progress is keyed by the file's path, size and mtime and committed with
+    # each batch, so an interrupted import resumes exactly where it stopped.
+    from shared.models import ImportCheckpoint
+    if path == '-':
+        return None
+    stat = os.stat(path)
+    source = hashlib.sha256(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    checkpoint = session.get(ImportCheckpoint, (user.id, source))
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(user_id=user.id, source=source, records=0)
+        session.add(checkpoint)
+    elif restart:
+        checkpoint.records = 0
+    elif checkpoint.records:
+        click.echo(Fore.CYAN + f'Resuming after {checkpoint.records} records already imported from this file.' + Style.RESET_ALL)
+    return checkpoint
+
+@cli.command(name='import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--username', prompt=True, help='Your username')
+@click.option('--password', help='Your password (not needed while the vault is unlocked)')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='File format (default: from the file extension)')
+@click.option('--encrypted', is_flag=True, help='Data is already encrypted with this vault\'s key (from export --encrypted)')
+@click.option('--batch-size', default=5000, show_default=True, help='Records encrypted and committed per transaction')
+@click.option('--restart', is_flag=True, help='Ignore progress saved by an interrupted import of this file')
+@click.option('--sync/--no-sync', default=True, show_default=True, help='Push the imported credentials when done')
+@click.pass_context
+def import_credentials(ctx, path, username, password, fmt, encrypted, batch_size, restart, sync):
+    from shared.ciphertext import from_text
+    from shared.models import bulk_insert_credentials
+    session = ctx.obj['session']
+    user, encryption = open_vault(session, username, password)
+    if user is None:
+        click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL)
+        return
+
+    checkpoint = _import_checkpoint(session, user, path, restart)
+    processed = checkpoint.records if checkpoint else 0
+    imported = skipped = 0
+    try:
+        with _open_stream(path, 'r') as stream:
+            records = itertools.islice(read_records(stream, fmt or detect_format(path)), processed, None)
+            for batch in chunked(records, batch_size):
+                valid = [r for r in batch if isinstance(r, dict) and r.get('name') and r.get('data')]
+                data = [r['data'] for r in valid]
+                if encrypted:
+                    # Only keep ciphertext this vault can actually decrypt.
+                    data = [from_text(str(d)) for d in data]
+                    checked = encryption.decrypt_many(data, errors='return')
+                    kept = [(r, d) for r, d, c in zip(valid, data, checked) if not isinstance(c, Exception)]
+                    valid, data = [r for r, _ in kept], [d for _, d in kept]
+                else:
+                    data = encryption.encrypt_many(data)
+                bulk_insert_credentials(session, user.id, [{'name': r['name'], 'encrypted_data': d}
+                                                           for r, d in zip(valid, data)])
+                processed += len(batch)
+                if checkpoint is not None:
+                    checkpoint.records = processed
+                session.commit()
+                imported += len(valid)
+                skipped += len(batch) - len(valid)
+                click.echo(f'\r{processed} records processed', nl=False, err=True)
+    except (ValueError, UnicodeDecodeError) as e:
+        session.rollback()
+        click.echo(Fore.RED + f'\nImport stopped after {processed} records: {str(e)}' + Style.RESET_ALL, err=True)
+        if checkpoint is not None:
+            click.echo('Run the same command again to resume.', err=True)
+        sys.exit(1)
+
+    if checkpoint is not None:
+        session.delete(checkpoint)
+        session.commit()
+    click.echo(Fore.GREEN + f'\nImported {imported} credentials' + Style.RESET_ALL
+               + (Fore.YELLOW + f', skipped {skipped} invalid records' + Style.RESET_ALL if skipped else '') + '.')
+
+    if sync and imported:
+        click.echo(Fore.CYAN + "Syncing with remote database..." + Style.RESET_ALL)
+        if make_synchronizer(session).sync_to_remote(user):
+            click.echo(Fore.GREEN + "Sync completed." + Style.RESET_ALL)
+        else:
+            click.echo(Fore.YELLOW + "Sync failed; the credentials will be pushed on the next sync." + Style.RESET_ALL)
+
+@cli.command(name='export')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--username', prompt=True, help='Your username')
+@click.option('--password', help='Your password (not needed while the vault is unlocked)')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='File format (default: from the file extension, else json)')
+@click.option('--encrypted', is_flag=True, help='Write the encrypted data instead of decrypting it')
+@click.option('--batch-size', default=1000, show_default=True, help='Records read and decrypted at a time')
+@click.pass_context
+def export_credentials(ctx, path, username, password, fmt, encrypted, batch_size):
+    from shared.ciphertext import to_text
+    from shared.models import Credential
+    session = ctx.obj['session']
+    user, encryption = open_vault(session, username, password)
+    if user is None:
+        click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL, err=True)
+        return
+
+    rows = (session.query(Credential.public_id, Credential.name, Credential.encrypted_data, Credential.updated_at)
+            .filter(Credential.user_id == user.id)
+            .order_by(Credential.id)
+            .yield_per(batch_size))
+    failed = 0
+    with _open_stream(path, 'w') as stream:
+        writer = RecordWriter(stream, fmt or detect_format(path))
+        for chunk in chunked(rows, batch_size):
+            data = ([to_text(row.encrypted_data) for row in chunk] if encrypted
+                    else encryption.decrypt_many((row.encrypted_data for row in chunk), errors='return'))
+            for row, value in zip(chunk, data):
+                if isinstance(value, Exception):
+                    failed += 1
+                    continue
+                writer.write({'id': row.public_id, 'name': row.name, 'data': value,
+                              'last_modified': row.updated_at.isoformat() if row.updated_at else None})
+        writer.close()
+
+    click.echo(Fore.GREEN + f'Exported {writer.count} credentials.' + Style.RESET_ALL, err=True)
+    if failed:
+        click.echo(Fore.YELLOW + f'{failed} credentials could not be decrypted and were left out.' + Style.RESET_ALL, err=True)
+
+@cli.command()
+@click.argument('query')
+@click.option('--username', prompt=True, help='Your username')
+@click.option('--password', help='Your password (not needed while the vault is unlocked)')
+@click.option('--limit', default=20, show_default=True, help='Maximum number of matches')
+@click.pass_context
+def search(ctx, query, username, password, limit):
+    from shared.models import search_credentials
+    session = ctx.obj['session']
+    user, encryption = open_vault(session, username, password)
+    if user is None:
+        click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL)
+        return
+    matches = search_credentials(session, user.id, query, limit)
+    values = encryption.decrypt_many((credential.encrypted_data for credential in matches), errors='return')
+    show_credentials([(credential.id, credential.name) for credential in matches],
+                     {credential.id: value for credential, value in zip(matches, values)}, 'Matching credentials:')
+
+@cli.command()
+@click.option('--username', prompt=True, help='Your username')
+@click.option('--password', help='Your password (not needed while the vault is unlocked)')
+@click.option('--timeout', default=25, show_default=True, help='Seconds the server holds each request open')
+@click.pass_context
+def watch(ctx, username, password, timeout):
+    from data_vault_cli.interactive import WATCH_RETRY_BASE, WATCH_RETRY_MAX
+    session = ctx.obj['session']
+    user, _ = open_vault(session, username, password)
+    if user is None:
+        click.echo(Fore.RED + 'Invalid username or password. Please try again.' + Style.RESET_ALL)
+        return
+
+    pulled = []
+    syncer = make_synchronizer(session)
+    syncer.log = lambda message: click.echo(Fore.YELLOW + message + Style.RESET_ALL, err=True)
+    syncer.progress = lambda kind, count: pulled.append(count) if kind == 'pulled' else None
+    syncer.perform_full_sync(user)
+    click.echo(Fore.CYAN + 'Watching for remote changes, press Ctrl+C to stop.' + Style.RESET_ALL)
+    seq, delay = None, WATCH_RETRY_BASE
+    try:
+        while True:
+            changed = syncer.wait_for_remote_change(user, seq, timeout)
+            if changed is None:
+                time.sleep(delay)
+                delay = min(delay * 2, WATCH_RETRY_MAX)
+                continue
+            delay = WATCH_RETRY_BASE
+            if changed == seq:
+                continue
+            seq = changed
+            del pulled[:]
+            if syncer.sync_from_remote(user) and pulled:
+                click.echo(f'{time.strftime("%H:%M:%S")} pulled {sum(pulled)} changes')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        syncer.close()
+
+@cli.command(name='convert-ciphertexts')
+@click.option('--batch-size', default=1000, show_default=True, help='Credentials converted per transaction')
+@click.option('--vacuum', is_flag=True, help='Afterwards, VACUUM the local database to give the space back')
+@click.pass_context
+def convert_ciphertexts(ctx, batch_size, vacuum):
+    from shared.models import convert_legacy_ciphertexts
+    engine = ctx.obj['engine']
+    converted = convert_legacy_ciphertexts(engine, batch_size=batch_size, log=lambda m: click.echo(m, err=True))
+    click.echo(Fore.GREEN + f'{converted} credentials converted to the binary format.' + Style.RESET_ALL)
+    if vacuum and engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+
 @cli.command()
 @click.pass_context
 def generate_password(ctx):
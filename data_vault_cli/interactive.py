@@ -0,0 +1,242 @@
+# data_vault_cli/interactive.py
+#
+# Support for the interactive `login` session: a background worker that
+# keeps the local vault in sync without blocking the menu, and a cache of
+# credential names so the menu can list entries without re-reading and
+# decrypting the vault.
+
+import threading
+import time
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from shared.models import Credential, User
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_WATCH_TIMEOUT = 25.0
+JOB_LABELS = {'full': 'syncing', 'pull': 'pulling remote changes', 'push': 'pushing local changes'}
+WATCH_RETRY_BASE = 5.0
+WATCH_RETRY_MAX = 300.0
+
+class CredentialCache:
+    # Ids and names of the user's credentials, loaded once and patched on
+    # local edits. Values are never cached: decrypt() reads and decrypts
+    # only the credentials about to be shown.
+
+    def __init__(self, session, user_id: int):
+        self.session = session
+        self.user_id = user_id
+        self._entries = None
+        self._stale = threading.Event()
+
+    def invalidate(self):
+        # Safe to call from the sync worker; the reload happens on the
+        # menu's thread the next time the entries are needed.
+        self._stale.set()
+
+    def entries(self):
+        if self._entries is None or self._stale.is_set():
+            self._stale.clear()
+            rows = (self.session.query(Credential.id, Credential.name)
+                    .filter(Credential.user_id == self.user_id))
+            self._entries = {row.id: row.name for row in rows}
+        return sorted(self._entries.items(), key=lambda entry: (entry[1].lower(), entry[0]))
+
+    def put(self, credential: Credential):
+        if self._entries is not None:
+            self._entries[credential.id] = credential.name
+
+    def discard(self, credential_id: int):
+        if self._entries is not None:
+            self._entries.pop(credential_id, None)
+
+    def decrypt(self, encryption, credential_ids):
+        # Returns {id: plaintext or Exception} for the given ids
+        rows = (self.session.query(Credential.id, Credential.encrypted_data)
+                .filter(Credential.user_id == self.user_id, Credential.id.in_(list(credential_ids)))
+                .all()) if credential_ids else []
+        values = encryption.decrypt_many((row.encrypted_data for row in rows), errors='return')
+        return {row.id: value for row, value in zip(rows, values)}
+
+class BackgroundSync:
+    # Runs syncs on a worker thread with its own database session, so the
+    # menu stays usable while the server is slow or unreachable. Local
+    # edits call request_push(); the push waits until no edit has arrived
+    # for `debounce` seconds, so a burst of edits goes out as one batch.
+    # Changes that fail stay in the outbox, and the worker wakes up again
+    # when the first of them is due for a retry. Failures and progress are
+    # recorded for status() instead of being printed over the prompt.
+    #
+    # With watch=True a second thread long-polls the server (GET
+    # /api/watch) and has the worker pull as soon as another device
+    # changes the vault, instead of waiting for the next manual sync.
+
+    def __init__(self, engine, user_id: int, make_synchronizer, debounce: float = DEFAULT_DEBOUNCE,
+                 on_pull=None, watch: bool = False, watch_timeout: float = DEFAULT_WATCH_TIMEOUT):
+        self.engine = engine
+        self.user_id = user_id
+        self.make_synchronizer = make_synchronizer
+        self.debounce = debounce
+        self.on_pull = on_pull
+        self.watch = watch
+        self.watch_timeout = watch_timeout
+        self._cond = threading.Condition()
+        self._full_sync = False
+        self._pull = False
+        self._push_due = None
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._running = None
+        self._pushed = 0
+        self._pulled = 0
+        self._last_result = None
+        self._last_error = None
+        self._thread = None
+
+    def start(self, full_sync: bool = True):
+        with self._cond:
+            self._full_sync = full_sync
+        self._thread = threading.Thread(target=self._run, name='data-vault-sync', daemon=True)
+        self._thread.start()
+        if self.watch:
+            threading.Thread(target=self._watch, name='data-vault-watch', daemon=True).start()
+
+    def request_push(self):
+        with self._cond:
+            self._push_due = time.monotonic() + self.debounce
+            self._cond.notify()
+
+    def request_pull(self):
+        with self._cond:
+            self._pull = True
+            self._cond.notify()
+
+    def request_sync(self):
+        with self._cond:
+            self._full_sync = True
+            self._cond.notify()
+
+    def pending(self) -> bool:
+        with self._cond:
+            return self._full_sync or self._pull or self._push_due is not None or self._running is not None
+
+    def stop(self, timeout: float = 30) -> bool:
+        # Flushes a debounced push right away, then waits for the worker.
+        # Returns False if it was still busy when the timeout expired.
+        self._stopped.set()
+        with self._cond:
+            self._stopping = True
+            if self._push_due is not None:
+                self._push_due = time.monotonic()
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def status(self) -> str:
+        with self._cond:
+            if self._running is not None:
+                return f"{self._running}... ({self._pulled} pulled, {self._pushed} pushed)"
+            parts = []
+            if self._last_result is not None:
+                at, ok = self._last_result
+                parts.append(f"last sync {'completed' if ok else 'failed'} at {at:%H:%M:%S}")
+                if not ok and self._last_error:
+                    parts.append(self._last_error)
+            return '; '.join(parts) or 'waiting to sync'
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._full_sync:
+                    self._full_sync, self._pull, self._push_due = False, False, None
+                    return 'full'
+                if self._push_due is not None and now >= self._push_due:
+                    self._push_due = None
+                    return 'push'
+                if self._pull and not self._stopping:
+                    self._pull = False
+                    return 'pull'
+                if self._stopping:
+                    return None
+                self._cond.wait(None if self._push_due is None else self._push_due - now)
+
+    def _log(self, message: str):
+        with self._cond:
+            self._last_error = message
+
+    def _progress(self, kind: str, count: int):
+        with self._cond:
+            if kind == 'pulled':
+                self._pulled += count
+            else:
+                self._pushed += count
+        if kind == 'pulled' and self.on_pull is not None:
+            self.on_pull()
+
+    def _run(self):
+        session = sessionmaker(bind=self.engine)()
+        syncer = self.make_synchronizer(session)
+        syncer.log, syncer.progress = self._log, self._progress
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                with self._cond:
+                    self._running = JOB_LABELS[job]
+                    self._pulled = self._pushed = 0
+                    self._last_error = None
+                retry_in = None
+                try:
+                    user = session.get(User, self.user_id)
+                    if job == 'full':
+                        ok = syncer.perform_full_sync(user)
+                    elif job == 'pull':
+                        ok = syncer.sync_from_remote(user)
+                    else:
+                        ok = syncer.sync_to_remote(user)
+                    retry_in = syncer.outbox_retry_delay(user)
+                except Exception as e:
+                    session.rollback()
+                    self._log(f"Sync error: {e}")
+                    ok = False
+                with self._cond:
+                    self._running = None
+                    self._last_result = (datetime.now(), ok)
+                    pulled = self._pulled
+                    if retry_in is not None and not self._stopping:
+                        due = time.monotonic() + retry_in
+                        if self._push_due is None or due < self._push_due:
+                            self._push_due = due
+                if pulled and self.on_pull is not None:
+                    self.on_pull()
+        finally:
+            syncer.close()
+            session.close()
+
+    def _watch(self):
+        # Remembers the last remote version it saw, so a change the worker
+        # has not pulled yet does not wake it again. Backs off while the
+        # server is unreachable.
+        session = sessionmaker(bind=self.engine)()
+        syncer = self.make_synchronizer(session)
+        syncer.log = self._log
+        seq, delay = None, WATCH_RETRY_BASE
+        try:
+            while not self._stopped.is_set():
+                changed = syncer.wait_for_remote_change(session.get(User, self.user_id), seq, self.watch_timeout)
+                if changed is None:
+                    self._stopped.wait(delay)
+                    delay = min(delay * 2, WATCH_RETRY_MAX)
+                    continue
+                delay = WATCH_RETRY_BASE
+                if changed != seq:
+                    # The first answer pulls too; an up-to-date vault
+                    # costs a 304
+                    self.request_pull()
+                    seq = changed
+        finally:
+            syncer.close()
+            session.close()
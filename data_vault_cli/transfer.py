@@ -0,0 +1,90 @@
+# data_vault_cli/transfer.py
+#
+# Record readers and writers for `data-vault-cli import` / `export`. All of
+# them work one record at a time so vault dumps of any size run in constant
+# memory. Records are dicts with at least 'name' and 'data'.
+
+import csv
+import itertools
+import json
+
+FORMATS = ('csv', 'json', 'jsonl')
+EXPORT_FIELDS = ('id', 'name', 'data', 'last_modified')
+
+def chunked(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def detect_format(path: str, default: str = 'json') -> str:
+    for fmt in FORMATS:
+        if path.lower().endswith('.' + fmt):
+            return fmt
+    return default
+
+def _iter_json_stream(stream, chunk_size: int = 64 * 1024):
+    # Accepts either a JSON array of objects or JSON Lines, decoding one
+    # object at a time from a sliding buffer.
+    decoder = json.JSONDecoder()
+    buffer, pos = '', 0
+    in_array = None
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            more = stream.read(chunk_size)
+            if not more:
+                if in_array:
+                    raise ValueError("Unexpected end of JSON array")
+                return
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        if in_array is None:
+            in_array = buffer[pos] == '['
+            pos += in_array
+            continue
+        if in_array and buffer[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            more = stream.read(chunk_size)
+            if not more:
+                raise
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield record
+        pos = end
+
+def read_records(stream, fmt: str):
+    if fmt == 'csv':
+        return csv.DictReader(stream)
+    return _iter_json_stream(stream)
+
+class RecordWriter:
+    def __init__(self, stream, fmt: str):
+        self.stream = stream
+        self.fmt = fmt
+        self.count = 0
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(stream, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            self._csv.writeheader()
+        elif fmt == 'json':
+            stream.write('[')
+
+    def write(self, record: dict):
+        if self.fmt == 'csv':
+            self._csv.writerow(record)
+        elif self.fmt == 'json':
+            self.stream.write((',\n' if self.count else '\n') + json.dumps(record))
+        else:
+            self.stream.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.fmt == 'json':
+            self.stream.write('\n]\n' if self.count else ']\n')
+        self.stream.flush()
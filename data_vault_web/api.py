@@ -1,53 +1,158 @@
 # Imports
-from flask import Blueprint, jsonify, request, current_app
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from shared.models import Credential, User
-from shared.encryption import EncryptionManager
+from flask import Blueprint, jsonify, request, current_app, g, stream_with_context
+from flask_jwt_extended import jwt_required
+from shared.models import (Credential, CredentialTombstone, IdempotencyRecord, MerkleNode, User, normalize_timestamp,
+                           rebuild_merkle_tree, merkle_tree_is_current, merkle_children, merkle_bucket_items,
+                           merkle_bucket_tombstones, search_credentials, UserNotFound)
+from shared.sharding import UserMoving
+from shared.merkle import MERKLE_DEPTH, EMPTY_HASH
+from shared.ciphertext import from_text, to_text
 from sqlalchemy.exc import IntegrityError
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-from datetime import datetime
+from ratelimit import limiter, rate_limit_key
+from streaming import stream_json, json_response
+from identity import resolve_user_id, user_moving
+from replicas import replica_reads
+from watch import WatchBusy
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import json
+import re
+import time
+import zlib
 
-# Blueprint and Limiter initialization
+# Blueprint initialization
 api = Blueprint('api', __name__)
-limiter = Limiter(key_func=get_remote_address)
+api.register_error_handler(UserMoving, user_moving)
+api.register_error_handler(UserNotFound, user_moving)
 
-# Encryption manager initialization
-encryption_manager = EncryptionManager(current_app.config['ENCRYPTION_SECRET'])
+@api.errorhandler(WatchBusy)
+def watch_busy(e):
+    response = jsonify({"msg": "Too many open watches, please retry shortly"})
+    response.headers['Retry-After'] = str(current_app.change_notifier.retry_after)
+    return response, 503
 
 # Routes
 
+# Columns needed for each field a client can ask for with ?fields=
+CREDENTIAL_FIELDS = {
+    'id': Credential.public_id,
+    'name': Credential.name,
+    'data': Credential.encrypted_data,
+    'created_at': Credential.created_at,
+    'updated_at': Credential.updated_at,
+}
+DEFAULT_CREDENTIAL_FIELDS = ('id', 'name', 'data')
+
+# A Merkle bucket: the first characters of credential public_ids (UUIDs)
+MERKLE_PREFIX = re.compile(f'[0-9a-f]{{0,{MERKLE_DEPTH}}}')
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _serialize_credential_rows(rows, fields):
+    # Decrypt a chunk at a time so large listings can use the bulk path;
+    # rows that did not ask for 'data' never touch Fernet.
+    for chunk in _chunked(rows, current_app.config['CREDENTIALS_YIELD_PER']):
+        plaintexts = (current_app.encryption_manager.decrypt_many(row.encrypted_data for row in chunk)
+                      if 'data' in fields else itertools.repeat(None))
+        for row, plaintext in zip(chunk, plaintexts):
+            yield {field: plaintext if field == 'data' else getattr(row, CREDENTIAL_FIELDS[field].key)
+                   for field in fields}
+
+def _vault_etag(user_id):
+    # Every credential write bumps the user's change_seq, so the vault
+    # version identifies the content of any listing URL.
+    seq = current_app.db_session.query(User.change_seq).filter_by(id=user_id).scalar()
+    return seq, f"{user_id}.{seq}"
+
+def _conditional_response(etag, build):
+    # Answers If-None-Match from the version alone; build() only runs, and
+    # the credentials table is only read, when the client's copy is stale.
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Authorization')
+    return response
+
 @api.route('/credentials', methods=['GET'])
 @jwt_required()
 @limiter.limit("30 per minute")
+@replica_reads
 def get_credentials():
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
-    
-    credentials = current_app.db_session.query(Credential).filter_by(user_id=user.id).all()
-    return jsonify([
-        {
-            'id': cred.public_id,
-            'name': cred.name,
-            'data': encryption_manager.decrypt_data(cred.encrypted_data.encode())
-        } for cred in credentials
-    ]), 200
+
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(DEFAULT_CREDENTIAL_FIELDS)
+    unknown = [f for f in fields if f not in CREDENTIAL_FIELDS]
+    if unknown:
+        return jsonify({"msg": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    _, etag = _vault_etag(user_id)
+    if request.args.get('q') is not None:
+        return _conditional_response(etag, lambda: _search_credentials(user_id, request.args['q'], fields))
+    return _conditional_response(etag, lambda: _list_credentials(user_id, fields))
+
+def _search_credentials(user_id, query, fields):
+    # Ranked matches only; nothing outside the hits is decrypted
+    max_limit = current_app.config['SEARCH_MAX_LIMIT']
+    limit = max(1, min(request.args.get('limit', 20, type=int), max_limit))
+    matches = search_credentials(current_app.db_session, user_id, query, limit)
+    return json_response(list(_serialize_credential_rows(matches, fields)))
+
+def _list_credentials(user_id, fields):
+    # Keyset pagination on (user_id, public_id) so every page is an index
+    # range scan no matter how deep into the vault it is.
+    columns = {CREDENTIAL_FIELDS[f] for f in fields} | {Credential.public_id}
+    query = (current_app.db_session.query(*columns)
+             .filter(Credential.user_id == user_id)
+             .order_by(Credential.public_id))
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    if after:
+        query = query.filter(Credential.public_id > after)
+    if limit is None and after is None:
+        rows = query.yield_per(current_app.config['CREDENTIALS_YIELD_PER'])
+        return stream_json(_serialize_credential_rows(rows, fields))
+
+    max_limit = current_app.config['CREDENTIALS_PAGE_MAX_LIMIT']
+    limit = max(1, min(limit or max_limit, max_limit))
+    rows = query.limit(limit + 1).yield_per(current_app.config['CREDENTIALS_YIELD_PER'])
+    page = {'next_after': None}
+
+    def page_rows():
+        last = None
+        for index, row in enumerate(rows):
+            if index == limit:
+                page['next_after'] = last
+                return
+            last = row.public_id
+            yield row
+
+    return stream_json(_serialize_credential_rows(page_rows(), fields), key='credentials', trailer=lambda: page)
 
 @api.route('/credentials', methods=['POST'])
 @jwt_required()
 @limiter.limit("10 per minute")
 def add_credential():
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
     
     data = request.get_json()
     try:
-        encrypted_data = encryption_manager.encrypt_data(data['data'])
-        new_credential = Credential(name=data['name'], encrypted_data=encrypted_data, user_id=user.id)
+        encrypted_data = current_app.encryption_manager.encrypt_data(data['data'])
+        new_credential = Credential(name=data['name'], encrypted_data=encrypted_data, user_id=user_id)
         current_app.db_session.add(new_credential)
         current_app.db_session.commit()
         return jsonify({"msg": "Credential added successfully", "id": new_credential.public_id}), 201
@@ -61,12 +166,11 @@ def add_credential():
 @jwt_required()
 @limiter.limit("10 per minute")
 def update_credential(cred_public_id):
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
     
-    credential = current_app.db_session.query(Credential).filter_by(public_id=cred_public_id, user_id=user.id).first()
+    credential = current_app.db_session.query(Credential).filter_by(public_id=cred_public_id, user_id=user_id).first()
     if not credential:
         return jsonify({"msg": "Credential not found"}), 404
     
@@ -75,7 +179,7 @@ def update_credential(cred_public_id):
         if 'name' in data:
             credential.name = data['name']
         if 'data' in data:
-            credential.encrypted_data = encryption_manager.encrypt_data(data['data'])
+            credential.encrypted_data = current_app.encryption_manager.encrypt_data(data['data'])
         current_app.db_session.commit()
         return jsonify({"msg": "Credential updated successfully"}), 200
     except IntegrityError:
@@ -86,12 +190,11 @@ def update_credential(cred_public_id):
 @jwt_required()
 @limiter.limit("10 per minute")
 def delete_credential(cred_public_id):
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
     
-    credential = current_app.db_session.query(Credential).filter_by(public_id=cred_public_id, user_id=user.id).first()
+    credential = current_app.db_session.query(Credential).filter_by(public_id=cred_public_id, user_id=user_id).first()
     if not credential:
         return jsonify({"msg": "Credential not found"}), 404
     
@@ -99,48 +202,473 @@ def delete_credential(cred_public_id):
     current_app.db_session.commit()
     return jsonify({"msg": "Credential deleted successfully"}), 200
 
+def _batch_cost():
+    # Charge the rate limit per operation rather than per request. Limits
+    # run before @jwt_required, so anonymous requests are charged 1 without
+    # their body being read. The parsed body is kept for the view and for
+    # any further limits, so it is only read once.
+    if not rate_limit_key().startswith('user:'):
+        return 1
+    if 'batch_body' not in g:
+        try:
+            g.batch_body = _read_json_body()
+        except ValueError as e:
+            g.batch_body = e
+    operations = g.batch_body.get('operations') if isinstance(g.batch_body, dict) else None
+    if not isinstance(operations, list):
+        return 1
+    return max(1, min(len(operations), current_app.config['CREDENTIALS_BATCH_MAX_ITEMS']))
+
+def _validate_batch_operation(op):
+    if not isinstance(op, dict) or op.get('op') not in ('create', 'update', 'delete'):
+        return "Unknown operation"
+    if op['op'] == 'create':
+        if not isinstance(op.get('name'), str) or not isinstance(op.get('data'), str):
+            return "Missing name or data"
+        return None
+    if not isinstance(op.get('id'), str):
+        return "Missing id"
+    if op['op'] == 'update':
+        if 'name' not in op and 'data' not in op:
+            return "Missing name or data"
+        if ('name' in op and not isinstance(op['name'], str)) or ('data' in op and not isinstance(op['data'], str)):
+            return "Invalid name or data"
+    return None
+
+@api.route('/credentials/batch', methods=['POST'])
+@jwt_required()
+@limiter.limit(lambda: current_app.config['CREDENTIALS_BATCH_RATE_LIMIT'], cost=_batch_cost)
+def batch_credentials():
+    user_id = resolve_user_id()
+    if user_id is None:
+        return jsonify({"msg": "User not found"}), 404
+
+    data = g.pop('batch_body', None)
+    if data is None:
+        try:
+            data = _read_json_body()
+        except ValueError as e:
+            data = e
+    if isinstance(data, ValueError):
+        return jsonify({"msg": f"Malformed request body: {data}"}), 400
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list):
+        return jsonify({"msg": "Missing operations"}), 400
+    max_items = current_app.config['CREDENTIALS_BATCH_MAX_ITEMS']
+    if len(operations) > max_items:
+        return jsonify({"msg": f"Too many operations in one batch (max {max_items})"}), 413
+
+    results = [{'index': index} for index in range(len(operations))]
+    valid = []
+    for result, op in zip(results, operations):
+        error = _validate_batch_operation(op)
+        if error:
+            result.update(status='error', msg=error)
+        else:
+            valid.append((result, op))
+
+    session = current_app.db_session
+    ids = {op['id'] for _, op in valid if op['op'] != 'create'}
+    existing = {}
+    if ids:
+        existing = {cred.public_id: cred for cred in session.query(Credential).filter(
+            Credential.user_id == user_id, Credential.public_id.in_(ids))}
+
+    # One bulk encryption pass for every plaintext in the batch
+    plaintexts = [op['data'] for _, op in valid if 'data' in op]
+    ciphertexts = iter(current_app.encryption_manager.encrypt_many(plaintexts))
+
+    written = []
+    for result, op in valid:
+        encrypted_data = next(ciphertexts) if 'data' in op else None
+        if op['op'] == 'create':
+            credential = Credential(name=op['name'], encrypted_data=encrypted_data, user_id=user_id)
+            session.add(credential)
+            result['status'] = 'created'
+            written.append((result, credential))
+            continue
+        credential = existing.get(op['id'])
+        if credential is None:
+            result.update(status='error', id=op['id'], msg="Credential not found")
+        elif op['op'] == 'delete':
+            session.delete(credential)
+            del existing[op['id']]
+            result.update(status='deleted', id=op['id'])
+        else:
+            if 'name' in op:
+                credential.name = op['name']
+            if encrypted_data is not None:
+                credential.encrypted_data = encrypted_data
+            result.update(status='updated', id=op['id'])
+
+    # Everything is written by a single flush and committed together.
+    try:
+        session.flush()
+        for result, credential in written:
+            result['id'] = credential.public_id
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return jsonify({"msg": "Error applying batch"}), 409
+    return json_response({"results": results})
+
 # New Routes for Synchronization
 
+def _read_json_body():
+    body = request.get_data(cache=False)
+    limit = current_app.config['SYNC_MAX_BODY_BYTES']
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(body, limit + 1)
+    elif encoding != 'identity':
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+    if len(body) > limit:
+        raise ValueError("Request body too large")
+    return json.loads(body)
+
+def _apply_sync_change(session, user_id, change, by_id, by_name):
+    cred_public_id = change.get('id')
+    credential = by_id.get(cred_public_id) if cred_public_id else by_name.get(change['name'])
+    last_modified = normalize_timestamp(change.get('last_modified'))
+
+    if change.get('deleted'):
+        if not credential:
+            return 'unchanged', cred_public_id
+        session.delete(credential)
+        by_id.pop(credential.public_id, None)
+        by_name.pop(credential.name, None)
+        return 'deleted', credential.public_id
+
+    if credential:
+        current = normalize_timestamp(credential.updated_at)
+        if current is not None and (last_modified is None or last_modified <= current):
+            return 'unchanged', credential.public_id
+        credential.name = change['name']
+        credential.encrypted_data = from_text(change['data'])
+        credential.updated_at = last_modified
+        return 'updated', credential.public_id
+
+    credential = Credential(name=change['name'], encrypted_data=from_text(change['data']),
+                            user_id=user_id, updated_at=last_modified)
+    if cred_public_id:
+        credential.public_id = cred_public_id
+    session.add(credential)
+    session.flush()
+    by_id[credential.public_id] = credential
+    by_name[credential.name] = credential
+    return 'created', credential.public_id
+
+def _apply_sync_changes(session, user_id, changes):
+    ids = [c['id'] for c in changes if isinstance(c, dict) and c.get('id')]
+    names = [c['name'] for c in changes if isinstance(c, dict) and not c.get('id') and c.get('name')]
+    by_id, by_name = {}, {}
+    if ids:
+        by_id = {cred.public_id: cred for cred in session.query(Credential).filter(
+            Credential.user_id == user_id, Credential.public_id.in_(ids))}
+    if names:
+        by_name = {cred.name: cred for cred in session.query(Credential).filter(
+            Credential.user_id == user_id, Credential.name.in_(names))}
+
+    results = []
+    for index, change in enumerate(changes):
+        result = {'index': index}
+        try:
+            if not isinstance(change, dict):
+                raise KeyError('change')
+            # Each change gets its own savepoint so one bad item does not
+            # roll back the rest of the chunk.
+            with session.begin_nested():
+                result['status'], result['id'] = _apply_sync_change(session, user_id, change, by_id, by_name)
+        except KeyError:
+            result.update(status='error', msg="Missing required data")
+        except (ValueError, TypeError):
+            result.update(status='error', msg="Invalid last_modified")
+        except IntegrityError:
+            result.update(status='error', msg="Error syncing credential")
+        results.append(result)
+    session.commit()
+    return results
+
 @api.route('/sync_credential', methods=['POST'])
 @jwt_required()
 def sync_credential():
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
-    
+
     data = request.get_json()
+    result = _apply_sync_changes(current_app.db_session, user_id, [data])[0]
+    if result['status'] == 'error':
+        return jsonify({"msg": result['msg']}), 400
+    return jsonify({"msg": "Credential synced successfully", "id": result['id']}), 200
+
+@api.route('/sync_credentials', methods=['POST'])
+@jwt_required()
+def sync_credentials_batch():
+    user_id = resolve_user_id()
+    if user_id is None:
+        return jsonify({"msg": "User not found"}), 404
+
     try:
-        credential = current_app.db_session.query(Credential).filter_by(name=data['name'], user_id=user.id).first()
-        if credential:
-            if datetime.fromisoformat(data['last_modified']) > credential.updated_at:
-                credential.data = data['data']
-                credential.updated_at = datetime.fromisoformat(data['last_modified'])
-        else:
-            new_credential = Credential(name=data['name'], data=data['data'], user_id=user.id)
-            current_app.db_session.add(new_credential)
-        
-        current_app.db_session.commit()
-        return jsonify({"msg": "Credential synced successfully"}), 200
-    except KeyError:
-        return jsonify({"msg": "Missing required data"}), 400
+        data = _read_json_body()
+    except ValueError as e:
+        return jsonify({"msg": f"Malformed request body: {e}"}), 400
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list):
+        return jsonify({"msg": "Missing changes"}), 400
+    max_items = current_app.config['SYNC_BATCH_MAX_ITEMS']
+    if len(changes) > max_items:
+        return jsonify({"msg": f"Too many changes in one batch (max {max_items})"}), 413
+
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 64:
+        return jsonify({"msg": "Invalid Idempotency-Key"}), 400
+    session = current_app.db_session
+    if key is not None:
+        record = session.get(IdempotencyRecord, (user_id, key))
+        # Expired records are only swept on the next insert
+        if record is not None and normalize_timestamp(record.created_at) >= normalize_timestamp(_idempotency_cutoff()):
+            response = json_response(json.loads(record.response))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+    results = _apply_sync_changes(session, user_id, changes)
+    # A batch with failed items is not remembered, so a retry under the same
+    # key applies those items again instead of replaying their errors
+    if key is not None and all(result['status'] != 'error' for result in results):
+        _remember_idempotent_response(session, user_id, key, {"results": results})
+    return json_response({"results": results})
+
+def _remember_idempotent_response(session, user_id, key, payload):
+    # The changes are already committed; they are last-writer-wins, so a
+    # retry that races this insert is still applied correctly, and the
+    # losing insert is simply dropped.
+    now = datetime.now(timezone.utc)
+    session.query(IdempotencyRecord).filter(
+        IdempotencyRecord.user_id == user_id,
+        IdempotencyRecord.created_at < _idempotency_cutoff(now)
+    ).delete(synchronize_session=False)
+    session.add(IdempotencyRecord(user_id=user_id, key=key, response=json.dumps(payload), created_at=now))
+    try:
+        session.commit()
     except IntegrityError:
-        current_app.db_session.rollback()
-        return jsonify({"msg": "Error syncing credential"}), 400
+        session.rollback()
+
+def _idempotency_cutoff(now=None):
+    now = now or datetime.now(timezone.utc)
+    return now - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+
+def _sync_feed_item(cred):
+    return {
+        'id': cred.public_id,
+        'name': cred.name,
+        'data': to_text(cred.encrypted_data),
+        'last_modified': str(cred.updated_at),
+        'seq': cred.change_seq
+    }
+
+def _sync_feed_tombstone(tombstone):
+    return {
+        'id': tombstone.public_id,
+        'name': tombstone.name,
+        'deleted': True,
+        'seq': tombstone.change_seq
+    }
+
+def _changes_since(session, user_id, since, limit):
+    yield_per = current_app.config['CREDENTIALS_YIELD_PER']
+    credentials = (session.query(Credential)
+                   .filter(Credential.user_id == user_id, Credential.change_seq > since)
+                   .order_by(Credential.change_seq)
+                   .limit(limit + 1)
+                   .yield_per(yield_per))
+    tombstones = (session.query(CredentialTombstone)
+                  .filter(CredentialTombstone.user_id == user_id, CredentialTombstone.change_seq > since)
+                  .order_by(CredentialTombstone.change_seq)
+                  .limit(limit + 1)
+                  .yield_per(yield_per))
+    return heapq.merge((_sync_feed_item(c) for c in credentials),
+                       (_sync_feed_tombstone(t) for t in tombstones),
+                       key=lambda item: item['seq'])
 
 @api.route('/get_credentials', methods=['GET'])
 @jwt_required()
+@replica_reads
 def get_credentials_for_sync():
-    user_public_id = get_jwt_identity()
-    user = current_app.db_session.query(User).filter_by(public_id=user_public_id).first()
-    if not user:
+    user_id = resolve_user_id()
+    if user_id is None:
         return jsonify({"msg": "User not found"}), 404
-    
-    credentials = current_app.db_session.query(Credential).filter_by(user_id=user.id).all()
-    return jsonify([
-        {
-            'name': cred.name,
-            'data': cred.data,
-            'last_modified': str(cred.updated_at)
-        } for cred in credentials
-    ]), 200
+
+    user_seq, etag = _vault_etag(user_id)
+    return _conditional_response(etag, lambda: _sync_feed(user_id, user_seq))
+
+def _sync_feed(user_id, user_seq):
+    since = request.args.get('since', type=int)
+    if since is None:
+        credentials = (current_app.db_session.query(Credential)
+                       .filter_by(user_id=user_id)
+                       .yield_per(current_app.config['CREDENTIALS_YIELD_PER']))
+        return stream_json(_sync_feed_item(cred) for cred in credentials)
+
+    # A cursor from the future means the client is tracking a different
+    # history (e.g. a restored server); make it start over.
+    if since > user_seq:
+        return jsonify({"changes": [], "cursor": 0, "has_more": True, "reset": True}), 200
+    if since == user_seq:
+        return jsonify({"changes": [], "cursor": since, "has_more": False}), 200
+
+    max_limit = current_app.config['SYNC_FEED_MAX_LIMIT']
+    limit = max(1, min(request.args.get('limit', max_limit, type=int), max_limit))
+    changes = _changes_since(current_app.db_session, user_id, since, limit)
+    page = {'cursor': since, 'has_more': False}
+
+    def items():
+        for index, change in enumerate(changes):
+            if index == limit:
+                page['has_more'] = True
+                return
+            page['cursor'] = change['seq']
+            yield change
+        page['cursor'] = max(user_seq, page['cursor'])
+
+    return stream_json(items(), key='changes', trailer=lambda: page)
+
+@api.route('/reconcile', methods=['POST'])
+@jwt_required()
+def reconcile():
+    user_id = resolve_user_id()
+    if user_id is None:
+        return jsonify({"msg": "User not found"}), 404
+
+    try:
+        data = _read_json_body()
+    except ValueError as e:
+        return jsonify({"msg": f"Malformed request body: {e}"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"msg": "Missing prefixes or fetch"}), 400
+    prefixes = data.get('prefixes') or []
+    buckets = data.get('buckets') or []
+    fetch = data.get('fetch') or []
+    for value in (prefixes, buckets):
+        if not isinstance(value, list) or not all(isinstance(p, str) and MERKLE_PREFIX.fullmatch(p) for p in value):
+            return jsonify({"msg": f"prefixes and buckets must be lists of up to {MERKLE_DEPTH} hex digits"}), 400
+    if not isinstance(fetch, list) or not all(isinstance(i, str) and len(i) <= 36 for i in fetch):
+        return jsonify({"msg": "fetch must be a list of credential ids"}), 400
+    if (len(prefixes) + len(buckets) > current_app.config['RECONCILE_MAX_PREFIXES']
+            or len(fetch) > current_app.config['SYNC_FEED_MAX_LIMIT']):
+        return jsonify({"msg": "Too many prefixes or ids in one request"}), 413
+
+    session = current_app.db_session
+    response = {}
+    if '' in prefixes:
+        # Rows written before the tree existed are folded in on first use.
+        if not merkle_tree_is_current(session, user_id):
+            rebuild_merkle_tree(session, user_id)
+        root = session.get(MerkleNode, (user_id, ''))
+        response['root'] = {'hash': root.hash if root else EMPTY_HASH, 'count': root.count if root else 0}
+        response['cursor'] = session.query(User.change_seq).filter_by(id=user_id).scalar()
+
+    response['children'] = {prefix: merkle_children(session, user_id, prefix)
+                            for prefix in prefixes if len(prefix) < MERKLE_DEPTH}
+    response['items'] = {prefix: merkle_bucket_items(session, user_id, prefix) for prefix in buckets}
+    response['deleted'] = {prefix: merkle_bucket_tombstones(session, user_id, prefix) for prefix in buckets}
+
+    if fetch:
+        credentials = session.query(Credential).filter(Credential.user_id == user_id, Credential.public_id.in_(fetch))
+        response['credentials'] = [_sync_feed_item(cred) for cred in credentials]
+    return json_response(response)
+
+@api.route('/watch', methods=['GET'])
+@jwt_required()
+@limiter.limit(lambda: current_app.config['WATCH_RATE_LIMIT'])
+def watch():
+    user_id = resolve_user_id()
+    if user_id is None:
+        return jsonify({"msg": "User not found"}), 404
+
+    # since is the client's sync cursor (or the id of the last event it got
+    # on a reconnecting stream); without one, wait for the next change.
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = _vault_etag(user_id)[0]
+    if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+        return _watch_stream(user_id, since)
+
+    max_timeout = current_app.config['WATCH_TIMEOUT']
+    timeout = max(0, min(request.args.get('timeout', max_timeout, type=float), max_timeout))
+    seq = _wait_for_change(user_id, since, timeout)
+    return jsonify({"seq": seq, "changed": seq != since}), 200
+
+def _wait_for_change(user_id, since, timeout):
+    # Returns the user's change_seq as soon as it differs from since, or
+    # since when the timeout runs out first. A notification only triggers a
+    # re-read, so the database stays the source of truth, and no connection
+    # is held while waiting.
+    notifier = current_app.change_notifier
+    deadline = time.monotonic() + timeout
+    while True:
+        future = notifier.subscribe(user_id)
+        try:
+            seq = current_app.db_session.query(User.change_seq).filter_by(id=user_id).scalar() or 0
+            current_app.db_session.close()
+            remaining = deadline - time.monotonic()
+            if seq != since or remaining <= 0:
+                return seq
+            if notifier.wait(future, remaining) is None:
+                return since
+        finally:
+            notifier.unsubscribe(user_id, future)
+
+def _watch_stream(user_id, since):
+    # Server-sent events: a 'change' event carrying the new change_seq for
+    # every change, and a comment every WATCH_HEARTBEAT seconds so proxies
+    # keep the connection open. The stream ends after WATCH_STREAM_MAX_AGE;
+    # EventSource clients reconnect with Last-Event-ID and miss nothing.
+    config = current_app.config
+    retry_after = current_app.change_notifier.retry_after
+
+    def events():
+        seq = since
+        deadline = time.monotonic() + config['WATCH_STREAM_MAX_AGE']
+        yield 'retry: 1000\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                new_seq = _wait_for_change(user_id, seq, min(config['WATCH_HEARTBEAT'], remaining))
+            except WatchBusy:
+                yield f'retry: {retry_after * 1000}\n\n'
+                return
+            if new_seq == seq:
+                yield ': keepalive\n\n'
+            else:
+                seq = new_seq
+                yield f'id: {seq}\nevent: change\ndata: {{"seq":{seq}}}\n\n'
+
+    response = current_app.response_class(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@api.route('/stats', methods=['GET'])
+@jwt_required()
+def stats():
+    user_id = resolve_user_id()
+    if user_id is None:
+        return jsonify({"msg": "User not found"}), 404
+    username = current_app.db_session.query(User.username).filter_by(id=user_id).scalar()
+    if username not in current_app.config['STATS_USERS']:
+        return jsonify({"msg": "Not allowed"}), 403
+
+    return jsonify({
+        "identity_cache": current_app.identity_cache.stats(),
+        "password_hasher": current_app.password_hasher.stats(),
+        "revocation": current_app.revocation_store.stats(),
+        "watch": current_app.change_notifier.stats(),
+        "shards": current_app.shard_router.stats() if current_app.shard_router is not None else None,
+        "replicas": current_app.replica_router.stats(),
+    }), 200
@@ -1,20 +1,33 @@
 from flask import Flask
 from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from flask_cors import CORS
 from config import Config
-from models import init_db
+from shared.models import init_engine
+from shared.sharding import ShardRouter
+from sqlalchemy.orm import scoped_session, sessionmaker
+from shared.encryption import EncryptionManager
 from auth import auth
 from api import api
+from identity import identity_cache
+from hashing import password_hasher
+from revocation import revocation_store
+from watch import change_notifier
+from replicas import replica_router, ReplicaSession
+from ratelimit import limiter
+from compression import response_compressor
+from streaming import init_json_encoder
+from commands import register_commands
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 
 migrate = Migrate()
 jwt = JWTManager()
-limiter = Limiter(key_func=get_remote_address)
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return revocation_store.is_revoked(jwt_payload['jti'])
 
 def create_app(config_class=Config):
     app = Flask(__name__)
@@ -24,14 +37,48 @@ def create_app(config_class=Config):
     jwt.init_app(app)
     migrate.init_app(app)
     limiter.init_app(app)
+    identity_cache.init_app(app)
+    password_hasher.init_app(app)
+    response_compressor.init_app(app)
+    init_json_encoder(app)
     CORS(app)
 
-    # Initialize database session
-    app.db_session = init_db(app.config['SQLALCHEMY_DATABASE_URI'])
+    # Initialize database session: one session per request thread, handed
+    # back to the pool when the app context is torn down
+    engine_options = dict(pool_size=app.config['SQLALCHEMY_POOL_SIZE'],
+                          max_overflow=app.config['SQLALCHEMY_MAX_OVERFLOW'],
+                          pool_timeout=app.config['SQLALCHEMY_POOL_TIMEOUT'],
+                          sqlite_pragmas=app.config['SQLITE_PRAGMAS'])
+    engine = init_engine(app.config['SQLALCHEMY_DATABASE_URI'], **engine_options)
+    app.db_engine = engine
+    if app.config['SHARD_DATABASE_URLS']:
+        # Each shard gets the full schema; sessions are routed per user
+        shards = [engine if url == app.config['SQLALCHEMY_DATABASE_URI'] else init_engine(url, **engine_options)
+                  for url in app.config['SHARD_DATABASE_URLS']]
+        app.shard_router = ShardRouter(engine, shards, placement_ttl=app.config['SHARD_PLACEMENT_TTL'],
+                                       maxsize=app.config['IDENTITY_CACHE_SIZE'])
+        app.db_session = scoped_session(app.shard_router.sessionmaker())
+        app.db_engines = shards
+    else:
+        app.shard_router = None
+        app.db_session = scoped_session(sessionmaker(class_=ReplicaSession, bind=engine))
+        app.db_engines = [engine]
+
+    @app.teardown_appcontext
+    def remove_db_session(exception=None):
+        app.db_session.remove()
+    revocation_store.init_app(app, app.db_session.session_factory)
+    change_notifier.init_app(app)
+    replica_router.init_app(app, engine_options)
+    app.encryption_manager = EncryptionManager([app.config['ENCRYPTION_SECRET']] + app.config['ENCRYPTION_EXTRA_SECRETS'],
+                                               executor=app.config['ENCRYPTION_EXECUTOR'],
+                                               parallel_threshold=app.config['ENCRYPTION_PARALLEL_THRESHOLD'],
+                                               compress_min_size=app.config['ENCRYPTION_COMPRESS_MIN_SIZE'] or None)
 
     # Register blueprints
     app.register_blueprint(auth, url_prefix='/auth')
     app.register_blueprint(api, url_prefix='/api')
+    register_commands(app)
 
     # Setup logging
     if not app.debug:
@@ -45,6 +92,8 @@ def create_app(config_class=Config):
         app.logger.addHandler(file_handler)
         app.logger.setLevel(logging.INFO)
         app.logger.info('Data Vault startup')
+        app.logger.info('Password hashing: %(method)s, %(workers)d workers, max %(max_pending)d pending'
+                        % password_hasher.stats())
 
     return app
 
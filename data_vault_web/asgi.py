@@ -0,0 +1,210 @@
+from config import Config
+from app import create_app
+from hashing import password_hasher
+from revocation import revocation_store
+from watch import change_notifier
+from sqlalchemy.orm import scoped_session, sessionmaker
+from shared.sharding import ShardRouter
+from replicas import ReplicaSession
+from shared.concurrency import run_in_greenlet
+from shared.database import create_async_db_engine
+from sqlalchemy.util import await_only
+import asyncio
+import greenlet
+import io
+import json
+import sys
+
+# Requests that mostly wait for a change notification; they hold no
+# database connection while waiting, so they don't take a slot
+LONG_POLL_PATHS = {'/api/watch'}
+
+class AsgiServer:
+    # Serves the Flask app's routes over ASGI. Each request runs the
+    # unchanged WSGI app in its own greenlet on the event loop, so auth.py
+    # and api.py answer exactly as they do under gunicorn, while every
+    # database call goes through SQLAlchemy's asyncio engine and hands the
+    # loop to other requests until the driver is done. Password hashing and
+    # bulk encryption wait on their pools the same way (shared.concurrency),
+    # so thousands of mostly idle sync clients cost a greenlet each instead
+    # of a worker thread. At most max_concurrency requests run at once;
+    # the rest wait on the loop rather than piling onto the database.
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        engine_options = dict(pool_size=config['SQLALCHEMY_POOL_SIZE'],
+                              max_overflow=config['SQLALCHEMY_MAX_OVERFLOW'],
+                              pool_timeout=config['SQLALCHEMY_POOL_TIMEOUT'],
+                              sqlite_pragmas=config['SQLITE_PRAGMAS'])
+        self.engine = create_async_db_engine(config['SQLALCHEMY_ASYNC_DATABASE_URI'], **engine_options)
+        self.engines = [self.engine]
+        # current_app.db_session keeps working in the views: one session
+        # per request greenlet, on the async engine. app.db_engine stays
+        # synchronous for the CLI commands.
+        if app.shard_router is not None:
+            # create_app() has created the schemas through the sync engines
+            shards = [self.engine if url == config['SQLALCHEMY_DATABASE_URI'] else create_async_db_engine(url, **engine_options)
+                      for url in config['SHARD_DATABASE_URLS']]
+            self.engines += [shard for shard in shards if shard is not self.engine]
+            app.shard_router = ShardRouter(self.engine.sync_engine, [shard.sync_engine for shard in shards],
+                                           placement_ttl=config['SHARD_PLACEMENT_TTL'],
+                                           maxsize=config['IDENTITY_CACHE_SIZE'], create_directory=False)
+            factory = app.shard_router.sessionmaker()
+        else:
+            factory = sessionmaker(class_=ReplicaSession, bind=self.engine.sync_engine)
+            # Replica reads on the loop too; the health checks keep their
+            # sync engines, as they run on a thread
+            for replica in app.replica_router.replicas:
+                engine = create_async_db_engine(replica.probe.url, **engine_options)
+                replica.engine = engine.sync_engine
+                self.engines.append(engine)
+        app.db_session = scoped_session(factory, scopefunc=greenlet.getcurrent)
+        revocation_store.init_app(app, app.db_session.session_factory)
+        self.slots = asyncio.Semaphore(config['ASGI_MAX_CONCURRENCY'])
+        # Bodies are buffered before the app runs, so the cap is enforced
+        # while reading rather than by the views
+        self.max_body = min(limit for limit in (config.get('MAX_CONTENT_LENGTH'), config['SYNC_MAX_BODY_BYTES'])
+                            if limit)
+        # A waiting watch costs a parked greenlet here, not a thread
+        change_notifier.max_waiters = config['ASGI_WATCH_MAX_WAITERS']
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            body = await self._read_body(scope, receive, send)
+            if body is None:
+                return
+            if scope['path'] in LONG_POLL_PATHS:
+                await self._run_long_poll(self._environ(scope, body), receive, send)
+            else:
+                async with self.slots:
+                    await run_in_greenlet(self._run_wsgi, self._environ(scope, body), send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines:
+                    await engine.dispose()
+                self.app.encryption_manager.close()
+                password_hasher.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _run_long_poll(self, environ, receive, send):
+        # Watches the connection meanwhile, so an event stream whose client
+        # has gone away ends at its next heartbeat instead of its max age.
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await run_in_greenlet(self._run_wsgi, environ, send, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def _read_body(self, scope, receive, send):
+        # None if the client went away before sending the whole body, or if
+        # it was too large and has been answered with a 413
+        declared = dict(scope.get('headers') or ()).get(b'content-length')
+        if declared is not None and declared.isdigit() and int(declared) > self.max_body:
+            await self._too_large(send)
+            return None
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body:
+                await self._too_large(send)
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    @staticmethod
+    async def _too_large(send):
+        body = json.dumps({"msg": "Request body too large"}).encode()
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                                (b'connection', b'close')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+            value = value.decode('latin-1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ, send, disconnected=None):
+        # Runs in the request's greenlet: await_only() parks it until the
+        # client has taken each chunk, so streamed listings keep their
+        # backpressure and their database cursor stays on this greenlet.
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                         headers=[(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers])
+
+        def send_start():
+            await_only(send({key: start[key] for key in ('type', 'status', 'headers')}))
+            start['sent'] = True
+
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                if disconnected is not None and disconnected.is_set():
+                    return
+                if not chunk:
+                    continue
+                if not start.get('sent'):
+                    send_start()
+                await_only(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+            if not start.get('sent'):
+                send_start()
+            await_only(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+
+def create_asgi_app(config_class=Config):
+    return AsgiServer(create_app(config_class))
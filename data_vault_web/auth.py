@@ -1,27 +1,43 @@
 from flask import Blueprint, request, jsonify, current_app
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, create_refresh_token, get_jwt
-from models import User
-from werkzeug.security import check_password_hash
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, create_refresh_token, get_jwt, decode_token
+from shared.models import User
+from shared.sharding import UserMoving
+from hashing import HasherBusy
+from identity import user_moving
 from datetime import timedelta
 from sqlalchemy.exc import IntegrityError
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from ratelimit import limiter
 
 auth = Blueprint('auth', __name__)
-limiter = Limiter(key_func=get_remote_address)
+auth.register_error_handler(UserMoving, user_moving)
+
+@auth.errorhandler(HasherBusy)
+def hasher_busy(e):
+    response = jsonify({"msg": "Server is busy, please retry shortly"})
+    response.headers['Retry-After'] = str(current_app.password_hasher.retry_after)
+    return response, 503
 
 @auth.route('/register', methods=['POST'])
 @limiter.limit("5 per hour")
 def register():
     data = request.get_json()
+    router = current_app.shard_router
     try:
         new_user = User(username=data['username'], email=data['email'])
-        new_user.set_password(data['password'])
+        new_user.password_hash = current_app.password_hasher.generate(data['password'])
+        if router is not None:
+            # Claims the username and email on every shard, and picks the
+            # user's shard and id
+            router.place(current_app.db_session, new_user)
         current_app.db_session.add(new_user)
         current_app.db_session.commit()
+        # Its first reads must not go to a replica that lacks the user
+        current_app.replica_router.pin(new_user.id)
         return jsonify({"msg": "User registered successfully", "user_id": new_user.public_id}), 201
     except IntegrityError:
         current_app.db_session.rollback()
+        if router is not None:
+            router.unplace(new_user)
         return jsonify({"msg": "Username or email already exists"}), 400
     except KeyError:
         return jsonify({"msg": "Missing username, email or password"}), 400
@@ -30,26 +46,47 @@ def register():
 @limiter.limit("10 per minute")
 def login():
     data = request.get_json()
-    user = current_app.db_session.query(User).filter_by(username=data['username']).first()
-    if user and check_password_hash(user.password_hash, data['password']):
-        access_token = create_access_token(identity=user.public_id, expires_delta=timedelta(hours=1))
-        refresh_token = create_refresh_token(identity=user.public_id)
+    user = _find_user(data['username'])
+    if user and current_app.password_hasher.verify(user.password_hash, data['password']):
+        claims = {'uid': user.id} if current_app.config['JWT_EMBED_USER_ID'] else None
+        access_token = create_access_token(identity=user.public_id, expires_delta=timedelta(hours=1), additional_claims=claims)
+        refresh_token = create_refresh_token(identity=user.public_id, additional_claims=claims)
         return jsonify(access_token=access_token, refresh_token=refresh_token), 200
     return jsonify({"msg": "Invalid username or password"}), 401
 
+def _find_user(username):
+    router = current_app.shard_router
+    if router is not None:
+        user_id = router.find(username=username)
+        if user_id is None or not router.route(current_app.db_session, user_id):
+            return None
+    return current_app.db_session.query(User).filter_by(username=username).first()
+
 @auth.route('/refresh', methods=['POST'])
 @jwt_required(refresh=True)
 def refresh():
     current_user = get_jwt_identity()
-    new_token = create_access_token(identity=current_user, expires_delta=timedelta(hours=1))
+    claims = {'uid': get_jwt()['uid']} if 'uid' in get_jwt() else None
+    new_token = create_access_token(identity=current_user, expires_delta=timedelta(hours=1), additional_claims=claims)
     return jsonify(access_token=new_token), 200
 
 @auth.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    jti = get_jwt()['jti']
-    # Here you would typically add the token to a blocklist
-    # For simplicity, we'll just return a success message
+    token = get_jwt()
+    tokens = [token]
+    # The refresh token can be revoked in the same call
+    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh_token:
+        try:
+            refresh = decode_token(refresh_token)
+        except Exception:
+            return jsonify({"msg": "Invalid refresh token"}), 400
+        if refresh.get('type') != 'refresh' or refresh['sub'] != token['sub']:
+            return jsonify({"msg": "Invalid refresh token"}), 400
+        tokens.append(refresh)
+    for revoked in tokens:
+        current_app.revocation_store.revoke(current_app.db_session, revoked['jti'], revoked['exp'])
     return jsonify({"msg": "Successfully logged out"}), 200
 
 @auth.route('/protected', methods=['GET'])
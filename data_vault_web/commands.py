@@ -0,0 +1,106 @@
+from flask import current_app
+from flask.cli import with_appcontext
+from shared.encryption import EncryptionManager
+from shared.models import convert_legacy_ciphertexts
+from shared.rotation import KeyRotator
+from shared.rebalance import ShardRebalancer
+from shared.sharding import UserPlacement
+from sqlalchemy.orm import Session
+import click
+
+@click.command('rotate-keys', help='Re-encrypt all credentials with the primary ENCRYPTION_SECRET.')
+@click.option('--batch-size', type=int, help='Credentials re-encrypted per transaction (default: KEY_ROTATION_BATCH_SIZE)')
+@click.option('--max-rate', type=float, help='Maximum rows per second, 0 for no limit (default: KEY_ROTATION_MAX_RATE)')
+@click.option('--workers', type=int, help='Encryption worker processes (default: one per CPU)')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming, even if this key\'s rotation finished')
+@with_appcontext
+def rotate_keys(batch_size, max_rate, workers, restart):
+    config = current_app.config
+    if not config['ENCRYPTION_EXTRA_SECRETS']:
+        click.echo('ENCRYPTION_EXTRA_SECRETS is empty: the data is already under the only key.')
+        return
+    batch_size = batch_size or config['KEY_ROTATION_BATCH_SIZE']
+    max_rate = config['KEY_ROTATION_MAX_RATE'] if max_rate is None else max_rate
+    # Its own manager, so every batch is spread over the pool
+    encryption = EncryptionManager(current_app.encryption_manager.keys, executor=config['ENCRYPTION_EXECUTOR'],
+                                   max_workers=workers, parallel_threshold=EncryptionManager.CHUNK_SIZE)
+    skipped = 0
+    try:
+        for engine in _shard_engines():
+            rotator = KeyRotator(engine, encryption, batch_size=batch_size,
+                                 max_rate=max_rate or None, log=click.echo)
+            skipped += rotator.run(restart=restart).skipped
+    finally:
+        encryption.close()
+    if skipped:
+        click.echo(f'{skipped} credentials could not be decrypted with any configured key '
+                   'and were left as they are.')
+    click.echo('Once no worker still needs them, the keys in ENCRYPTION_EXTRA_SECRETS can be removed.')
+
+@click.command('convert-ciphertexts', help='Convert credentials stored as token text to the binary format.')
+@click.option('--batch-size', default=1000, show_default=True, help='Credentials converted per transaction')
+@click.option('--after-id', default=0, help='Resume after this credential id')
+@click.option('--vacuum', is_flag=True, help='Afterwards, VACUUM an SQLite database to give the space back')
+@with_appcontext
+def convert_ciphertexts(batch_size, after_id, vacuum):
+    converted = 0
+    for engine in _shard_engines():
+        converted += convert_legacy_ciphertexts(engine, batch_size=batch_size, after_id=after_id, log=click.echo)
+        if vacuum and engine.dialect.name == 'sqlite':
+            with engine.connect() as conn:
+                conn.exec_driver_sql('VACUUM')
+    click.echo(f'{converted} credentials converted.')
+
+def _shard_engines():
+    engines = current_app.db_engines
+    for shard, engine in enumerate(engines):
+        if len(engines) > 1:
+            click.echo(f'Shard {shard}: {engine.url.render_as_string(hide_password=True)}')
+        yield engine
+
+def _rebalancer(batch_size, grace):
+    if current_app.shard_router is None:
+        raise click.ClickException('SHARD_DATABASE_URLS is not set.')
+    return ShardRebalancer(current_app.shard_router, batch_size=batch_size or current_app.config['SHARD_MOVE_BATCH_SIZE'],
+                           grace=grace, log=click.echo)
+
+@click.command('rebalance-shards', help='Move every user to the shard their public id hashes to, while serving. '
+                                        'Adds users from before sharding to the shard directory first.')
+@click.option('--dry-run', is_flag=True, help='Only list the users that would be moved')
+@click.option('--limit', type=int, help='Move at most this many users')
+@click.option('--batch-size', type=int, help='Rows copied per transaction (default: SHARD_MOVE_BATCH_SIZE)')
+@click.option('--grace', type=float, help='Seconds a user is frozen before the final copy (default: SHARD_PLACEMENT_TTL + 1)')
+@click.option('--purge-orphans', is_flag=True, help='Delete copies of users left behind by interrupted moves')
+@with_appcontext
+def rebalance_shards(dry_run, limit, batch_size, grace, purge_orphans):
+    rebalancer = _rebalancer(batch_size, grace)
+    if purge_orphans and not dry_run:
+        rebalancer.adopt(purge_orphans=True)
+    moved = rebalancer.run(limit=limit, dry_run=dry_run)
+    if not dry_run:
+        click.echo(f'{moved} users moved.')
+
+@click.command('move-user', help='Move one user to another shard, while serving.')
+@click.argument('username')
+@click.argument('shard', type=int)
+@click.option('--batch-size', type=int, help='Rows copied per transaction (default: SHARD_MOVE_BATCH_SIZE)')
+@click.option('--grace', type=float, help='Seconds the user is frozen before the final copy (default: SHARD_PLACEMENT_TTL + 1)')
+@with_appcontext
+def move_user(username, shard, batch_size, grace):
+    rebalancer = _rebalancer(batch_size, grace)
+    if not 0 <= shard < len(current_app.shard_router.shards):
+        raise click.ClickException(f'There is no shard {shard}.')
+    rebalancer.adopt()
+    with Session(current_app.shard_router.directory) as session:
+        placement = session.query(UserPlacement).filter_by(username=username).first()
+        if placement is None:
+            raise click.ClickException(f'No user {username}.')
+        user_id = placement.id
+    if not rebalancer.move(user_id, shard):
+        click.echo(f'{username} is already on shard {shard}.')
+
+def register_commands(app):
+    app.cli.add_command(rotate_keys)
+    app.cli.add_command(convert_ciphertexts)
+    app.cli.add_command(rebalance_shards)
+    app.cli.add_command(move_user)
@@ -0,0 +1,79 @@
+from flask import request
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'text/csv'}
+
+class ResponseCompressor:
+    # Compresses JSON and text responses with the best encoding the client
+    # accepts (zstd when the zstandard package is installed, else gzip).
+    # Buffered responses below min_size are sent as is; streamed listings
+    # are compressed chunk by chunk as they are generated.
+
+    def __init__(self):
+        self.encodings = ['gzip']
+        self.min_size = 1024
+        self.gzip_level = 6
+        self.zstd_level = 3
+
+    def init_app(self, app):
+        self.encodings = [encoding for encoding in app.config['COMPRESS_ENCODINGS']
+                          if encoding == 'gzip' or (encoding == 'zstd' and zstandard is not None)]
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.gzip_level = app.config['COMPRESS_GZIP_LEVEL']
+        self.zstd_level = app.config['COMPRESS_ZSTD_LEVEL']
+        app.after_request(self.compress_response)
+        app.response_compressor = self
+
+    def _compressor(self, encoding):
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=self.zstd_level).compressobj()
+        return zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _compress_stream(self, chunks, encoding):
+        compressor = self._compressor(encoding)
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def compress_response(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = self._compressor(encoding)
+            response.set_data(compressor.compress(data) + compressor.flush())
+        response.headers['Content-Encoding'] = encoding
+
+        # The bytes now differ per encoding, so a strong validator would be
+        # wrong; the weak one still matches If-None-Match on the next poll.
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+response_compressor = ResponseCompressor()
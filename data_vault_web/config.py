@@ -8,10 +8,77 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(32)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///data_vault.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('SQLALCHEMY_POOL_SIZE') or 10)
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('SQLALCHEMY_MAX_OVERFLOW') or 20)
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get('SQLALCHEMY_POOL_TIMEOUT') or 30)  # seconds
+    # Database for the ASGI server (asgi.py); by default DATABASE_URL with
+    # the backend's async driver (aiosqlite, asyncpg or aiomysql)
+    SQLALCHEMY_ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL') or SQLALCHEMY_DATABASE_URI
+    # Requests the ASGI server runs at once per worker; idle keep-alive
+    # connections do not count. SQLite has one writer, and a transaction
+    # holding it waits its turn on the loop, so keep this low there.
+    ASGI_MAX_CONCURRENCY = int(os.environ.get('ASGI_MAX_CONCURRENCY') or 8)
+    # Horizontal sharding: users are spread over these databases (comma
+    # separated; only ever append) by a hash of their public id. The
+    # directory of placements and the revoked tokens stay in DATABASE_URL,
+    # which may also be one of the shards. Empty: no sharding.
+    SHARD_DATABASE_URLS = [u.strip() for u in (os.environ.get('SHARD_DATABASE_URLS') or '').split(',') if u.strip()]
+    # How long a worker routes a user by its cached placement; a user being
+    # moved gets 503 with Retry-After for about this long
+    SHARD_PLACEMENT_TTL = float(os.environ.get('SHARD_PLACEMENT_TTL') or 5)  # seconds
+    SHARD_MOVE_RETRY_AFTER = int(os.environ.get('SHARD_MOVE_RETRY_AFTER') or 5)  # seconds
+    SHARD_MOVE_BATCH_SIZE = int(os.environ.get('SHARD_MOVE_BATCH_SIZE') or 1000)
+    # Read replicas of DATABASE_URL (comma separated) for the credential
+    # listings and the sync feed; not used with sharding
+    REPLICA_DATABASE_URLS = [u.strip() for u in (os.environ.get('REPLICA_DATABASE_URLS') or '').split(',') if u.strip()]
+    REPLICA_HEALTH_INTERVAL = float(os.environ.get('REPLICA_HEALTH_INTERVAL') or 1)  # seconds
+    # A replica trailing the primary by more than this takes no reads
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG') or 10)  # seconds
+    # Overrides for shared.database.SQLITE_PRAGMAS (ignored for other databases)
+    SQLITE_PRAGMAS = {
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS') or 5000),
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL',
+    }
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or os.urandom(32)
     JWT_ACCESS_TOKEN_EXPIRES = 3600  # 1 hour
+    # Put the internal user id in tokens as a signed 'uid' claim at login
+    JWT_EMBED_USER_ID = os.environ.get('JWT_EMBED_USER_ID', '').lower() in ('1', 'true', 'yes')
+
+    # Revoked tokens: each worker polls for new revocations and sweeps
+    # expired ones
+    REVOCATION_REFRESH_INTERVAL = float(os.environ.get('REVOCATION_REFRESH_INTERVAL') or 1.0)  # seconds
+    REVOCATION_SWEEP_INTERVAL = int(os.environ.get('REVOCATION_SWEEP_INTERVAL') or 300)  # seconds
+    REVOCATION_REFRESH_LOOKBACK = int(os.environ.get('REVOCATION_REFRESH_LOOKBACK') or 100)  # rows
+
+    # JWT identity -> user id cache (per process)
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 60)  # seconds
+    # Usernames allowed to read /api/stats; nobody if empty
+    STATS_USERS = [u.strip() for u in (os.environ.get('STATS_USERS') or '').split(',') if u.strip()]
     ENCRYPTION_SECRET = os.environ.get('ENCRYPTION_SECRET') or EncryptionManager.generate_key()
+    # Further keys accepted for decryption only: retired keys until
+    # `flask rotate-keys` has re-encrypted their data, or the next primary
+    # key while it is rolled out to every worker
+    ENCRYPTION_EXTRA_SECRETS = [k.strip() for k in (os.environ.get('ENCRYPTION_EXTRA_SECRETS') or '').split(',') if k.strip()]
+    # Bulk encrypt/decrypt runs inline below the threshold and in a pool above it
+    ENCRYPTION_EXECUTOR = os.environ.get('ENCRYPTION_EXECUTOR') or 'process'
+    ENCRYPTION_PARALLEL_THRESHOLD = int(os.environ.get('ENCRYPTION_PARALLEL_THRESHOLD') or EncryptionManager.PARALLEL_THRESHOLD)
+    # Plaintexts of at least this many bytes are compressed before
+    # encryption when that makes them smaller (0 turns it off)
+    ENCRYPTION_COMPRESS_MIN_SIZE = int(os.environ.get('ENCRYPTION_COMPRESS_MIN_SIZE') or 1024)  # bytes
+    # Key rotation job defaults (flask rotate-keys)
+    KEY_ROTATION_BATCH_SIZE = int(os.environ.get('KEY_ROTATION_BATCH_SIZE') or 1000)
+    KEY_ROTATION_MAX_RATE = float(os.environ.get('KEY_ROTATION_MAX_RATE') or 0)  # rows/second, 0 = unlimited
     
+    # Password hashing, run in a bounded process pool per worker
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    PASSWORD_HASH_SALT_LENGTH = int(os.environ.get('PASSWORD_HASH_SALT_LENGTH') or 16)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 8)
+    PASSWORD_HASH_TIMEOUT = int(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)  # seconds
+    PASSWORD_HASH_RETRY_AFTER = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER') or 1)  # seconds
+
     # Security headers
     SECURE_HEADERS = {
         'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
@@ -21,9 +88,52 @@ class Config:
         'Content-Security-Policy': "default-src 'self'; script-src 'self' 'unsafe-inline' 'unsafe-eval'; style-src 'self' 'unsafe-inline';"
     }
 
-    # Rate limiting
+    # Rate limiting: sliding-window counters shared by all workers on the
+    # host through a local SQLite file (see ratelimit.SQLiteStorage)
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'true').lower() != 'false'
     RATELIMIT_DEFAULT = "200 per day;50 per hour;1 per second"
-    RATELIMIT_STORAGE_URL = os.environ.get('REDIS_URL') or "memory://"
+    RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY') or 'sliding-window-counter'
+    RATELIMIT_STORAGE_URI = (os.environ.get('RATELIMIT_STORAGE_URI') or os.environ.get('REDIS_URL')
+                             or 'sqlite:///data_vault_ratelimit.db')
+
+    # Responses: compression negotiated via Accept-Encoding (zstd needs the
+    # zstandard package) and the JSON encoder ('auto' prefers orjson)
+    COMPRESS_ENCODINGS = [e.strip() for e in (os.environ.get('COMPRESS_ENCODINGS') or 'zstd,gzip').split(',') if e.strip()]
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)  # bytes
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL') or 6)
+    COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL') or 3)
+    JSON_ENCODER = os.environ.get('JSON_ENCODER') or 'auto'
+
+    # Credential listings
+    CREDENTIALS_PAGE_MAX_LIMIT = int(os.environ.get('CREDENTIALS_PAGE_MAX_LIMIT') or 1000)
+    CREDENTIALS_YIELD_PER = int(os.environ.get('CREDENTIALS_YIELD_PER') or 500)
+    SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT') or 100)  # results per ?q= search
+
+    # Batch writes; the rate limit is charged once per operation
+    CREDENTIALS_BATCH_MAX_ITEMS = int(os.environ.get('CREDENTIALS_BATCH_MAX_ITEMS') or 500)
+    CREDENTIALS_BATCH_RATE_LIMIT = os.environ.get('CREDENTIALS_BATCH_RATE_LIMIT') or "1000 per hour"
+
+    # Synchronization
+    SYNC_BATCH_MAX_ITEMS = int(os.environ.get('SYNC_BATCH_MAX_ITEMS') or 500)
+    SYNC_MAX_BODY_BYTES = int(os.environ.get('SYNC_MAX_BODY_BYTES') or 16 * 1024 * 1024)
+    # How long the result of a sync batch sent with an Idempotency-Key is kept
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL') or 24 * 3600)  # seconds
+    SYNC_FEED_MAX_LIMIT = int(os.environ.get('SYNC_FEED_MAX_LIMIT') or 1000)
+    RECONCILE_MAX_PREFIXES = int(os.environ.get('RECONCILE_MAX_PREFIXES') or 256)
+
+    # Change notifications (GET /api/watch), fanned out to every worker on
+    # the host through a local SQLite file (see watch.ChangeNotifier)
+    WATCH_BUS_PATH = os.environ.get('WATCH_BUS_PATH') or 'data_vault_watch.db'
+    WATCH_POLL_INTERVAL = float(os.environ.get('WATCH_POLL_INTERVAL') or 0.1)  # seconds
+    WATCH_TIMEOUT = int(os.environ.get('WATCH_TIMEOUT') or 30)  # seconds a long-poll is held at most
+    WATCH_HEARTBEAT = int(os.environ.get('WATCH_HEARTBEAT') or 15)  # seconds between SSE keep-alive comments
+    WATCH_STREAM_MAX_AGE = int(os.environ.get('WATCH_STREAM_MAX_AGE') or 300)  # seconds before an SSE stream is closed
+    # A waiting watch request holds a gunicorn thread, so only a few may wait
+    # per worker; the ASGI server parks them on the loop and allows many more
+    WATCH_MAX_WAITERS = int(os.environ.get('WATCH_MAX_WAITERS') or 4)
+    ASGI_WATCH_MAX_WAITERS = int(os.environ.get('ASGI_WATCH_MAX_WAITERS') or 10000)
+    WATCH_RETRY_AFTER = int(os.environ.get('WATCH_RETRY_AFTER') or 30)  # seconds
+    WATCH_RATE_LIMIT = os.environ.get('WATCH_RATE_LIMIT') or "600 per hour"
 
     # Logging
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
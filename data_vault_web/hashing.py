@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+from shared.concurrency import wait
+import threading
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    # Runs the deliberately slow password hash functions in a small process
+    # pool so a login storm cannot occupy every request thread. Once
+    # max_pending hashes are queued or running, further callers are turned
+    # away immediately with HasherBusy instead of waiting.
+
+    def __init__(self):
+        self.method = 'pbkdf2:sha256:260000'
+        self.salt_length = 16
+        self.workers = 2
+        self.max_pending = 8
+        self.timeout = 10
+        self.retry_after = 1
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.salt_length = app.config['PASSWORD_HASH_SALT_LENGTH']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.max_pending = app.config['PASSWORD_HASH_MAX_PENDING']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.retry_after = app.config['PASSWORD_HASH_RETRY_AFTER']
+        app.password_hasher = self
+
+    def _get_pool(self):
+        # Created on first use so every gunicorn worker forks its own pool
+        # after the master has forked it.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def _discard_pool(self, pool):
+        # A worker process died (BrokenProcessPool) or the pool was shut
+        # down: the next call starts a new one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy()
+            pool = self._get_pool()
+            try:
+                future = pool.submit(fn, *args)
+            except (BrokenProcessPool, RuntimeError):
+                failed = True
+            else:
+                failed = False
+                self.pending += 1
+        if failed:
+            self._discard_pool(pool)
+            raise HasherBusy()
+        future.add_done_callback(self._release)
+        try:
+            return wait(future, self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise HasherBusy()
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'method': self.method,
+                'salt_length': self.salt_length,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from flask import current_app, g, jsonify
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from shared.models import User, UserNotFound
+from watch import change_notifier
+import threading
+import time
+
+class IdentityCache:
+    # Process-wide LRU of JWT identity (User.public_id) -> internal User.id
+    # for active users, so routes don't need a User query on every request.
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config['IDENTITY_CACHE_SIZE']
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        change_notifier.observe_identities(self.invalidate_many)
+        app.identity_cache = self
+
+    def get(self, public_id):
+        with self._lock:
+            entry = self._entries.get(public_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(public_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[public_id]
+            self.misses += 1
+            return None
+
+    def put(self, public_id, user_id):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[public_id] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(public_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, public_id):
+        with self._lock:
+            if self._entries.pop(public_id, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_many(self, public_ids):
+        for public_id in public_ids:
+            self.invalidate(public_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+identity_cache = IdentityCache()
+
+def resolve_user_id():
+    # Returns the internal id of the active user behind the current JWT, or
+    # None if that user no longer exists or has been deactivated. With
+    # sharding, also routes current_app.db_session to the user's shard, and
+    # in read-only views to a read replica that has the user's writes.
+    public_id = get_jwt_identity()
+    router = current_app.shard_router
+    # Listens for accounts changed by the other workers on the host
+    change_notifier.start()
+    user_id = identity_cache.get(public_id)
+    if user_id is not None:
+        if router is not None and not router.route(current_app.db_session, user_id):
+            return None
+        return _route_reads(user_id)
+
+    if router is not None:
+        user_id = router.find(public_id=public_id)
+        if user_id is None or not router.route(current_app.db_session, user_id):
+            return None
+    query = current_app.db_session.query(User.id, User.is_active)
+    claimed_id = get_jwt().get('uid')
+    if claimed_id is not None:
+        # The signed claim saves the public_id index lookup; the primary key
+        # lookup is still needed for the is_active check.
+        row = query.filter(User.id == claimed_id, User.public_id == public_id).first()
+    else:
+        row = query.filter(User.public_id == public_id).first()
+    if row is None or not row.is_active:
+        return None
+    identity_cache.put(public_id, row.id)
+    return _route_reads(row.id)
+
+def _route_reads(user_id):
+    if g.get('replica_reads'):
+        current_app.replica_router.route(current_app.db_session, user_id)
+    return user_id
+
+def user_moving(e):
+    # UserMoving while the user's rows are copied to another shard;
+    # UserNotFound when a write reached the old shard after the move
+    router = current_app.shard_router
+    if isinstance(e, UserNotFound):
+        if router is None:
+            return jsonify({"msg": "User not found"}), 404
+        router.forget(e.user_id)
+    response = jsonify({"msg": "Your vault is being moved, please retry shortly"})
+    response.headers['Retry-After'] = str(current_app.config['SHARD_MOVE_RETRY_AFTER'])
+    return response, 503
+
+@event.listens_for(Session, 'after_flush')
+def _collect_identity_changes(session, flush_context):
+    changed = session.info.setdefault('identity_invalidations', set())
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.public_id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj, include_collections=False):
+            changed.add(obj.public_id)
+
+@event.listens_for(Session, 'after_commit')
+def _apply_identity_invalidations(session):
+    # Reaches this worker at once and the others on the host through the
+    # change bus. Other hosts, and changes made to the database directly,
+    # are only seen once the cached entries expire (IDENTITY_CACHE_TTL).
+    changed = session.info.pop('identity_invalidations', None)
+    if changed:
+        change_notifier.publish_identities(changed)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_identity_changes(session):
+    session.info.pop('identity_invalidations', None)
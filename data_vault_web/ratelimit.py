@@ -0,0 +1,186 @@
+from flask import request
+from flask_jwt_extended import decode_token
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from limits.storage import Storage, SlidingWindowCounterSupport
+from shared.concurrency import call_blocking
+import contextlib
+import functools
+import math
+import os
+import sqlite3
+import threading
+import time
+
+def _off_loop(method):
+    # A hit waits up to busy_timeout for the write lock; under the ASGI
+    # server that must not hold up the event loop
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return call_blocking(method, self, *args, **kwargs)
+    return wrapper
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport):
+    # Rate limit counters in a local SQLite WAL database, shared by every
+    # worker process on the host without a network hop. Selected with
+    # RATELIMIT_STORAGE_URI = 'sqlite:///path/to/file.db'.
+    #
+    # Counters are disposable, so the file runs with synchronous=OFF. Each
+    # sliding-window hit reads both windows and bumps the current one
+    # inside a single BEGIN IMMEDIATE transaction, so concurrent workers
+    # cannot both take the last slot.
+
+    STORAGE_SCHEME = ['sqlite']
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, uri=None, wrap_exceptions=False, busy_timeout=5000, **options):
+        path = uri.split('://', 1)[1]
+        self.path = path[1:] if path.startswith('/') else path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_limits '
+                         '(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID')
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _get(self, conn, key, now):
+        row = conn.execute('SELECT count, expires_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] <= now:
+            return 0, now
+        return row
+
+    def _incr(self, conn, key, expiry, amount, now):
+        # A counter past its expiry starts over from amount
+        conn.execute('INSERT INTO rate_limits (key, count, expires_at) VALUES (?, ?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET '
+                     'count = CASE WHEN expires_at <= ?4 THEN ?2 ELSE count + ?2 END, '
+                     'expires_at = CASE WHEN expires_at <= ?4 THEN ?3 ELSE expires_at END',
+                     (key, amount, now + expiry, now))
+        self._maybe_sweep(conn, now)
+        return self._get(conn, key, now)[0]
+
+    def _maybe_sweep(self, conn, now):
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.SWEEP_INTERVAL
+            conn.execute('DELETE FROM rate_limits WHERE expires_at <= ?', (now,))
+
+    @_off_loop
+    def incr(self, key, expiry, amount=1):
+        with self._transaction() as conn:
+            return self._incr(conn, key, expiry, amount, time.time())
+
+    @_off_loop
+    def get(self, key):
+        return self._get(self._connection(), key, time.time())[0]
+
+    @_off_loop
+    def get_expiry(self, key):
+        return self._get(self._connection(), key, time.time())[1]
+
+    @_off_loop
+    def check(self):
+        try:
+            self._connection().execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    @_off_loop
+    def reset(self):
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM rate_limits').rowcount
+
+    @_off_loop
+    def clear(self, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM rate_limits WHERE key = ?', (key,))
+
+    @staticmethod
+    def _window_keys(key, expiry, now):
+        return f"{key}/{int((now - expiry) / expiry)}", f"{key}/{int(now / expiry)}"
+
+    def _window(self, conn, key, expiry, now):
+        previous_key, current_key = self._window_keys(key, expiry, now)
+        previous_count = self._get(conn, previous_key, now)[0]
+        current_count = self._get(conn, current_key, now)[0]
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry if previous_count else 0.0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    @_off_loop
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as conn:
+            previous_count, previous_ttl, current_count, _ = self._window(conn, key, expiry, now)
+            if math.floor(previous_count * previous_ttl / expiry + current_count) + amount > limit:
+                return False
+            # The current window's counter has to outlive the next window
+            # too, where it is weighed as the previous one.
+            self._incr(conn, self._window_keys(key, expiry, now)[1], 2 * expiry, amount, now)
+            return True
+
+    @_off_loop
+    def get_sliding_window(self, key, expiry):
+        return self._window(self._connection(), key, expiry, time.time())
+
+    @_off_loop
+    def clear_sliding_window(self, key, expiry):
+        with self._transaction() as conn:
+            for window_key in self._window_keys(key, expiry, time.time()):
+                conn.execute('DELETE FROM rate_limits WHERE key = ?', (window_key,))
+
+@functools.lru_cache(maxsize=4096)
+def _token_identity(token):
+    # Signature checks dominate the key function's cost, so each distinct
+    # token is verified once per process. Keyed on the exact token string,
+    # a forged token can never borrow another user's entry.
+    claims = decode_token(token)
+    return claims['sub'], claims['exp']
+
+def rate_limit_key():
+    # Authenticated requests are limited per user, so users behind one NAT
+    # don't share a budget; everything else is limited per client IP.
+    # Default limits run before @jwt_required has verified the token, so
+    # the bearer token is checked here too.
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme == 'Bearer' and token:
+        try:
+            identity, expires = _token_identity(token)
+            if expires > time.time():
+                return f"user:{identity}"
+        except Exception:
+            pass
+    return f"ip:{get_remote_address()}"
+
+# The one limiter for the whole app; blueprints decorate routes with it and
+# create_app() initializes it.
+limiter = Limiter(key_func=rate_limit_key)
@@ -0,0 +1,272 @@
+from collections import OrderedDict
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from shared.database import create_db_engine
+from shared.models import ReplicaHeartbeat, User
+from watch import change_notifier
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ReplicaSession(Session):
+    # Sends every statement to the read replica the session was routed to,
+    # if any (see ReplicaRouter.route)
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get('replica')
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause, **kwargs)
+
+class Replica:
+    def __init__(self, engine):
+        self.name = engine.url.render_as_string(hide_password=True)
+        # engine serves the requests' reads (the ASGI server swaps in its
+        # async one); probe is only used by the health checks
+        self.engine = engine
+        self.probe = engine
+        self.healthy = False
+        self.lag = None
+        self.failures = 0
+        self.reads = 0
+
+class ReplicaRouter:
+    # Serves the read-only views (@replica_reads) from read replicas of the
+    # primary database, and everything else from the primary.
+    #
+    # Read-your-writes: every commit that changes a vault publishes the
+    # user's new change_seq (watch.ChangeNotifier), and this worker learns
+    # of those made by any worker on the host. Until a replica has caught up
+    # to that change_seq, which one primary key read there tells, the
+    # user's reads stay on the primary. Markers are dropped a little after
+    # max_lag, as no replica trailing further is in use.
+    #
+    # Those markers only cover the host. Across hosts the client carries
+    # its own: write responses return the user's new change_seq in
+    # X-Vault-Seq, and a read sent with X-Min-Vault-Seq stays on the
+    # primary until the chosen replica has at least that change_seq.
+    #
+    # Health: a thread per worker stamps a heartbeat row on the primary and
+    # reads it back from every replica each health_interval seconds. A
+    # replica that cannot be read or trails by more than max_lag seconds
+    # takes no reads until it is back; with none left, reads go to the
+    # primary. A read that fails on a replica is retried on the primary.
+
+    def __init__(self, health_interval=1.0, max_lag=10.0, maxsize=10000):
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.maxsize = maxsize
+        self.replicas = []
+        self.primary = None
+        self.replica_reads = 0
+        self.pinned_reads = 0
+        self.failover_reads = 0
+        self._markers = OrderedDict()
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def init_app(self, app, engine_options):
+        self.health_interval = app.config['REPLICA_HEALTH_INTERVAL']
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.maxsize = app.config['IDENTITY_CACHE_SIZE']
+        self.primary = app.db_engine
+        urls = app.config['REPLICA_DATABASE_URLS']
+        if urls and app.shard_router is not None:
+            app.logger.warning('REPLICA_DATABASE_URLS is ignored with SHARD_DATABASE_URLS')
+            urls = []
+        # The replicas' schema comes from the primary, so it is not created
+        self.replicas = [Replica(create_db_engine(url, **engine_options)) for url in urls]
+        if self.replicas:
+            change_notifier.observe(self.record)
+            app.after_request(self.stamp)
+        app.replica_router = self
+
+    def record(self, changes):
+        # changes maps user id -> the user's change_seq after a commit. A
+        # replica's lag is measured up to a health_interval late, off a
+        # heartbeat up to half of one old.
+        if has_request_context():
+            # This worker's own commit, returned to the client by stamp()
+            g.vault_seqs = {**g.get('vault_seqs', {}), **changes}
+        expires = time.monotonic() + self.max_lag + 2 * self.health_interval
+        with self._lock:
+            for user_id, seq in changes.items():
+                marker = self._markers.get(user_id)
+                if marker is None or seq > marker[0]:
+                    # The replicas known to have the user's writes so far
+                    self._markers[user_id] = (seq, expires, set())
+                else:
+                    self._markers[user_id] = (marker[0], expires, marker[2])
+                self._markers.move_to_end(user_id)
+            while len(self._markers) > self.maxsize:
+                self._markers.popitem(last=False)
+
+    def pin(self, user_id, seq=0):
+        # Keeps the user's reads on the primary until the replicas have
+        # their change_seq seq, e.g. after creating the user
+        if self.replicas:
+            change_notifier.publish({user_id: seq})
+
+    def stamp(self, response):
+        seqs = g.pop('vault_seqs', None)
+        if seqs:
+            response.headers['X-Vault-Seq'] = str(max(seqs.values()))
+        return response
+
+    def _marker(self, user_id):
+        with self._lock:
+            marker = self._markers.get(user_id)
+            if marker is not None and marker[1] <= time.monotonic():
+                del self._markers[user_id]
+                return None
+            return marker
+
+    def _start_checker(self):
+        with self._lock:
+            if self._checker is None or self._checker[1] != os.getpid():
+                thread = threading.Thread(target=self._check_forever, name='data-vault-replicas', daemon=True)
+                self._checker = (thread, os.getpid())
+                thread.start()
+        change_notifier.start()
+
+    def route(self, session, user_id):
+        # Sends the session's statements to a healthy replica that has the
+        # user's latest writes; leaves it on the primary if there is none
+        if not self.replicas:
+            return False
+        if self._checker is None or self._checker[1] != os.getpid():
+            self._start_checker()
+        healthy = [index for index, replica in enumerate(self.replicas) if replica.healthy]
+        if not healthy:
+            self.failover_reads += 1
+            return False
+        index = healthy[next(self._next) % len(healthy)]
+        replica = self.replicas[index]
+        marker = self._marker(user_id)
+        client_seq = request.headers.get('X-Min-Vault-Seq', type=int)
+        check = marker is not None and index not in marker[2]
+        if client_seq is not None and (marker is None or client_seq > marker[0]):
+            check = True
+        # Hands back the primary connection the identity lookup may hold
+        session.close()
+        session.info['replica'] = replica.engine
+        if check:
+            required = max(marker[0] if marker is not None else 0, client_seq or 0)
+            seq = session.query(User.change_seq).filter_by(id=user_id).scalar()
+            if seq is None or seq < required:
+                session.info.pop('replica')
+                session.close()
+                self.pinned_reads += 1
+                return False
+            if marker is not None:
+                with self._lock:
+                    marker[2].add(index)
+        replica.reads += 1
+        self.replica_reads += 1
+        return True
+
+    def mark_down(self, engine):
+        for replica in self.replicas:
+            if replica.engine is engine and replica.healthy:
+                replica.healthy = False
+                replica.failures += 1
+                logger.warning('Read replica %s failed; reading from the primary until it recovers', replica.name)
+
+    def _beat(self):
+        # One stamp per health_interval, whichever worker gets there first
+        now = time.time()
+        table = ReplicaHeartbeat.__table__
+        try:
+            with self.primary.begin() as conn:
+                updated = conn.execute(update(table).where(table.c.id == 1,
+                                                           table.c.beat_at <= now - self.health_interval / 2)
+                                       .values(beat_at=now)).rowcount
+                if not updated and conn.execute(select(table.c.id).where(table.c.id == 1)).first() is None:
+                    conn.execute(table.insert().values(id=1, beat_at=now))
+        except IntegrityError:
+            # Another worker wrote the first one
+            pass
+
+    def check(self):
+        try:
+            self._beat()
+        except SQLAlchemyError:
+            logger.exception('Could not write the replica heartbeat')
+        now = time.time()
+        for replica in self.replicas:
+            try:
+                with replica.probe.connect() as conn:
+                    beat = conn.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1)).scalar()
+            except SQLAlchemyError as e:
+                if replica.healthy:
+                    logger.warning('Read replica %s is unreachable: %s', replica.name, e)
+                replica.healthy, replica.lag = False, None
+                replica.failures += 1
+                continue
+            replica.lag = now - beat if beat is not None else None
+            healthy = replica.lag is not None and replica.lag <= self.max_lag
+            if healthy != replica.healthy:
+                if healthy:
+                    logger.info('Read replica %s is in use, %.1fs behind', replica.name, replica.lag)
+                else:
+                    logger.warning('Read replica %s is %s behind; reading from the primary', replica.name,
+                                   f'{replica.lag:.1f}s' if replica.lag is not None else 'too far')
+            replica.healthy = healthy
+
+    def _check_forever(self):
+        while True:
+            self.check()
+            time.sleep(self.health_interval)
+
+    def stats(self):
+        with self._lock:
+            markers = len(self._markers)
+        return {
+            'replicas': [{
+                'url': replica.name,
+                'healthy': replica.healthy,
+                'lag': replica.lag,
+                'failures': replica.failures,
+                'reads': replica.reads,
+            } for replica in self.replicas],
+            'max_lag': self.max_lag,
+            'pinned_users': markers,
+            'replica_reads': self.replica_reads,
+            'pinned_reads': self.pinned_reads,
+            'failover_reads': self.failover_reads,
+        }
+
+replica_router = ReplicaRouter()
+
+def replica_reads(view):
+    # Lets resolve_user_id() route the view's session to a read replica.
+    # Only for views that never write. If the replica fails while the view
+    # runs, it is marked down and the view runs again on the primary.
+    # Streamed bodies (stream_json) read the replica after the view has
+    # returned and the status line is out, so a failure there cannot fail
+    # over: the replica is marked down by the next health check, and the
+    # client sees a cut-off response and retries.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.replica_reads = True
+        try:
+            return view(*args, **kwargs)
+        except DBAPIError:
+            session = current_app.db_session
+            replica = session.info.pop('replica', None)
+            if replica is None:
+                raise
+            current_app.replica_router.mark_down(replica)
+            session.rollback()
+            g.replica_reads = False
+            return view(*args, **kwargs)
+        finally:
+            g.replica_reads = False
+    return wrapper
@@ -0,0 +1,119 @@
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from shared.models import RevokedToken
+import threading
+import time
+
+def _epoch(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+class RevocationStore:
+    # Revoked JWT ids live in the revoked_tokens table, shared by every
+    # worker. Each worker mirrors the unexpired ones in a dict of jti ->
+    # exp, so the check on every authenticated request is a single hash
+    # lookup. The mirror picks up new rows by id every refresh_interval
+    # seconds, and expired entries are swept from both the dict and the
+    # table every sweep_interval seconds.
+    #
+    # The lock only guards the dict and the refresh bookkeeping and is never
+    # held across a query: under the ASGI server requests are greenlets on
+    # one thread, and one blocking on a lock held by a greenlet parked on
+    # database I/O would stall the event loop.
+
+    def __init__(self, refresh_interval=1.0, sweep_interval=300, lookback=100):
+        self.refresh_interval = refresh_interval
+        self.sweep_interval = sweep_interval
+        self.lookback = lookback
+        self.refreshes = 0
+        self.sweeps = 0
+        self._revoked = {}
+        self._last_id = 0
+        self._next_refresh = 0.0
+        self._next_sweep = 0.0
+        self._refreshing = False
+        self._session_factory = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, session_factory):
+        self.refresh_interval = app.config['REVOCATION_REFRESH_INTERVAL']
+        self.sweep_interval = app.config['REVOCATION_SWEEP_INTERVAL']
+        self.lookback = app.config['REVOCATION_REFRESH_LOOKBACK']
+        self._session_factory = session_factory
+        app.revocation_store = self
+
+    def is_revoked(self, jti):
+        if time.monotonic() >= self._next_refresh:
+            self.refresh()
+        return jti in self._revoked
+
+    def revoke(self, session, jti, expires):
+        # expires is the token's exp claim (seconds since the epoch)
+        session.add(RevokedToken(jti=jti, expires_at=datetime.fromtimestamp(expires, timezone.utc)))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Revoked concurrently by another request
+            session.rollback()
+        with self._lock:
+            self._revoked[jti] = expires
+
+    def refresh(self, force=False):
+        # Only one thread refreshes at a time; the others keep answering
+        # from the current mirror instead of queueing behind the query.
+        with self._lock:
+            now = time.monotonic()
+            if not force and (self._refreshing or now < self._next_refresh):
+                return
+            self._refreshing = True
+            self._next_refresh = now + self.refresh_interval
+            sweep = now >= self._next_sweep
+            if sweep:
+                self._next_sweep = now + self.sweep_interval
+        try:
+            self._load_new()
+            if sweep:
+                self._sweep()
+        except SQLAlchemyError:
+            current_app.logger.exception('Could not refresh the token blocklist')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load_new(self):
+        # Ids can commit out of order on databases with concurrent writers,
+        # so re-read a few rows behind the newest one already seen.
+        with self._session_factory() as session:
+            rows = (session.query(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at)
+                    .filter(RevokedToken.id > self._last_id - self.lookback)
+                    .order_by(RevokedToken.id)
+                    .all())
+        with self._lock:
+            for row in rows:
+                self._revoked[row.jti] = _epoch(row.expires_at)
+                self._last_id = max(self._last_id, row.id)
+            self.refreshes += 1
+
+    def _sweep(self):
+        now = time.time()
+        with self._lock:
+            self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        with self._session_factory() as session:
+            session.query(RevokedToken).filter(
+                RevokedToken.expires_at < datetime.fromtimestamp(now, timezone.utc)
+            ).delete(synchronize_session=False)
+            session.commit()
+        self.sweeps += 1
+
+    def stats(self):
+        return {
+            'size': len(self._revoked),
+            'last_id': self._last_id,
+            'refreshes': self.refreshes,
+            'sweeps': self.sweeps,
+            'refresh_interval': self.refresh_interval,
+        }
+
+revocation_store = RevocationStore()
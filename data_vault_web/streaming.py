@@ -0,0 +1,66 @@
+from flask import Response, stream_with_context
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Rows are serialized one at a time but written in chunks of roughly this
+# size, so a large listing neither builds up in memory nor turns into one
+# socket write per row.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def _stdlib_dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=str)
+
+def _orjson_dumps(value):
+    # Datetimes go through default=str like with the stdlib encoder, so the
+    # output does not depend on which encoder is installed.
+    return orjson.dumps(value, default=str,
+                        option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode()
+
+JSON_ENCODERS = {'json': _stdlib_dumps}
+if orjson is not None:
+    JSON_ENCODERS['orjson'] = _orjson_dumps
+
+_dumps = _stdlib_dumps
+
+def init_json_encoder(app):
+    # JSON_ENCODER is 'auto' (the fastest installed), 'orjson' or 'json'; a
+    # requested encoder that is not installed falls back to the stdlib one.
+    global _dumps
+    name = app.config['JSON_ENCODER']
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in JSON_ENCODERS else 'json'
+    if name not in JSON_ENCODERS:
+        app.logger.warning('JSON encoder %s is not available, using json', name)
+        name = 'json'
+    _dumps = JSON_ENCODERS[name]
+    app.json_encoder_name = name
+
+def json_response(payload, status=200):
+    # jsonify() for large payloads, built with the configured encoder
+    return Response(_dumps(payload), status=status, mimetype='application/json')
+
+def stream_json(items, key=None, trailer=None, status=200):
+    # Streams items as a JSON array, or as {key: [...], **trailer()} when a
+    # key is given; trailer is called after the last item has been written.
+    def generate():
+        buffer = ['{%s:[' % _dumps(key) if key else '[']
+        size = 0
+        for index, item in enumerate(items):
+            part = (',' if index else '') + _dumps(item)
+            buffer.append(part)
+            size += len(part)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        buffer.append(']')
+        if key:
+            for name, value in (trailer() if trailer else {}).items():
+                buffer.append(f',{_dumps(name)}:{_dumps(value)}')
+            buffer.append('}')
+        yield ''.join(buffer)
+
+    return Response(stream_with_context(generate()), status=status, mimetype='application/json')
@@ -0,0 +1,236 @@
+from concurrent.futures import Future, TimeoutError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from shared.concurrency import call_blocking, wait
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class WatchBusy(Exception):
+    pass
+
+class ChangeNotifier:
+    # Wakes watch requests (GET /api/watch) when their user's vault changes.
+    # Every commit that allocated change sequence numbers is published to a
+    # small SQLite file shared by all workers on the host, one upserted row
+    # per user stamped with a global version. Each worker runs a single
+    # listener thread that reads the file's PRAGMA data_version every
+    # poll_interval seconds, which costs next to nothing while nothing
+    # changes. After a commit by any worker it reads the rows past its last
+    # version and resolves the futures of the local waiters of those users.
+    # A gunicorn thread blocks on its future; under the ASGI server only the
+    # request's greenlet is parked (shared.concurrency.wait).
+    #
+    # Publishing is best effort: a lost notification delays a watcher until
+    # its wait times out, it is never wrong.
+    #
+    # Observers (see observe()) get the same feed of (user id -> change_seq):
+    # this worker's commits at once, other workers' through the listener.
+    # Changed user accounts are passed around the same way, by public id
+    # (publish_identities()), so every worker drops them from its cache.
+
+    def __init__(self, path='data_vault_watch.db', poll_interval=0.1, max_waiters=4, retry_after=30):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self.retry_after = retry_after
+        self.published = 0
+        self.wakeups = 0
+        self.rejected = 0
+        self._waiters = {}
+        self._waiting = 0
+        self._version = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._listener = None
+        self._observers = []
+        self._identity_observers = []
+        self._identity_version = 0
+
+    def init_app(self, app):
+        self.path = app.config['WATCH_BUS_PATH']
+        self.poll_interval = app.config['WATCH_POLL_INTERVAL']
+        self.max_waiters = app.config['WATCH_MAX_WAITERS']
+        self.retry_after = app.config['WATCH_RETRY_AFTER']
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS vault_changes '
+                         '(user_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL, version INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_vault_changes_version ON vault_changes (version)')
+            conn.execute('CREATE TABLE IF NOT EXISTS identity_changes '
+                         '(public_id TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_identity_changes_version ON identity_changes (version)')
+        app.change_notifier = self
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA busy_timeout=1000')
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def observe(self, callback):
+        # callback(changes) is called with every published {user id: seq}
+        self._observers.append(callback)
+
+    def observe_identities(self, callback):
+        # callback(public_ids) is called with every published set of changed
+        # user accounts
+        self._identity_observers.append(callback)
+
+    def start(self):
+        # Starts this process's listener thread, if not running yet
+        if self._listener is None or self._listener[1] != os.getpid():
+            with self._lock:
+                self._start_listener()
+
+    def _start_listener(self):
+        if self._listener is None or self._listener[1] != os.getpid():
+            thread = threading.Thread(target=self._listen, name='data-vault-watch', daemon=True)
+            self._listener = (thread, os.getpid())
+            thread.start()
+
+    def publish(self, changes):
+        # changes maps user id -> the user's change_seq after the commit
+        for callback in self._observers:
+            callback(changes)
+        # Waits up to busy_timeout for the bus's write lock, so never on
+        # the ASGI server's event loop
+        try:
+            call_blocking(self._write_changes, changes)
+        except sqlite3.Error:
+            logger.exception('Could not publish vault changes')
+            return
+        self.published += len(changes)
+
+    def _write_changes(self, changes):
+        with self._transaction() as conn:
+            version = conn.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM vault_changes').fetchone()[0]
+            conn.executemany('INSERT INTO vault_changes (user_id, seq, version) VALUES (?, ?, ?) '
+                             'ON CONFLICT(user_id) DO UPDATE SET '
+                             'seq = MAX(seq, excluded.seq), version = excluded.version',
+                             [(user_id, seq, version) for user_id, seq in changes.items()])
+
+    def publish_identities(self, public_ids):
+        for callback in self._identity_observers:
+            callback(public_ids)
+        try:
+            call_blocking(self._write_identities, public_ids)
+        except sqlite3.Error:
+            logger.exception('Could not publish user account changes')
+
+    def _write_identities(self, public_ids):
+        with self._transaction() as conn:
+            version = conn.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM identity_changes').fetchone()[0]
+            conn.executemany('INSERT INTO identity_changes (public_id, version) VALUES (?, ?) '
+                             'ON CONFLICT(public_id) DO UPDATE SET version = excluded.version',
+                             [(public_id, version) for public_id in public_ids])
+
+    def subscribe(self, user_id):
+        # Returns a future that gets the user's new change_seq on their next
+        # published change. Subscribe before reading the current change_seq,
+        # so a change committed in between is not missed.
+        with self._lock:
+            if self._waiting >= self.max_waiters:
+                self.rejected += 1
+                raise WatchBusy()
+            self._start_listener()
+            future = Future()
+            self._waiters.setdefault(user_id, set()).add(future)
+            self._waiting += 1
+        return future
+
+    def unsubscribe(self, user_id, future):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters is not None and future in waiters:
+                waiters.discard(future)
+                self._waiting -= 1
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def wait(self, future, timeout):
+        # The new change_seq, or None if the timeout ran out first
+        try:
+            return wait(future, timeout)
+        except TimeoutError:
+            return None
+
+    def _listen(self):
+        conn = self._connect()
+        self._version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM vault_changes').fetchone()[0]
+        self._identity_version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM identity_changes').fetchone()[0]
+        data_version = None
+        while True:
+            try:
+                current = conn.execute('PRAGMA data_version').fetchone()[0]
+                if current != data_version:
+                    data_version = current
+                    rows = conn.execute('SELECT user_id, seq, version FROM vault_changes WHERE version > ?',
+                                        (self._version,)).fetchall()
+                    for user_id, seq, version in rows:
+                        self._version = max(self._version, version)
+                        self._wake(user_id, seq)
+                    if rows:
+                        changes = {user_id: seq for user_id, seq, _ in rows}
+                        for callback in self._observers:
+                            callback(changes)
+                    rows = conn.execute('SELECT public_id, version FROM identity_changes WHERE version > ?',
+                                        (self._identity_version,)).fetchall()
+                    if rows:
+                        self._identity_version = max(version for _, version in rows)
+                        for callback in self._identity_observers:
+                            callback({public_id for public_id, _ in rows})
+            except sqlite3.Error:
+                logger.exception('Could not read vault changes')
+            time.sleep(self.poll_interval)
+
+    def _wake(self, user_id, seq):
+        with self._lock:
+            waiters = self._waiters.pop(user_id, ())
+            self._waiting -= len(waiters)
+            self.wakeups += len(waiters)
+        for future in waiters:
+            future.set_result(seq)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'waiting': self._waiting,
+                'max_waiters': self.max_waiters,
+                'published': self.published,
+                'wakeups': self.wakeups,
+                'rejected': self.rejected,
+                'poll_interval': self.poll_interval,
+            }
+
+change_notifier = ChangeNotifier()
+
+@event.listens_for(Session, 'after_commit')
+def _publish_vault_changes(session):
+    changes = session.info.pop('vault_changes', None)
+    if changes:
+        change_notifier.publish(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_vault_changes(session):
+    session.info.pop('vault_changes', None)
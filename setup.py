@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='data_vault',
     version='0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     install_requires=[
         'click',
@@ -15,6 +15,11 @@ setup(
         'cryptography',
         'python-dotenv',
     ],
+    extras_require={
+        'speedups': ['orjson', 'zstandard'],
+        'asgi': ['uvicorn', 'aiosqlite'],
+        'test': ['pytest'],
+    },
     entry_points='''
         [console_scripts]
         data-vault-cli=data_vault_cli.cli:cli
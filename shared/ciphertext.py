@@ -0,0 +1,86 @@
+# shared/ciphertext.py
+#
+# Storage format of encrypted credential data. Version 1 keeps the Fernet
+# token as raw bytes behind a 10-byte header instead of the token's base64
+# text, which is a third larger:
+#
+#   version (1 byte, 0x01) | codec (1 byte) | key id (8 bytes) | raw token
+#
+# The key id names the key that made the token (ANY_KEY if unknown), so
+# readers go straight to the right key, and the codec says whether the
+# plaintext was compressed before encryption. Legacy values are the token
+# text itself; a Fernet token always starts with 0x80, base64 "g", so the
+# two formats cannot be confused and readers accept both.
+#
+# Sync payloads, exports and Merkle digests use the text form (to_text):
+# the plain token for uncompressed data, exactly as before this format
+# existed, so converting a row does not change its digest and older
+# clients can still read it. Only compressed data is sent as the base64 of
+# the whole value.
+
+import base64
+import binascii
+import struct
+
+FORMAT_V1 = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+ANY_KEY = bytes(8)
+
+_HEADER = struct.Struct('>BB8s')
+
+def _as_bytes(value) -> bytes:
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+def is_legacy(value) -> bool:
+    value = _as_bytes(value)
+    return not value or value[0] != FORMAT_V1
+
+def pack(token, key_id: bytes = ANY_KEY, codec: int = CODEC_NONE) -> bytes:
+    return _HEADER.pack(FORMAT_V1, codec, key_id) + base64.urlsafe_b64decode(_as_bytes(token))
+
+def unpack(value):
+    # Returns (Fernet token, key id or None, codec) for either format
+    value = _as_bytes(value)
+    if is_legacy(value):
+        return value, None, CODEC_NONE
+    _, codec, key_id = _HEADER.unpack_from(value)
+    return base64.urlsafe_b64encode(value[_HEADER.size:]), None if key_id == ANY_KEY else key_id, codec
+
+def upgrade(value) -> bytes:
+    # Legacy token text -> version 1, without needing the key
+    value = _as_bytes(value)
+    return pack(value) if is_legacy(value) and _is_token(value) else value
+
+def _is_token(value: bytes) -> bool:
+    # Only tokens that survive a decode/encode round trip are converted,
+    # so the text form, and with it the digest, stays byte for byte equal.
+    try:
+        return value[:1] == b'g' and base64.urlsafe_b64encode(base64.urlsafe_b64decode(value)) == value
+    except (ValueError, binascii.Error):
+        return False
+
+def to_text(value) -> str:
+    value = _as_bytes(value)
+    if is_legacy(value):
+        return value.decode()
+    token, _, codec = unpack(value)
+    if codec == CODEC_NONE:
+        return token.decode()
+    return base64.urlsafe_b64encode(value).decode()
+
+def from_text(text) -> bytes:
+    # Inverse of to_text. Text in neither form is stored unchanged.
+    value = _as_bytes(text)
+    if _is_token(value):
+        return pack(value)
+    try:
+        decoded = base64.urlsafe_b64decode(value)
+    except (ValueError, binascii.Error):
+        return value
+    if (len(decoded) > _HEADER.size and not is_legacy(decoded) and decoded[1] != CODEC_NONE
+            and base64.urlsafe_b64encode(decoded) == value):
+        return decoded
+    return value
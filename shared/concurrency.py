@@ -0,0 +1,60 @@
+# shared/concurrency.py
+#
+# Lets the synchronous code shared by both web servers wait on executor
+# futures, or make blocking calls, without blocking an event loop. Under the ASGI server every
+# request runs in its own greenlet on the loop (data_vault_web/asgi.py);
+# there wait() suspends just that request's greenlet while the pool works,
+# and the loop keeps serving the others. Everywhere else it is a plain
+# future.result().
+#
+# SQLAlchemy is imported only on the loop path, so the CLI can use the
+# encryption manager without loading it.
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import asyncio
+import contextvars
+import os
+import threading
+
+_loop_greenlet = contextvars.ContextVar('loop_greenlet', default=False)
+
+# Threads for call_blocking(); created on first use, again after a fork
+BLOCKING_THREADS = 4
+_blocking_pool = None
+_blocking_lock = threading.Lock()
+
+async def run_in_greenlet(fn, *args, **kwargs):
+    # The greenlet starts with a copy of the current context, so the flag
+    # stays set for fn however long it runs.
+    from sqlalchemy.util import greenlet_spawn
+    token = _loop_greenlet.set(True)
+    try:
+        return await greenlet_spawn(fn, *args, **kwargs)
+    finally:
+        _loop_greenlet.reset(token)
+
+def wait(future, timeout=None):
+    if not _loop_greenlet.get():
+        return future.result(timeout=timeout)
+    from sqlalchemy.util import await_only
+    try:
+        # Shielded, so a timeout leaves the job running as result() would
+        return await_only(asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout))
+    except asyncio.TimeoutError:
+        raise TimeoutError()
+
+def _blocking_executor():
+    global _blocking_pool
+    with _blocking_lock:
+        if _blocking_pool is None or _blocking_pool[1] != os.getpid():
+            _blocking_pool = (ThreadPoolExecutor(BLOCKING_THREADS, thread_name_prefix='data-vault-blocking'),
+                              os.getpid())
+        return _blocking_pool[0]
+
+def call_blocking(fn, *args, **kwargs):
+    # Runs fn, which may block on I/O or a lock (e.g. a local SQLite file),
+    # on a worker thread when called on the loop, so only the calling
+    # greenlet waits for it. Everywhere else fn simply runs here.
+    if not _loop_greenlet.get():
+        return fn(*args, **kwargs)
+    return wait(_blocking_executor().submit(fn, *args, **kwargs))
@@ -0,0 +1,103 @@
+# shared/database.py
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Applied to every new SQLite connection. WAL lets readers run alongside a
+# writer, NORMAL sync is safe under WAL, and the busy timeout makes writers
+# wait for the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Drivers for create_async_db_engine(); aiosqlite runs each connection's
+# sqlite3 calls on its own thread
+ASYNC_DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+}
+
+def _configure_sqlite(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        # Take transaction control away from pysqlite: its implicit BEGIN
+        # breaks SAVEPOINTs (Session.begin_nested).
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    # Reads run outside an explicit transaction so they never hold a WAL
+    # snapshot, and the first write, savepoint or SELECT ... FOR UPDATE
+    # (which SQLite itself ignores) takes the write lock up front with
+    # BEGIN IMMEDIATE. A deferred BEGIN would let two sessions read and then
+    # race to upgrade, which fails with "database is locked" instead of
+    # waiting out the busy timeout.
+    def _begin_immediate(dbapi_connection, cursor):
+        # aiosqlite's adapter keeps the state on the connection it wraps
+        if not getattr(dbapi_connection, '_connection', dbapi_connection).in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _on_execute(conn, cursor, statement, parameters, context, executemany):
+        compiled = getattr(context, 'compiled', None)
+        for_update = getattr(getattr(compiled, 'statement', None), '_for_update_arg', None) is not None
+        if for_update or statement.lstrip()[:7].upper().startswith(_WRITE_PREFIXES):
+            _begin_immediate(conn.connection.dbapi_connection, cursor)
+
+    @event.listens_for(engine, 'savepoint')
+    def _on_savepoint(conn, name):
+        dbapi_connection = conn.connection.dbapi_connection
+        cursor = dbapi_connection.cursor()
+        _begin_immediate(dbapi_connection, cursor)
+        cursor.close()
+
+def create_db_engine(db_url, pool_size=5, max_overflow=10, pool_timeout=30, sqlite_pragmas=None, **kwargs):
+    url = make_url(db_url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                             pool_timeout=pool_timeout, pool_pre_ping=True, **kwargs)
+
+    pragmas = dict(SQLITE_PRAGMAS, **(sqlite_pragmas or {}))
+    if url.database in (None, '', ':memory:'):
+        # Every connection to :memory: is a separate database, so keep the
+        # default single-connection pool.
+        pragmas.pop('journal_mode', None)
+        engine = create_engine(url, connect_args={'check_same_thread': False}, **kwargs)
+    else:
+        engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                               pool_timeout=pool_timeout, connect_args={'check_same_thread': False}, **kwargs)
+    _configure_sqlite(engine, pragmas)
+    return engine
+
+def create_async_db_engine(db_url, pool_size=5, max_overflow=10, pool_timeout=30, sqlite_pragmas=None, **kwargs):
+    # The asyncio counterpart of create_db_engine(). A URL naming a sync
+    # driver gets the backend's async one; the schema must already exist.
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = make_url(db_url)
+    backend = url.get_backend_name()
+    if not url.get_dialect().is_async and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    if backend != 'sqlite':
+        return create_async_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                   pool_timeout=pool_timeout, pool_pre_ping=True, **kwargs)
+
+    pragmas = dict(SQLITE_PRAGMAS, **(sqlite_pragmas or {}))
+    if url.database in (None, '', ':memory:'):
+        pragmas.pop('journal_mode', None)
+        engine = create_async_engine(url, **kwargs)
+    else:
+        engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size,
+                                     max_overflow=max_overflow, pool_timeout=pool_timeout,
+                                     connect_args={'check_same_thread': False}, **kwargs)
+    _configure_sqlite(engine.sync_engine, pragmas)
+    return engine
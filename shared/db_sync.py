@@ -1,59 +1,495 @@
 # shared/db_sync.py
 
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
+import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from sqlalchemy import bindparam, func
 from sqlalchemy.orm import Session
-from shared.models import User, Credential
-from shared.encryption import encrypt_data, decrypt_data
-import json
+from shared.models import (User, Credential, CredentialTombstone, MerkleNode, SyncState, SyncOutbox, normalize_timestamp,
+                           rebuild_merkle_tree, merkle_tree_is_current, merkle_children, merkle_bucket_items)
+from shared.merkle import MERKLE_DEPTH, EMPTY_HASH, differing_children
+from shared.ciphertext import from_text, to_text
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _has_local_credentials(session: Session, user: User) -> bool:
+    return session.query(Credential.id).filter_by(user_id=user.id).first() is not None
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+def outbox_counts(session: Session, user_id: int) -> dict:
+    # Changes not yet accepted by the server, and how many of them have
+    # failed at least once and are waiting to be retried
+    rows = session.query(SyncOutbox.attempts).filter(SyncOutbox.user_id == user_id)
+    pending = rows.count()
+    failed = rows.filter(SyncOutbox.attempts > 0).count() if pending else 0
+    return {'pending': pending, 'failed': failed}
 
 class DatabaseSynchronizer:
-    def __init__(self, local_session: Session, remote_url: str, api_key: str):
+    def __init__(self, local_session: Session, remote_url: str, api_key: str,
+                 chunk_size: int = 200, compress: bool = True, compress_threshold: int = 1024,
+                 pool_size: int = 4, timeout: float = 30, log=print, progress=None,
+                 retry_base: float = 5, retry_max: float = 3600):
         self.local_session = local_session
         self.remote_url = remote_url
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.timeout = timeout
+        # log(message) reports failures; progress(kind, count), if given,
+        # is called with 'pushed' or 'pulled' after every chunk or page.
+        self.log = log
+        self.progress = progress
+        # Failed pushes are retried after retry_base seconds, doubling per
+        # consecutive failure up to retry_max. An unreachable server backs
+        # off the whole outbox; an entry the server rejects backs off alone.
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._failures = 0
+        self._retry_at = None
+        # The vault version the server returned for our last write; reads
+        # ask for at least that, so a lagging read replica can't serve them
+        self._vault_seq = 0
         self.headers = {
             'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
+            'Authorization': f'Bearer {api_key}',
+            # Offer every encoding urllib3 can decode here (zstd too, when
+            # the installed urllib3 supports it); compress=False also turns
+            # off compressed downloads.
+            'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding'] if compress else 'identity',
+        }
+
+        # One keep-alive session for every request so a sync reuses the
+        # same pooled connection instead of reconnecting per call.
+        self.http = requests.Session()
+        self.http.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+    def close(self):
+        self.http.close()
+
+    def _report(self, kind: str, count: int):
+        if self.progress is not None and count:
+            self.progress(kind, count)
+
+    def _post_json(self, path: str, payload, headers=None) -> requests.Response:
+        body = json.dumps(payload, separators=(',', ':')).encode()
+        headers = dict(headers or {})
+        if self.compress and len(body) >= self.compress_threshold:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return self.http.post(f"{self.remote_url}{path}", data=body, headers=headers, timeout=self.timeout)
+
+    @staticmethod
+    def _credential_change(cred: Credential) -> dict:
+        return {
+            'id': cred.public_id,
+            'name': cred.name,
+            'data': to_text(cred.encrypted_data),  # This is already encrypted
+            'last_modified': cred.updated_at.isoformat() if cred.updated_at else None
         }
 
-    def sync_to_remote(self, user: User):
-        local_credentials = self.local_session.query(Credential).filter_by(user_id=user.id).all()
-        
-        for cred in local_credentials:
-            payload = {
-                'name': cred.name,
-                'data': cred.data,  # This is already encrypted
-                'last_modified': str(cred.updated_at)
-            }
-            
-            response = requests.post(f"{self.remote_url}/api/sync_credential", 
-                                     headers=self.headers, 
-                                     data=json.dumps(payload))
-            
+    def push_changes(self, changes) -> bool:
+        ok = True
+        for chunk in _chunked(changes, self.chunk_size):
+            try:
+                response = self._post_json('/api/sync_credentials', {'changes': chunk})
+            except requests.RequestException as e:
+                self.log(f"Failed to sync credentials: {e}")
+                return False
+
             if response.status_code != 200:
-                print(f"Failed to sync credential {cred.name}: {response.text}")
-
-    def sync_from_remote(self, user: User):
-        response = requests.get(f"{self.remote_url}/api/get_credentials", headers=self.headers)
-        
-        if response.status_code == 200:
-            remote_credentials = response.json()
-            
-            for remote_cred in remote_credentials:
-                local_cred = self.local_session.query(Credential).filter_by(name=remote_cred['name'], user_id=user.id).first()
-                
-                if not local_cred:
-                    new_cred = Credential(name=remote_cred['name'], 
-                                          data=remote_cred['data'],
-                                          user_id=user.id)
-                    self.local_session.add(new_cred)
-                elif remote_cred['last_modified'] > str(local_cred.updated_at):
-                    local_cred.data = remote_cred['data']
-                    local_cred.updated_at = remote_cred['last_modified']
-            
+                self.log(f"Failed to sync {len(chunk)} credentials: {response.text}")
+                ok = False
+                continue
+
+            for result in response.json()['results']:
+                if result['status'] == 'error':
+                    change = chunk[result['index']]
+                    self.log(f"Failed to sync credential {change.get('name')}: {result.get('msg')}")
+                    ok = False
+            self._report('pushed', len(chunk))
+        return ok
+
+    def _sync_state(self, user: User) -> SyncState:
+        state = self.local_session.get(SyncState, user.id)
+        if state is None:
+            state = SyncState(user_id=user.id, remote_cursor=0, pushed_seq=0)
+            self.local_session.add(state)
+        return state
+
+    def _enqueue_changes(self, user: User, since: int, high_water: int):
+        # Moves the local change log (credentials and tombstones with a
+        # change_seq in (since, high_water]) into the outbox. Each credential
+        # keeps one entry, for its latest change.
+        latest = {}
+        for model, op in ((Credential, 'upsert'), (CredentialTombstone, 'delete')):
+            rows = (self.local_session.query(model.public_id, model.change_seq)
+                    .filter(model.user_id == user.id, model.change_seq > since, model.change_seq <= high_water)
+                    .yield_per(1000))
+            for public_id, change_seq in rows:
+                if public_id not in latest or latest[public_id][1] < change_seq:
+                    latest[public_id] = (op, change_seq)
+        if not latest:
+            return
+
+        now = _utcnow()
+        outbox = SyncOutbox.__table__
+        conn = self.local_session.connection()
+        queued = set()
+        for chunk in _chunked(list(latest), 500):
+            queued.update(row[0] for row in conn.execute(
+                outbox.select().with_only_columns([outbox.c.public_id])
+                .where(outbox.c.user_id == user.id, outbox.c.public_id.in_(chunk))))
+        values = [{'b_public_id': public_id, 'op': op, 'change_seq': change_seq, 'attempts': 0,
+                   'next_attempt_at': now, 'last_error': None}
+                  for public_id, (op, change_seq) in latest.items()]
+        updates = [v for v in values if v['b_public_id'] in queued]
+        inserts = [dict(v, user_id=user.id, public_id=v.pop('b_public_id')) for v in values
+                   if v['b_public_id'] not in queued]
+        if updates:
+            conn.execute(outbox.update()
+                         .where((outbox.c.user_id == user.id) & (outbox.c.public_id == bindparam('b_public_id')))
+                         .values(op=bindparam('op'), change_seq=bindparam('change_seq'), attempts=0,
+                                 next_attempt_at=bindparam('next_attempt_at'), last_error=None), updates)
+        if inserts:
+            conn.execute(outbox.insert(), inserts)
+
+    def _outbox_change(self, entry, credentials) -> dict:
+        cred = credentials.get(entry.public_id) if entry.op == 'upsert' else None
+        if cred is None:
+            # Deleted since it was queued; its tombstone is queued next
+            return {'id': entry.public_id, 'deleted': True}
+        return self._credential_change(cred)
+
+    @staticmethod
+    def _idempotency_key(user: User, entries) -> str:
+        # The same entries at the same versions always get the same key, so
+        # resending a batch whose response was lost is answered from the
+        # server's record instead of being applied twice.
+        digest = hashlib.sha256(str(user.public_id).encode())
+        for entry in entries:
+            digest.update(f"|{entry.public_id}:{entry.op}:{entry.change_seq}".encode())
+        return digest.hexdigest()
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+
+    def _settle(self, user: User, entry, error=None, rejected=False):
+        # Drops a pushed entry, or records a failed attempt; an entry the
+        # server rejected is also held back for its own backoff. Either way
+        # only if it was not replaced by a newer edit while the request was
+        # in flight.
+        outbox = SyncOutbox.__table__
+        match = ((outbox.c.user_id == user.id) & (outbox.c.public_id == entry.public_id)
+                 & (outbox.c.change_seq == entry.change_seq))
+        conn = self.local_session.connection()
+        if error is None:
+            conn.execute(outbox.delete().where(match))
+            return
+        values = {'attempts': entry.attempts + 1, 'last_error': error[:255]}
+        if rejected:
+            values['next_attempt_at'] = _utcnow() + timedelta(seconds=self._backoff(entry.attempts + 1))
+        conn.execute(outbox.update().where(match).values(**values))
+
+    def flush_outbox(self, user: User) -> bool:
+        # Pushes the outbox entries that are due, chunk_size per request.
+        # Returns False if any of them failed; those wait for their retry.
+        if self._retry_at is not None and time.monotonic() < self._retry_at:
+            return False
+        ok = True
+        while True:
+            entries = (self.local_session.query(SyncOutbox)
+                       .filter(SyncOutbox.user_id == user.id, SyncOutbox.next_attempt_at <= _utcnow())
+                       .order_by(SyncOutbox.change_seq)
+                       .limit(self.chunk_size)
+                       .all())
+            if not entries:
+                return ok
+            upserts = [entry.public_id for entry in entries if entry.op == 'upsert']
+            credentials = {cred.public_id: cred for cred in self.local_session.query(Credential).filter(
+                Credential.user_id == user.id, Credential.public_id.in_(upserts))} if upserts else {}
+            chunk = [self._outbox_change(entry, credentials) for entry in entries]
+
+            error = None
+            try:
+                response = self._post_json('/api/sync_credentials', {'changes': chunk},
+                                           headers={'Idempotency-Key': self._idempotency_key(user, entries)})
+                if response.status_code != 200:
+                    error = f"HTTP {response.status_code}: {response.text[:200]}"
+            except requests.RequestException as e:
+                error = str(e)
+            if error is not None:
+                self.log(f"Failed to sync {len(chunk)} credentials: {error}")
+                for entry in entries:
+                    self._settle(user, entry, error)
+                self.local_session.commit()
+                self._failures += 1
+                self._retry_at = time.monotonic() + self._backoff(self._failures)
+                return False
+            self._failures, self._retry_at = 0, None
+            self._vault_seq = max(self._vault_seq, int(response.headers.get('X-Vault-Seq') or 0))
+
+            for entry, result in zip(entries, response.json()['results']):
+                if result['status'] == 'error':
+                    self.log(f"Failed to sync credential {chunk[result['index']].get('name')}: {result.get('msg')}")
+                    self._settle(user, entry, result.get('msg') or 'error', rejected=True)
+                    ok = False
+                else:
+                    self._settle(user, entry)
             self.local_session.commit()
-        else:
-            print(f"Failed to fetch credentials from remote: {response.text}")
+            self._report('pushed', len(chunk))
+
+    def outbox_retry_delay(self, user: User):
+        # Seconds until the next retry of the outbox is due, or None if it
+        # is empty
+        next_attempt = (self.local_session.query(func.min(SyncOutbox.next_attempt_at))
+                        .filter(SyncOutbox.user_id == user.id).scalar())
+        if next_attempt is None:
+            return None
+        delay = (normalize_timestamp(next_attempt) - normalize_timestamp(_utcnow())).total_seconds()
+        if self._retry_at is not None:
+            delay = max(delay, self._retry_at - time.monotonic())
+        return max(0.0, delay)
+
+    def sync_to_remote(self, user: User, full: bool = False) -> bool:
+        state = self._sync_state(user)
+        since = 0 if full else state.pushed_seq
+        # Read the high-water mark first: anything written after this point
+        # is queued by the next push.
+        self.local_session.refresh(user, ['change_seq'])
+        high_water = user.change_seq
+        self._enqueue_changes(user, since, high_water)
+        state.pushed_seq = max(state.pushed_seq, high_water)
+        self.local_session.commit()
+        return self.flush_outbox(user)
+
+    def _apply_remote_changes(self, user: User, changes):
+        ids = [change['id'] for change in changes]
+        local = {cred.public_id: cred for cred in self.local_session.query(Credential).filter(
+            Credential.user_id == user.id, Credential.public_id.in_(ids))} if ids else {}
+
+        self.local_session.info['applying_remote'] = True
+        try:
+            for change in changes:
+                local_cred = local.get(change['id'])
+                if change.get('deleted'):
+                    if local_cred is not None:
+                        self.local_session.delete(local_cred)
+                        del local[change['id']]
+                    continue
+
+                remote_modified = normalize_timestamp(change['last_modified'])
+                if local_cred is None:
+                    local[change['id']] = Credential(public_id=change['id'],
+                                                     name=change['name'],
+                                                     encrypted_data=from_text(change['data']),
+                                                     updated_at=remote_modified,
+                                                     user_id=user.id)
+                    self.local_session.add(local[change['id']])
+                    continue
+
+                local_modified = normalize_timestamp(local_cred.updated_at)
+                if local_modified is None or (remote_modified is not None and remote_modified > local_modified):
+                    local_cred.name = change['name']
+                    local_cred.encrypted_data = from_text(change['data'])
+                    local_cred.updated_at = remote_modified
+            self.local_session.flush()
+        finally:
+            self.local_session.info.pop('applying_remote', None)
+
+    def sync_from_remote(self, user: User) -> bool:
+        state = self._sync_state(user)
+        # The ETag of the last caught-up poll: while the remote vault
+        # version is unchanged the server answers 304 without a body.
+        headers = {'If-None-Match': state.remote_etag} if state.remote_etag else {}
+        while True:
+            headers['X-Min-Vault-Seq'] = str(max(state.remote_cursor, self._vault_seq))
+            try:
+                response = self.http.get(f"{self.remote_url}/api/get_credentials",
+                                         params={'since': state.remote_cursor, 'limit': self.chunk_size},
+                                         headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.log(f"Failed to fetch credentials from remote: {e}")
+                return False
+
+            if response.status_code == 304:
+                return True
+            if response.status_code != 200:
+                self.log(f"Failed to fetch credentials from remote: {response.text}")
+                return False
+
+            page = response.json()
+            if page.get('reset'):
+                state.remote_etag = None
+                return self.reconcile(user)
+            self._apply_remote_changes(user, page['changes'])
+            state.remote_cursor = page['cursor']
+            state.remote_etag = None if page['has_more'] else response.headers.get('ETag')
+            self.local_session.commit()
+            self._report('pulled', len(page['changes']))
+            if not page['has_more']:
+                return True
+            headers = {}
+
+    def wait_for_remote_change(self, user: User, since: int = None, timeout: float = 25):
+        # Holds a request open on the server until the remote vault version
+        # differs from since (default: the sync cursor) or timeout seconds
+        # pass. Returns the remote version, which equals since when nothing
+        # changed, or None if the server could not be asked.
+        if since is None:
+            since = (self.local_session.query(SyncState.remote_cursor)
+                     .filter(SyncState.user_id == user.id).scalar() or 0)
+            # Don't keep a read transaction open on the local database
+            # while the request waits
+            self.local_session.commit()
+        try:
+            response = self.http.get(f"{self.remote_url}/api/watch", params={'since': since, 'timeout': timeout},
+                                     timeout=self.timeout + timeout)
+        except requests.RequestException as e:
+            self.log(f"Failed to watch for remote changes: {e}")
+            return None
+        if response.status_code != 200:
+            self.log(f"Failed to watch for remote changes: {response.text}")
+            return None
+        return response.json()['seq']
+
+    def _reconcile_request(self, **payload):
+        try:
+            response = self._post_json('/api/reconcile', payload)
+        except requests.RequestException as e:
+            self.log(f"Failed to reconcile with remote: {e}")
+            return None
+        if response.status_code != 200:
+            self.log(f"Failed to reconcile with remote: {response.text}")
+            return None
+        return response.json()
+
+    @staticmethod
+    def _diff_bucket(local_items: dict, remote_items: dict, remote_deleted: dict,
+                     to_pull: list, to_push: list, to_delete: list):
+        for public_id in set(local_items) | set(remote_items):
+            local_item, remote_item = local_items.get(public_id), remote_items.get(public_id)
+            if local_item and remote_item and local_item['digest'] == remote_item['digest']:
+                continue
+            if remote_item is None:
+                deleted_at = normalize_timestamp(remote_deleted.get(public_id))
+                if deleted_at is not None and deleted_at >= (normalize_timestamp(local_item['last_modified']) or datetime.min):
+                    to_delete.append({'id': public_id, 'deleted': True})
+                else:
+                    to_push.append(public_id)
+            elif local_item is None:
+                to_pull.append((public_id, normalize_timestamp(remote_item['last_modified'])))
+            elif (normalize_timestamp(remote_item['last_modified']) or datetime.min) > \
+                    (normalize_timestamp(local_item['last_modified']) or datetime.min):
+                to_pull.append((public_id, None))
+            else:
+                to_push.append(public_id)
+
+    def reconcile(self, user: User, batch_size: int = 128) -> bool:
+        session = self.local_session
+        if not merkle_tree_is_current(session, user.id):
+            rebuild_merkle_tree(session, user.id)
+        state = self._sync_state(user)
+        session.refresh(user, ['change_seq'])
+        high_water = user.change_seq
+
+        page = self._reconcile_request(prefixes=[''])
+        if page is None:
+            return False
+        cursor = page['cursor']
+        local_root = session.get(MerkleNode, (user.id, ''))
+
+        # Walk down only the subtrees whose hashes differ; identical vaults
+        # stop after the root comparison.
+        buckets = []
+        if (local_root.hash if local_root else EMPTY_HASH) != page['root']['hash']:
+            frontier = {'': page['children']['']}
+            while frontier:
+                next_prefixes = []
+                for prefix, remote_children in frontier.items():
+                    differing = differing_children(merkle_children(session, user.id, prefix), remote_children)
+                    if not differing:
+                        buckets.append(prefix)
+                    for child in differing:
+                        (buckets if len(child) >= MERKLE_DEPTH else next_prefixes).append(child)
+                frontier = {}
+                for chunk in _chunked(next_prefixes, batch_size):
+                    page = self._reconcile_request(prefixes=chunk)
+                    if page is None:
+                        return False
+                    frontier.update(page['children'])
+
+        to_pull, to_push, to_delete = [], [], []
+        for chunk in _chunked(buckets, batch_size):
+            page = self._reconcile_request(buckets=chunk)
+            if page is None:
+                return False
+            for prefix, remote_items in page['items'].items():
+                self._diff_bucket(merkle_bucket_items(session, user.id, prefix), remote_items,
+                                  page['deleted'][prefix], to_pull, to_push, to_delete)
+        self._apply_remote_changes(user, to_delete)
+        self._report('pulled', len(to_delete))
+
+        # Credentials missing locally may have been deleted here on purpose;
+        # push the deletion unless the remote copy is newer than it.
+        tombstones = {}
+        missing = [public_id for public_id, remote_modified in to_pull if remote_modified is not None]
+        for chunk in _chunked(missing, self.chunk_size):
+            for t in session.query(CredentialTombstone).filter(CredentialTombstone.user_id == user.id,
+                                                                CredentialTombstone.public_id.in_(chunk)):
+                tombstones[t.public_id] = t
+        deletions = []
+        for public_id, remote_modified in list(to_pull):
+            tombstone = tombstones.get(public_id)
+            if tombstone is not None and normalize_timestamp(tombstone.deleted_at) >= remote_modified:
+                to_pull.remove((public_id, remote_modified))
+                deletions.append({'id': public_id, 'name': tombstone.name, 'deleted': True})
+
+        for chunk in _chunked([public_id for public_id, _ in to_pull], self.chunk_size):
+            page = self._reconcile_request(fetch=chunk)
+            if page is None:
+                return False
+            self._apply_remote_changes(user, page['credentials'])
+            self._report('pulled', len(page['credentials']))
+        session.commit()
+
+        def local_changes():
+            for chunk in _chunked(to_push, self.chunk_size):
+                for cred in session.query(Credential).filter(Credential.user_id == user.id,
+                                                             Credential.public_id.in_(chunk)):
+                    yield self._credential_change(cred)
+            yield from deletions
+        if not self.push_changes(local_changes()):
+            return False
+
+        state.remote_cursor = cursor
+        state.pushed_seq = max(state.pushed_seq, high_water)
+        session.commit()
+        return True
 
-    def perform_full_sync(self, user: User):
-        self.sync_to_remote(user)
-        self.sync_from_remote(user)
\ No newline at end of file
+    def perform_full_sync(self, user: User) -> bool:
+        # Without a cursor there is no history to replay; diff the two
+        # vaults instead of shipping everything both ways.
+        state = self._sync_state(user)
+        if state.remote_cursor == 0 and _has_local_credentials(self.local_session, user):
+            return self.reconcile(user)
+        pushed = self.sync_to_remote(user)
+        pulled = self.sync_from_remote(user)
+        return pushed and pulled
@@ -1,9 +1,17 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+from typing import Iterable, List
 import base64
+import hashlib
 import os
+import threading
+import zlib
+from shared import ciphertext
+from shared.concurrency import wait
 
 def generate_key(password: str, salt: bytes = None) -> tuple:
     if salt is None:
@@ -18,16 +26,157 @@ def generate_key(password: str, salt: bytes = None) -> tuple:
     key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
     return key, salt
 
+def _as_bytes(value) -> bytes:
+    return value.encode() if isinstance(value, str) else value
+
+def key_id(key) -> str:
+    # Short fingerprint naming a key in logs and rotation checkpoints
+    return hashlib.sha256(_as_bytes(key)).hexdigest()[:16]
+
+class Keyring:
+    # The keys of an EncryptionManager, primary first. Encrypts into the
+    # version 1 storage format (shared.ciphertext), compressing plaintexts
+    # of at least compress_min_size bytes first when that makes them
+    # smaller, and decrypts both formats.
+
+    def __init__(self, keys, compress_min_size: int = None):
+        self.fernets = {bytes.fromhex(key_id(key)): Fernet(key) for key in keys}
+        self.primary_id = bytes.fromhex(key_id(keys[0]))
+        self.multi = MultiFernet(list(self.fernets.values()))
+        self.compress_min_size = compress_min_size
+
+    def encrypt(self, plaintext) -> bytes:
+        data, codec = _as_bytes(plaintext), ciphertext.CODEC_NONE
+        if self.compress_min_size and len(data) >= self.compress_min_size:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data, codec = compressed, ciphertext.CODEC_ZLIB
+        return ciphertext.pack(self.fernets[self.primary_id].encrypt(data), self.primary_id, codec)
+
+    def decrypt(self, value) -> str:
+        token, token_key_id, codec = ciphertext.unpack(value)
+        data = self.fernets.get(token_key_id, self.multi).decrypt(token)
+        if codec == ciphertext.CODEC_ZLIB:
+            data = zlib.decompress(data)
+        elif codec != ciphertext.CODEC_NONE:
+            raise ValueError(f"Unknown codec: {codec}")
+        return data.decode()
+
+    def rotate(self, value) -> bytes:
+        # Values already under the primary key come back unchanged
+        token, token_key_id, codec = ciphertext.unpack(value)
+        if token_key_id == self.primary_id:
+            return _as_bytes(value)
+        return ciphertext.pack(self.multi.rotate(token), self.primary_id, codec)
+
+def _run_batch(keyring: Keyring, operation: str, items: list, errors: str) -> list:
+    run = getattr(keyring, operation)
+    results = []
+    for item in items:
+        try:
+            results.append(run(item))
+        except Exception as e:
+            if errors == 'raise':
+                raise
+            results.append(e)
+    return results
+
+# Each pool process builds its keyring once instead of unpickling it per chunk.
+_worker_keyring = None
+
+def _init_worker(keys, compress_min_size):
+    global _worker_keyring
+    _worker_keyring = Keyring(keys, compress_min_size)
+
+def _run_worker_batch(operation: str, items: list, errors: str) -> list:
+    return _run_batch(_worker_keyring, operation, items, errors)
+
 class EncryptionManager:
-    def __init__(self, key):
-        self.fernet = Fernet(key)
+    # key is a single Fernet key or a keyring: a list of keys, primary
+    # first. Data is encrypted with the primary key and decrypted with
+    # whichever key matches, so a new key can be rolled out and old data
+    # re-encrypted (rotate_many) without downtime. Plaintexts of at least
+    # compress_min_size bytes are compressed before encryption when that
+    # makes them smaller; None turns compression off.
+    #
+    # Below this many items a batch runs inline: handing work to a pool and
+    # collecting it again costs more than it saves.
+    PARALLEL_THRESHOLD = 4096
+    CHUNK_SIZE = 512
+
+    def __init__(self, key, executor: str = 'process', max_workers: int = None,
+                 parallel_threshold: int = PARALLEL_THRESHOLD, chunk_size: int = CHUNK_SIZE,
+                 compress_min_size: int = None):
+        if executor not in ('process', 'thread'):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.keys = [key] if isinstance(key, (str, bytes)) else list(key)
+        if not self.keys:
+            raise ValueError("At least one key is required")
+        self.key = self.keys[0]
+        self.compress_min_size = compress_min_size
+        self.keyring = Keyring(self.keys, compress_min_size)
+        self.executor = executor
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def encrypt_data(self, data: str) -> bytes:
-        return self.fernet.encrypt(data.encode())
+        return self.keyring.encrypt(data)
 
     def decrypt_data(self, encrypted_data: bytes) -> str:
-        return self.fernet.decrypt(encrypted_data).decode()
+        return self.keyring.decrypt(encrypted_data)
+
+    def encrypt_many(self, items: Iterable[str], errors: str = 'raise') -> List[bytes]:
+        return self._run_many('encrypt', items, errors)
+
+    def decrypt_many(self, items: Iterable[bytes], errors: str = 'raise') -> List[str]:
+        # With errors='return' a failed item is replaced by its exception
+        # instead of aborting the whole batch.
+        return self._run_many('decrypt', items, errors)
+
+    def rotate_many(self, items: Iterable[bytes], errors: str = 'raise') -> List[bytes]:
+        # Re-encrypts data made with any key in the ring under the primary
+        # key, keeping the tokens' original timestamps.
+        return self._run_many('rotate', items, errors)
+
+    @property
+    def primary_key_id(self) -> str:
+        return key_id(self.key)
+
+    def _run_many(self, operation: str, items: Iterable, errors: str) -> list:
+        if errors not in ('raise', 'return'):
+            raise ValueError(f"Unknown errors mode: {errors}")
+        items = list(items)
+        if len(items) < self.parallel_threshold or self.max_workers < 2:
+            return _run_batch(self.keyring, operation, items, errors)
+
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        pool = self._get_pool()
+        if self.executor == 'process':
+            futures = [pool.submit(_run_worker_batch, operation, chunk, errors) for chunk in chunks]
+        else:
+            futures = [pool.submit(_run_batch, self.keyring, operation, chunk, errors) for chunk in chunks]
+        return list(chain.from_iterable(wait(future) for future in futures))
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                if self.executor == 'process':
+                    self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     initializer=_init_worker,
+                                                     initargs=(self.keys, self.compress_min_size))
+                else:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
 
     @staticmethod
     def generate_key():
-        return Fernet.generate_key()
\ No newline at end of file
+        return Fernet.generate_key()
@@ -0,0 +1,37 @@
+# shared/merkle.py
+
+import hashlib
+from shared.ciphertext import to_text
+
+# Credentials are bucketed by the first MERKLE_DEPTH characters of their
+# public_id, so the tree has a root, MERKLE_DEPTH - 1 inner levels and leaf
+# buckets holding the individual credentials.
+MERKLE_DEPTH = 3
+EMPTY_HASH = '0' * 64
+
+def credential_digest(public_id: str, updated_at: str, encrypted_data) -> str:
+    # Hashes the text form of the ciphertext, which is the same before and
+    # after a row is converted to the binary storage format.
+    encrypted_data = to_text(encrypted_data).encode() if encrypted_data else b''
+    data_digest = hashlib.sha256(encrypted_data).hexdigest()
+    return hashlib.sha256(f"{public_id}|{updated_at or ''}|{data_digest}".encode()).hexdigest()
+
+def xor_hex(a: str, b: str) -> str:
+    return format(int(a, 16) ^ int(b, 16), '064x')
+
+def bucket_prefixes(public_id: str):
+    # Every node on the path from the root down to the credential's leaf.
+    return [public_id[:depth] for depth in range(min(MERKLE_DEPTH, len(public_id)) + 1)]
+
+def prefix_range(prefix: str):
+    # [lower, upper) bounds of the public_id range covered by a bucket, so
+    # buckets can be read with an index range scan instead of LIKE.
+    if not prefix:
+        return None, None
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def differing_children(local: dict, remote: dict):
+    # Children are {prefix: {'hash': ..., 'count': ...}}; a bucket present on
+    # only one side differs as well.
+    return sorted(prefix for prefix in set(local) | set(remote)
+                  if local.get(prefix, {}).get('hash') != remote.get(prefix, {}).get('hash'))
@@ -1,9 +1,21 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Boolean, Text
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import bindparam, event, inspect, select, Column, Integer, String, ForeignKey, DateTime, Boolean, Float, Text, Index, LargeBinary
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.sql import func
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.types import TypeDecorator
 from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime, timezone
+from shared.ciphertext import upgrade as upgrade_ciphertext
+from shared.database import create_db_engine
+from shared.merkle import credential_digest, xor_hex, bucket_prefixes, prefix_range, EMPTY_HASH
+from shared.search import MIN_SIMILARITY, POSTINGS_PER_TRIGRAM, name_trigrams, query_trigrams, similarity
+import collections
+import math
+import time
 import uuid
+import zlib
 
 Base = declarative_base()
 
@@ -15,7 +27,10 @@ class User(Base):
     username = Column(String(50), unique=True, nullable=False, index=True)
     email = Column(String(120), unique=True, nullable=False, index=True)
     password_hash = Column(String(255), nullable=False)
+    # Salt of the PBKDF2 derivation of the CLI's vault key from the password
+    kdf_salt = Column(LargeBinary(16))
     is_active = Column(Boolean, default=True, nullable=False)
+    change_seq = Column(Integer, default=0, server_default='0', nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -38,21 +53,650 @@ class User(Base):
     def get_id(self):
         return self.public_id
 
+class CiphertextType(TypeDecorator):
+    # Binary column for shared.ciphertext values. Rows written before the
+    # binary format may still hold the token as text, so values are always
+    # read back as bytes, whatever the database stored them as.
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return value.encode() if isinstance(value, str) else value
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None or isinstance(value, bytes):
+                return value
+            return value.encode() if isinstance(value, str) else bytes(value)
+        return process
+
 class Credential(Base):
     __tablename__ = 'credentials'
 
     id = Column(Integer, primary_key=True)
     public_id = Column(String(36), unique=True, default=lambda: str(uuid.uuid4()))
     name = Column(String(100), nullable=False)
-    encrypted_data = Column(Text, nullable=False)
+    encrypted_data = Column(CiphertextType, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    change_seq = Column(Integer, default=0, server_default='0', nullable=False)
+    digest = Column(String(64))
 
     user = relationship("User", back_populates="credentials")
 
-def init_db(db_url):
-    engine = create_engine(db_url)
+    __table_args__ = (
+        Index('ix_credentials_user_change_seq', 'user_id', 'change_seq'),
+        Index('ix_credentials_user_public_id', 'user_id', 'public_id'),
+        # Case-insensitive prefix search is a range scan on this index
+        Index('ix_credentials_user_lower_name', 'user_id', func.lower(name)),
+    )
+
+    def compute_digest(self):
+        updated_at = normalize_timestamp(self.updated_at)
+        return credential_digest(self.public_id, updated_at.isoformat() if updated_at else '', self.encrypted_data)
+
+class CredentialTombstone(Base):
+    __tablename__ = 'credential_tombstones'
+
+    id = Column(Integer, primary_key=True)
+    public_id = Column(String(36), nullable=False)
+    name = Column(String(100), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    change_seq = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_credential_tombstones_user_change_seq', 'user_id', 'change_seq'),
+        Index('ix_credential_tombstones_user_public_id', 'user_id', 'public_id'),
+    )
+
+class CredentialTrigram(Base):
+    # Fuzzy search index: one row per distinct trigram of a credential's
+    # name, see shared/search.py. Rows are keyed by the credential's
+    # public_id so they can be written before the credential has an id.
+    __tablename__ = 'credential_trigrams'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    trigram = Column(String(3), primary_key=True)
+    public_id = Column(String(36), primary_key=True)
+
+    # On SQLite the primary key is the table, with no separate rowid B-tree
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    remote_cursor = Column(Integer, default=0, nullable=False)
+    pushed_seq = Column(Integer, default=0, nullable=False)
+    remote_etag = Column(String(128))
+
+class SyncOutbox(Base):
+    # Local changes waiting to be pushed, one row per credential: a later
+    # edit of the same credential replaces the pending operation. Rows that
+    # failed wait until next_attempt_at before they are retried.
+    __tablename__ = 'sync_outbox'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    public_id = Column(String(36), primary_key=True)
+    op = Column(String(10), nullable=False)  # 'upsert' or 'delete'
+    change_seq = Column(Integer, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    last_error = Column(String(255))
+
+    __table_args__ = (
+        Index('ix_sync_outbox_user_next_attempt', 'user_id', 'next_attempt_at'),
+    )
+
+class IdempotencyRecord(Base):
+    # Results of sync batches sent with an Idempotency-Key, so a retried
+    # request gets the original answer instead of being applied again.
+    __tablename__ = 'idempotency_records'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+
+    id = Column(Integer, primary_key=True)
+    jti = Column(String(36), unique=True, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    revoked_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class ImportCheckpoint(Base):
+    __tablename__ = 'import_checkpoints'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    source = Column(String(64), primary_key=True)
+    records = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class KeyRotation(Base):
+    # Progress of re-encrypting all credentials under one primary key:
+    # every credential with id <= last_id has been rotated. Updated in the
+    # same transaction as each batch, so a stopped job resumes exactly.
+    __tablename__ = 'key_rotations'
+
+    key_id = Column(String(16), primary_key=True)
+    last_id = Column(Integer, default=0, nullable=False)
+    rotated = Column(Integer, default=0, nullable=False)
+    skipped = Column(Integer, default=0, nullable=False)  # not decryptable with the keyring
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at = Column(DateTime(timezone=True))
+
+class ReplicaHeartbeat(Base):
+    # A single row the web workers stamp on the primary every few seconds;
+    # how old it is on a read replica is how far that replica trails.
+    __tablename__ = 'replica_heartbeats'
+
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(Float, nullable=False)  # seconds since the epoch
+
+class MerkleNode(Base):
+    __tablename__ = 'merkle_nodes'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    prefix = Column(String(8), primary_key=True)
+    hash = Column(String(64), nullable=False)
+    count = Column(Integer, nullable=False)
+
+def normalize_timestamp(value):
+    if value is None or value == '' or value == 'None':
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+class UserNotFound(LookupError):
+    # A write for a user whose row is not in this database: deleted, or
+    # moved to another shard while the request was in flight
+    def __init__(self, user_id):
+        super().__init__(f"No user {user_id} in this database")
+        self.user_id = user_id
+
+def allocate_change_seq(session, user_id, count=1):
+    users = User.__table__
+    conn = session.connection()
+    conn.execute(users.update()
+                 .where(users.c.id == user_id)
+                 .values(change_seq=users.c.change_seq + count))
+    last = conn.execute(select(users.c.change_seq).where(users.c.id == user_id)).scalar()
+    if last is None:
+        raise UserNotFound(user_id)
+    user = session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        set_committed_value(user, 'change_seq', last)
+    # Published to watching clients once the transaction commits
+    session.info.setdefault('vault_changes', {})[user_id] = last
+    return last - count
+
+def _apply_merkle_deltas(session, user_id, deltas):
+    nodes = MerkleNode.__table__
+    conn = session.connection()
+    existing = {row.prefix: row for row in conn.execute(
+        select(nodes.c.prefix, nodes.c.hash, nodes.c.count)
+        .where(nodes.c.user_id == user_id, nodes.c.prefix.in_(list(deltas)))
+        .with_for_update())}
+    inserts, updates, deletes = [], [], []
+    for prefix, (delta, count) in deltas.items():
+        row = existing.get(prefix)
+        if row is None:
+            if count > 0:
+                inserts.append({'user_id': user_id, 'prefix': prefix, 'hash': delta, 'count': count})
+        elif row.count + count <= 0:
+            deletes.append({'b_prefix': prefix})
+        elif delta != EMPTY_HASH or count:
+            updates.append({'b_prefix': prefix, 'hash': xor_hex(row.hash, delta), 'count': row.count + count})
+
+    # One executemany per statement kind keeps bulk writes, which touch
+    # thousands of nodes, from compiling a statement per node.
+    match = (nodes.c.user_id == user_id) & (nodes.c.prefix == bindparam('b_prefix'))
+    if inserts:
+        conn.execute(nodes.insert(), inserts)
+    if updates:
+        conn.execute(nodes.update().where(match).values(hash=bindparam('hash'), count=bindparam('count')), updates)
+    if deletes:
+        conn.execute(nodes.delete().where(match), deletes)
+
+def _add_merkle_delta(deltas, public_id, delta, count):
+    for prefix in bucket_prefixes(public_id):
+        node = deltas.setdefault(prefix, [EMPTY_HASH, 0])
+        node[0] = xor_hex(node[0], delta)
+        node[1] += count
+
+def _track_merkle_changes(session, user_id, written, deleted):
+    deltas = {}
+    def add(public_id, delta, count):
+        _add_merkle_delta(deltas, public_id, delta, count)
+
+    for obj in written:
+        if obj.public_id is None:
+            obj.public_id = str(uuid.uuid4())
+        # Stamp local edits explicitly so the digest matches what is stored;
+        # synced rows keep the timestamp they arrived with.
+        if obj.updated_at is None or not inspect(obj).attrs.updated_at.history.has_changes():
+            obj.updated_at = datetime.now(timezone.utc)
+        old, obj.digest = obj.digest, obj.compute_digest()
+        add(obj.public_id, xor_hex(old or EMPTY_HASH, obj.digest), 0 if old else 1)
+    for obj in deleted:
+        if obj.digest:
+            add(obj.public_id, obj.digest, -1)
+    if deltas:
+        _apply_merkle_deltas(session, user_id, deltas)
+
+def _apply_trigram_changes(session, user_id, removed, added):
+    # removed and added are (public_id, name) pairs
+    trigrams = CredentialTrigram.__table__
+    conn = session.connection()
+    deletes = [{'b_trigram': gram, 'b_public_id': public_id}
+               for public_id, name in removed for gram in name_trigrams(name)]
+    # Sorted in index order, so a large batch appends to a few B-tree pages
+    # at a time instead of touching a random page per row.
+    inserts = [{'user_id': user_id, 'trigram': gram, 'public_id': public_id}
+               for gram, public_id in sorted((gram, public_id) for public_id, name in added
+                                             for gram in name_trigrams(name))]
+    if deletes:
+        conn.execute(trigrams.delete().where(
+            (trigrams.c.user_id == user_id) & (trigrams.c.trigram == bindparam('b_trigram'))
+            & (trigrams.c.public_id == bindparam('b_public_id'))), deletes)
+    if inserts:
+        conn.execute(trigrams.insert(), inserts)
+
+def _track_search_changes(session, user_id, written, deleted):
+    removed, added = [], []
+    for obj in written:
+        state = inspect(obj)
+        if state.pending:
+            added.append((obj.public_id, obj.name))
+            continue
+        history = state.attrs.name.history
+        if history.deleted and history.added:
+            removed.append((obj.public_id, history.deleted[0]))
+            added.append((obj.public_id, obj.name))
+    for obj in deleted:
+        history = inspect(obj).attrs.name.history
+        removed.append((obj.public_id, history.deleted[0] if history.deleted else obj.name))
+    if removed or added:
+        _apply_trigram_changes(session, user_id, removed, added)
+
+@event.listens_for(Session, 'before_flush')
+def _track_credential_changes(session, flush_context, instances):
+    changes = {}
+    for obj in session.new:
+        if isinstance(obj, Credential):
+            user_id = obj.user_id if obj.user_id is not None else getattr(obj.user, 'id', None)
+            changes.setdefault(user_id, ([], []))[0].append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, Credential) and session.is_modified(obj, include_collections=False):
+            changes.setdefault(obj.user_id, ([], []))[0].append(obj)
+    for obj in session.deleted:
+        if isinstance(obj, Credential):
+            changes.setdefault(obj.user_id, ([], []))[1].append(obj)
+
+    for user_id, (written, deleted) in changes.items():
+        if user_id is None:
+            continue
+        _track_merkle_changes(session, user_id, written, deleted)
+        _track_search_changes(session, user_id, written, deleted)
+
+        # Changes pulled from the remote already carry the remote's sequence
+        # and must not be queued for pushing back.
+        if session.info.get('applying_remote'):
+            continue
+        seq = allocate_change_seq(session, user_id, len(written) + len(deleted))
+        for obj in written:
+            seq += 1
+            obj.change_seq = seq
+        for obj in deleted:
+            seq += 1
+            session.add(CredentialTombstone(public_id=obj.public_id, name=obj.name, user_id=user_id,
+                                            change_seq=seq, deleted_at=datetime.now(timezone.utc)))
+
+def bulk_insert_credentials(session, user_id, rows):
+    # Inserts many new credentials with one executemany instead of one ORM
+    # INSERT per row, doing the sequence and Merkle bookkeeping the
+    # before_flush hook would. rows are dicts with name and encrypted_data.
+    # Returns the new public ids in order.
+    if not rows:
+        return []
+    now = datetime.now(timezone.utc)
+    seq = allocate_change_seq(session, user_id, len(rows))
+    deltas, mappings = {}, []
+    for row in rows:
+        seq += 1
+        public_id = str(uuid.uuid4())
+        digest = credential_digest(public_id, normalize_timestamp(now).isoformat(), row['encrypted_data'])
+        mappings.append({'user_id': user_id, 'public_id': public_id, 'name': row['name'],
+                         'encrypted_data': row['encrypted_data'], 'updated_at': now,
+                         'change_seq': seq, 'digest': digest})
+        _add_merkle_delta(deltas, public_id, digest, 1)
+    session.execute(Credential.__table__.insert(), mappings)
+    _apply_merkle_deltas(session, user_id, deltas)
+    _apply_trigram_changes(session, user_id, [], [(m['public_id'], m['name']) for m in mappings])
+    return [mapping['public_id'] for mapping in mappings]
+
+def reencrypt_credentials(session, changes):
+    # Swaps in new ciphertext for existing credentials with one executemany,
+    # doing the sequence and Merkle bookkeeping the before_flush hook would,
+    # so sync clients pull the new ciphertext. updated_at is kept: the
+    # credential's content did not change, and last-writer-wins sync must
+    # not let a rotation beat a client's later edit. changes maps credential ids
+    # to (ciphertext as read, new ciphertext); rows locked here whose
+    # ciphertext no longer matches were rewritten meanwhile and are left
+    # alone. Returns the number of credentials updated.
+    if not changes:
+        return 0
+    credentials = Credential.__table__
+    current = session.execute(
+        select(credentials.c.id, credentials.c.user_id, credentials.c.public_id,
+               credentials.c.encrypted_data, credentials.c.digest, credentials.c.updated_at)
+        .where(credentials.c.id.in_(list(changes)))
+        .with_for_update()).all()
+    by_user = collections.defaultdict(list)
+    for row in current:
+        old, new = changes[row.id]
+        if row.encrypted_data == old:
+            by_user[row.user_id].append((row, new))
+
+    updates = []
+    for user_id, rows in by_user.items():
+        seq = allocate_change_seq(session, user_id, len(rows))
+        deltas = {}
+        for row, new in rows:
+            seq += 1
+            updated_at = normalize_timestamp(row.updated_at)
+            digest = credential_digest(row.public_id, updated_at.isoformat() if updated_at else '', new)
+            updates.append({'b_id': row.id, 'encrypted_data': new, 'digest': digest, 'change_seq': seq})
+            _add_merkle_delta(deltas, row.public_id, xor_hex(row.digest or EMPTY_HASH, digest),
+                              0 if row.digest else 1)
+        _apply_merkle_deltas(session, user_id, deltas)
+    if updates:
+        session.execute(credentials.update()
+                        .where(credentials.c.id == bindparam('b_id'))
+                        # Keep the column's onupdate from touching the timestamp
+                        .values(encrypted_data=bindparam('encrypted_data'), digest=bindparam('digest'),
+                                updated_at=credentials.c.updated_at, change_seq=bindparam('change_seq')),
+                        updates)
+    return len(updates)
+
+def search_credentials(session, user_id, query, limit=20):
+    # Ranked credentials whose name starts with query (case-insensitively),
+    # followed, when there are fewer than limit of those, by fuzzy trigram
+    # matches. Both lookups are index scans bounded by the matches, not by
+    # the size of the vault.
+    query = query.strip()
+    if not query:
+        return []
+    lowered = func.lower(Credential.name)
+    lower_bound = func.lower(query)
+    matches = (session.query(Credential)
+               .filter(Credential.user_id == user_id, lowered >= lower_bound, lowered < lower_bound + '\U0010ffff')
+               .order_by(lowered)
+               .limit(limit)
+               .all())
+
+    grams = query_trigrams(query)
+    if len(matches) < limit and grams:
+        # Read at most POSTINGS_PER_TRIGRAM entries per trigram, so a
+        # trigram that half the vault shares costs the same as a rare one.
+        trigrams = CredentialTrigram.__table__
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(row[0] for row in session.execute(
+                select(trigrams.c.public_id)
+                .where(trigrams.c.user_id == user_id, trigrams.c.trigram == gram)
+                .limit(POSTINGS_PER_TRIGRAM)))
+        min_shared = max(math.ceil(len(grams) * MIN_SIMILARITY), min(len(grams), 2))
+        seen = {cred.public_id for cred in matches}
+        candidates = [public_id for public_id, count in shared.most_common(limit * 4)
+                      if count >= min_shared and public_id not in seen]
+        fuzzy = [cred for cred in session.query(Credential).filter(
+                     Credential.user_id == user_id, Credential.public_id.in_(candidates))
+                 if similarity(grams, cred.name) >= MIN_SIMILARITY] if candidates else []
+        fuzzy.sort(key=lambda cred: (-similarity(grams, cred.name), len(cred.name), cred.name.lower()))
+        matches.extend(fuzzy[:limit - len(matches)])
+    return matches
+
+def rebuild_search_index(session, user_id=None):
+    trigrams = CredentialTrigram.__table__
+    conn = session.connection()
+    credentials = Credential.__table__
+    users = [user_id] if user_id is not None else [
+        row[0] for row in conn.execute(select(credentials.c.user_id).distinct())]
+    for uid in users:
+        conn.execute(trigrams.delete().where(trigrams.c.user_id == uid))
+        rows = conn.execute(select(credentials.c.public_id, credentials.c.name)
+                            .where(credentials.c.user_id == uid)).fetchall()
+        _apply_trigram_changes(session, uid, [], [tuple(row) for row in rows])
+    session.commit()
+
+def rebuild_merkle_tree(session, user_id):
+    nodes = {}
+    credentials = (session.query(Credential)
+                   .filter(Credential.user_id == user_id)
+                   .yield_per(1000))
+    for cred in credentials:
+        digest = cred.compute_digest()
+        if cred.digest != digest:
+            set_committed_value(cred, 'digest', digest)
+            # Keep the column's onupdate from touching the timestamp the
+            # digest covers
+            session.query(Credential).filter(Credential.id == cred.id).update(
+                {Credential.digest: digest, Credential.updated_at: Credential.updated_at}, synchronize_session=False)
+        for prefix in bucket_prefixes(cred.public_id):
+            node = nodes.setdefault(prefix, [EMPTY_HASH, 0])
+            node[0] = xor_hex(node[0], digest)
+            node[1] += 1
+
+    session.query(MerkleNode).filter(MerkleNode.user_id == user_id).delete(synchronize_session=False)
+    session.bulk_insert_mappings(MerkleNode, [
+        {'user_id': user_id, 'prefix': prefix, 'hash': node_hash, 'count': count}
+        for prefix, (node_hash, count) in nodes.items()])
+    session.commit()
+
+def merkle_tree_is_current(session, user_id):
+    root = session.get(MerkleNode, (user_id, ''))
+    total = session.query(func.count(Credential.id)).filter(Credential.user_id == user_id).scalar()
+    return (root.count if root else 0) == total
+
+def merkle_children(session, user_id, prefix):
+    depth = len(prefix) + 1
+    query = session.query(MerkleNode).filter(MerkleNode.user_id == user_id,
+                                             func.length(MerkleNode.prefix) == depth)
+    lower, upper = prefix_range(prefix)
+    if lower is not None:
+        query = query.filter(MerkleNode.prefix >= lower, MerkleNode.prefix < upper)
+    return {node.prefix: {'hash': node.hash, 'count': node.count} for node in query}
+
+def merkle_bucket_items(session, user_id, prefix):
+    query = session.query(Credential.public_id, Credential.digest, Credential.updated_at).filter(
+        Credential.user_id == user_id)
+    lower, upper = prefix_range(prefix)
+    if lower is not None:
+        query = query.filter(Credential.public_id >= lower, Credential.public_id < upper)
+    return {row.public_id: {'digest': row.digest, 'last_modified': str(row.updated_at)} for row in query}
+
+def merkle_bucket_tombstones(session, user_id, prefix):
+    query = session.query(CredentialTombstone.public_id, func.max(CredentialTombstone.deleted_at)).filter(
+        CredentialTombstone.user_id == user_id)
+    lower, upper = prefix_range(prefix)
+    if lower is not None:
+        query = query.filter(CredentialTombstone.public_id >= lower, CredentialTombstone.public_id < upper)
+    return {public_id: str(deleted_at) for public_id, deleted_at in query.group_by(CredentialTombstone.public_id)}
+
+def schema_fingerprint(metadata=Base.metadata):
+    # Positive 31-bit checksum of the tables, columns and indexes, so it
+    # fits SQLite's user_version and changes whenever the models do.
+    parts = []
+    for table in metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{column.name}:{column.type!r}" for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    return zlib.crc32('\n'.join(parts).encode()) & 0x7fffffff or 1
+
+# Turns a text encrypted_data column from before the binary storage format
+# into a binary one; existing tokens are kept as their UTF-8 bytes, which
+# readers still accept. SQLite needs nothing: its columns take either.
+_BINARY_CIPHERTEXT_DDL = {
+    'postgresql': "ALTER TABLE credentials ALTER COLUMN encrypted_data TYPE BYTEA "
+                  "USING convert_to(encrypted_data, 'UTF8')",
+    'mysql': "ALTER TABLE credentials MODIFY encrypted_data LONGBLOB NOT NULL",
+}
+
+def _ensure_binary_ciphertext_column(engine):
+    ddl = _BINARY_CIPHERTEXT_DDL.get(engine.dialect.name)
+    if ddl is None:
+        return
+    column = next(c for c in inspect(engine).get_columns(Credential.__tablename__) if c['name'] == 'encrypted_data')
+    if not _is_binary_type(column['type']):
+        with engine.begin() as conn:
+            conn.exec_driver_sql(ddl)
+
+def _is_binary_type(column_type):
+    # Reflected types are the dialect's own (MySQL's LONGBLOB is no
+    # LargeBinary), so they are told apart by the Python type they hold
+    try:
+        return column_type.python_type is bytes
+    except NotImplementedError:
+        return False
+
+def _ensure_user_kdf_salt_column(engine):
+    # create_all() does not add columns to the existing users table
+    if 'kdf_salt' not in {c['name'] for c in inspect(engine).get_columns(User.__tablename__)}:
+        column_type = User.__table__.c.kdf_salt.type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f'ALTER TABLE {User.__tablename__} ADD COLUMN kdf_salt {column_type}')
+
+def _create_missing_index(engine, table, name):
+    # create_all() does not add new indexes to existing tables either
+    if name not in {index['name'] for index in inspect(engine).get_indexes(table.name)}:
+        next(index for index in table.indexes if index.name == name).create(engine)
+
+def _ensure_credential_digest_column(engine):
+    # Databases from before reconciliation; returns whether the column was
+    # added, in which case the digests and Merkle trees still need building
+    if 'digest' in {c['name'] for c in inspect(engine).get_columns(Credential.__tablename__)}:
+        return False
+    column_type = Credential.__table__.c.digest.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f'ALTER TABLE {Credential.__tablename__} ADD COLUMN digest {column_type}')
+    _create_missing_index(engine, Credential.__table__, 'ix_credentials_user_public_id')
+    return True
+
+def _ensure_change_seq_columns(engine):
+    # Databases from before the sync feed: add the sequence columns, then
+    # number each user's credentials in id order, as if written one after
+    # another, so the first sync from cursor 0 sees all of them
+    inspector = inspect(engine)
+    missing = [table for table in (User.__table__, Credential.__table__)
+               if 'change_seq' not in {c['name'] for c in inspector.get_columns(table.name)}]
+    if not missing:
+        return
+    with engine.begin() as conn:
+        for table in missing:
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN change_seq INTEGER DEFAULT 0 NOT NULL')
+    users, credentials = User.__table__, Credential.__table__
+    with engine.begin() as conn:
+        rows = conn.execute(select(credentials.c.id, credentials.c.user_id)
+                            .order_by(credentials.c.user_id, credentials.c.id)).all()
+        seqs = collections.Counter()
+        updates = []
+        for row in rows:
+            seqs[row.user_id] += 1
+            updates.append({'b_id': row.id, 'change_seq': seqs[row.user_id]})
+        # Keep the columns' onupdate from touching the timestamps
+        if updates:
+            conn.execute(credentials.update()
+                         .where(credentials.c.id == bindparam('b_id'))
+                         .values(change_seq=bindparam('change_seq'), updated_at=credentials.c.updated_at),
+                         updates)
+        if seqs:
+            conn.execute(users.update()
+                         .where(users.c.id == bindparam('b_id'))
+                         .values(change_seq=bindparam('change_seq'), updated_at=users.c.updated_at),
+                         [{'b_id': user_id, 'change_seq': seq} for user_id, seq in seqs.items()])
+    _create_missing_index(engine, credentials, 'ix_credentials_user_change_seq')
+
+def convert_legacy_ciphertexts(engine, batch_size=1000, after_id=0, log=print, report_every=5.0):
+    # Rewrites credentials still holding token text in the binary format,
+    # in id order, one short transaction per batch. No key is needed and the
+    # digests do not change, so sync state is unaffected and each replica
+    # converts on its own schedule.
+    # Returns the number of rows converted.
+    credentials = Credential.__table__
+    converted = 0
+    next_report = time.monotonic() + report_every
+    while True:
+        # The page is read with FOR UPDATE, so no write can land between
+        # reading a row and rewriting it.
+        with engine.begin() as conn:
+            rows = conn.execute(select(credentials.c.id, credentials.c.encrypted_data)
+                                .where(credentials.c.id > after_id)
+                                .order_by(credentials.c.id)
+                                .limit(batch_size)
+                                .with_for_update()).all()
+            if not rows:
+                break
+            after_id = rows[-1].id
+            updates = [{'b_id': row.id, 'encrypted_data': new}
+                       for row, new in ((row, upgrade_ciphertext(row.encrypted_data)) for row in rows)
+                       if new != row.encrypted_data]
+            if updates:
+                conn.execute(credentials.update()
+                             .where(credentials.c.id == bindparam('b_id'))
+                             # Keep the column's onupdate from touching the timestamp
+                             .values(encrypted_data=bindparam('encrypted_data'), updated_at=credentials.c.updated_at),
+                             updates)
+        converted += len(updates)
+        if time.monotonic() >= next_report:
+            log(f"Converted {converted} credentials, up to id {after_id}")
+            next_report = time.monotonic() + report_every
+    return converted
+
+def init_engine(db_url, **engine_options):
+    engine = create_db_engine(db_url, **engine_options)
+    # SQLite files record the schema they were last checked against in
+    # user_version, so the table inspection and create_all() run only the
+    # first time a given file is opened with these models.
+    fingerprint = schema_fingerprint() if engine.dialect.name == 'sqlite' else None
+    if fingerprint is not None:
+        with engine.connect() as conn:
+            if conn.exec_driver_sql('PRAGMA user_version').scalar() == fingerprint:
+                return engine
+    existing = set(inspect(engine).get_table_names())
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    if User.__tablename__ in existing:
+        _ensure_user_kdf_salt_column(engine)
+    if Credential.__tablename__ in existing:
+        _ensure_change_seq_columns(engine)
+        if _ensure_credential_digest_column(engine):
+            with Session(engine) as session:
+                for user_id in session.scalars(select(Credential.user_id).distinct()).all():
+                    rebuild_merkle_tree(session, user_id)
+        _ensure_binary_ciphertext_column(engine)
+    if CredentialTrigram.__tablename__ not in existing:
+        # First start since search was added: create_all() skips the
+        # existing credentials table, so add its name index here, then
+        # index the names already stored.
+        if Credential.__tablename__ in existing:
+            for index in Credential.__table__.indexes:
+                if index.name == 'ix_credentials_user_lower_name':
+                    index.create(engine)
+        with Session(engine) as session:
+            rebuild_search_index(session)
+    if fingerprint is not None:
+        with engine.connect() as conn:
+            conn.exec_driver_sql(f'PRAGMA user_version = {fingerprint}')
+    return engine
+
+def init_db(db_url, **engine_options):
+    Session = sessionmaker(bind=init_engine(db_url, **engine_options))
     return Session()
\ No newline at end of file
@@ -0,0 +1,253 @@
+# shared/rebalance.py
+#
+# Moves users between shards while the API keeps serving (see
+# shared/sharding.py). A move first copies the user's rows to the new shard
+# in batches, without blocking anyone, then catches up on the changes made
+# meanwhile by change_seq until only a few are left. Only then is the user
+# frozen: the directory marks them as moving, which every worker picks up
+# within the placement TTL and answers with 503. The last changes are
+# copied under the source shard's lock on the user row; the directory is
+# pointed at the new shard and the old rows are deleted before that lock is
+# released. A write still waiting for the lock then finds no user and fails
+# (models.UserNotFound) instead of being lost.
+
+from sqlalchemy import delete, select, true, tuple_, update
+from sqlalchemy.orm import Session
+from shared.models import (User, Credential, CredentialTombstone, CredentialTrigram, MerkleNode, IdempotencyRecord,
+                           SyncState, SyncOutbox, ImportCheckpoint, UserNotFound)
+from shared.sharding import UserPlacement, home_shard
+import time
+
+USERS = User.__table__
+# Rows changed since a given change_seq can be found by it; the copies get
+# new ids on the target
+SEQ_TABLES = [Credential.__table__, CredentialTombstone.__table__]
+TRIGRAMS = CredentialTrigram.__table__
+# Small per-user tables copied whole while the user is frozen
+SNAPSHOT_TABLES = [MerkleNode.__table__, IdempotencyRecord.__table__, SyncState.__table__,
+                   SyncOutbox.__table__, ImportCheckpoint.__table__]
+# Every table with a user_id column, children before users
+USER_TABLES = SEQ_TABLES + [TRIGRAMS] + SNAPSHOT_TABLES
+
+def _chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _values(table, row):
+    values = dict(row._mapping)
+    if table in SEQ_TABLES:
+        del values['id']
+    return values
+
+class ShardRebalancer:
+    # grace is how long a user stays frozen before the final copy; it must
+    # exceed the workers' placement TTL, so none of them still routes the
+    # user to the old shard. Moves stop catching up once a round copies at
+    # most catch_up_rows rows.
+
+    def __init__(self, router, batch_size: int = 1000, grace: float = None, catch_up_rows: int = 100, log=print):
+        self.router = router
+        self.batch_size = batch_size
+        self.grace = router.placement_ttl + 1 if grace is None else grace
+        self.catch_up_rows = catch_up_rows
+        self.log = log
+
+    def _batches(self, engine, table, condition):
+        # Keyset pagination on the primary key, one short read per batch
+        key = list(table.primary_key.columns)
+        after = None
+        while True:
+            query = select(table).where(condition).order_by(*key).limit(self.batch_size)
+            if after is not None:
+                query = query.where(tuple_(*key) > tuple_(*after))
+            with engine.connect() as conn:
+                rows = conn.execute(query).all()
+            if not rows:
+                return
+            yield rows
+            after = [rows[-1]._mapping[column] for column in key]
+
+    def _clear(self, conn, user_id):
+        for table in USER_TABLES:
+            conn.execute(delete(table).where(table.c.user_id == user_id))
+        conn.execute(delete(USERS).where(USERS.c.id == user_id))
+
+    def _copy_initial(self, source, target, user_id):
+        # Copies everything up to the user's current change_seq and returns
+        # it; later changes are left to the catch-up rounds.
+        with source.connect() as conn:
+            user = conn.execute(select(USERS).where(USERS.c.id == user_id)).first()
+        if user is None:
+            raise UserNotFound(user_id)
+        with target.begin() as conn:
+            self._clear(conn, user_id)
+            conn.execute(USERS.insert(), [dict(user._mapping)])
+        copied = 0
+        for table in SEQ_TABLES + [TRIGRAMS]:
+            condition = table.c.user_id == user_id
+            if table in SEQ_TABLES:
+                condition &= table.c.change_seq <= user.change_seq
+            for rows in self._batches(source, table, condition):
+                with target.begin() as conn:
+                    conn.execute(table.insert(), [_values(table, row) for row in rows])
+                copied += len(rows)
+        self.log(f"  copied {copied} rows up to change {user.change_seq}")
+        return user.change_seq
+
+    def _catch_up(self, conn, target, user_id, since):
+        # Copies the changes after since; returns the change_seq now
+        # reached and the number of changed credentials. Credentials changed
+        # again later are replaced by a later round.
+        upto = conn.execute(select(USERS.c.change_seq).where(USERS.c.id == user_id)).scalar()
+        if upto is None:
+            raise UserNotFound(user_id)
+        if upto <= since:
+            return since, 0
+        changed = {table: conn.execute(select(table).where(table.c.user_id == user_id,
+                                                           table.c.change_seq > since,
+                                                           table.c.change_seq <= upto)).all()
+                   for table in SEQ_TABLES}
+        public_ids = {row.public_id for rows in changed.values() for row in rows}
+        credentials = Credential.__table__
+        with target.begin() as target_conn:
+            for chunk in _chunked(public_ids, 500):
+                for table in (credentials, TRIGRAMS):
+                    target_conn.execute(delete(table).where(table.c.user_id == user_id, table.c.public_id.in_(chunk)))
+                trigrams = conn.execute(select(TRIGRAMS).where(TRIGRAMS.c.user_id == user_id,
+                                                               TRIGRAMS.c.public_id.in_(chunk))).all()
+                if trigrams:
+                    target_conn.execute(TRIGRAMS.insert(), [dict(row._mapping) for row in trigrams])
+            for table, rows in changed.items():
+                if rows:
+                    target_conn.execute(table.insert(), [_values(table, row) for row in rows])
+        return upto, len(public_ids)
+
+    def _cut_over(self, source, target, user_id, since, target_shard):
+        directory = self.router.directory
+        with source.begin() as conn:
+            # Holding the user row keeps every write to the vault out until
+            # the rows are gone from this shard (on SQLite, the whole shard)
+            user = conn.execute(select(USERS).where(USERS.c.id == user_id).with_for_update()).first()
+            if user is None:
+                raise UserNotFound(user_id)
+            since, changed = self._catch_up(conn, target, user_id, since)
+            snapshots = {table: conn.execute(select(table).where(table.c.user_id == user_id)).all()
+                         for table in SNAPSHOT_TABLES}
+            with target.begin() as target_conn:
+                values = dict(user._mapping)
+                del values['id']
+                target_conn.execute(update(USERS).where(USERS.c.id == user_id).values(**values))
+                for table, rows in snapshots.items():
+                    target_conn.execute(delete(table).where(table.c.user_id == user_id))
+                    if rows:
+                        target_conn.execute(table.insert(), [dict(row._mapping) for row in rows])
+            # The directory may live in the source database, whose write
+            # lock this transaction already holds
+            if directory is source:
+                self.router.set_placement(conn, user_id, shard=target_shard, moving=False)
+            else:
+                with directory.begin() as directory_conn:
+                    self.router.set_placement(directory_conn, user_id, shard=target_shard, moving=False)
+            self._clear(conn, user_id)
+        self.log(f"  {changed} credentials changed while frozen")
+
+    def move(self, user_id: int, target_shard: int) -> bool:
+        with Session(self.router.directory) as session:
+            placement = session.get(UserPlacement, user_id)
+            if placement is None:
+                raise UserNotFound(user_id)
+            source_shard, was_moving = placement.shard, placement.moving
+        if source_shard == target_shard:
+            return False
+        if was_moving:
+            self.log(f"User {user_id} was left frozen by an interrupted move; starting it over")
+        source, target = self.router.shards[source_shard], self.router.shards[target_shard]
+        self.log(f"Moving user {user_id} from shard {source_shard} to shard {target_shard}")
+        started = time.monotonic()
+        since = self._copy_initial(source, target, user_id)
+        while True:
+            with source.connect() as conn:
+                since, changed = self._catch_up(conn, target, user_id, since)
+            if changed <= self.catch_up_rows:
+                break
+            self.log(f"  caught up on {changed} changed credentials")
+
+        with self.router.directory.begin() as conn:
+            self.router.set_placement(conn, user_id, moving=True)
+        frozen = time.monotonic()
+        try:
+            time.sleep(self.grace)
+            self._cut_over(source, target, user_id, since, target_shard)
+        except BaseException:
+            with self.router.directory.begin() as conn:
+                self.router.set_placement(conn, user_id, moving=False)
+            raise
+        self.log(f"  done in {time.monotonic() - started:.1f}s, "
+                 f"frozen for {time.monotonic() - frozen:.1f}s")
+        return True
+
+    def adopt(self, purge_orphans: bool = False, dry_run: bool = False) -> int:
+        # Registers users found on a shard but missing from the directory
+        # (e.g. all of them, after switching an existing database to
+        # sharding) at the shard where they are, keeping their ids. Copies
+        # left on a shard the directory does not place them on, by an
+        # interrupted move, are reported, and deleted with purge_orphans.
+        # A dry run only counts the users it would register.
+        adopted = 0
+        for shard, engine in enumerate(self.router.shards):
+            for rows in self._batches(engine, USERS, true()):
+                with Session(self.router.directory) as session:
+                    known = {row.id: row for row in session.execute(
+                        select(UserPlacement.id, UserPlacement.shard, UserPlacement.moving)
+                        .where(UserPlacement.id.in_([row.id for row in rows])))}
+                    for row in rows:
+                        placement = known.get(row.id)
+                        if placement is None:
+                            if dry_run:
+                                adopted += 1
+                                continue
+                            session.add(UserPlacement(id=row.id, public_id=row.public_id, username=row.username,
+                                                      email=row.email, shard=shard))
+                            adopted += 1
+                        elif placement.shard != shard and not placement.moving:
+                            self.log(f"User {row.id} ({row.username}) has a stale copy on shard {shard}"
+                                     + ("; deleting it" if purge_orphans else ""))
+                            if purge_orphans and not dry_run:
+                                with engine.begin() as conn:
+                                    self._clear(conn, row.id)
+                    if not dry_run:
+                        session.commit()
+        if adopted and not dry_run and self.router.directory.dialect.name == 'postgresql':
+            # Explicit ids do not advance the sequence new users draw from
+            with self.router.directory.begin() as conn:
+                conn.exec_driver_sql("SELECT setval(pg_get_serial_sequence('user_placements', 'id'), "
+                                     "(SELECT MAX(id) FROM user_placements))")
+        return adopted
+
+    def plan(self):
+        # (user id, username, current shard, home shard) of every user not
+        # on the shard their public id hashes to
+        count = len(self.router.shards)
+        with Session(self.router.directory) as session:
+            rows = session.execute(select(UserPlacement.id, UserPlacement.username, UserPlacement.public_id,
+                                          UserPlacement.shard)).all()
+        return [(row.id, row.username, row.shard, home_shard(row.public_id, count))
+                for row in rows if row.shard != home_shard(row.public_id, count)]
+
+    def run(self, limit: int = None, dry_run: bool = False) -> int:
+        adopted = self.adopt(dry_run=dry_run)
+        if adopted and dry_run:
+            self.log(f"{adopted} users are not in the shard directory yet; "
+                     "they are added, and may then be moved, by a real run")
+        elif adopted:
+            self.log(f"Added {adopted} users to the shard directory")
+        moves = self.plan()[:limit]
+        self.log(f"{len(moves)} users to move")
+        moved = 0
+        for user_id, username, current, home in moves:
+            if dry_run:
+                self.log(f"  {username}: shard {current} -> {home}")
+            elif self.move(user_id, home):
+                moved += 1
+        return moved
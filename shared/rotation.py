@@ -0,0 +1,131 @@
+# shared/rotation.py
+#
+# Online key rotation: re-encrypts every stored credential under the
+# keyring's primary key while the API keeps serving. Credentials are read
+# in id order (keyset pagination, so each page is an index range scan no
+# matter how far the job has got), re-encrypted on the EncryptionManager's
+# worker pool, and written back in one short transaction per batch together
+# with the checkpoint. While one batch is written the next one is already
+# being read and re-encrypted.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from shared.models import Credential, KeyRotation, reencrypt_credentials
+import time
+
+class RotationProgress:
+    def __init__(self, checkpoint, max_id):
+        self.start_id = checkpoint.last_id
+        self.last_id = checkpoint.last_id
+        self.max_id = max_id
+        self.rotated = checkpoint.rotated
+        self.skipped = checkpoint.skipped
+        self.changed = 0
+        self.current = 0
+        self.processed = 0
+        self.started = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        # Ids are close to evenly spread, so the share of the id range
+        # covered is a good enough completion estimate.
+        span = self.max_id - self.start_id
+        done = (self.last_id - self.start_id) / span if span > 0 else 1.0
+        remaining = (1 - done) * (time.monotonic() - self.started) / done if 0 < done < 1 else 0
+        return (f"{min(done, 1.0):6.1%} id {self.last_id}/{self.max_id}: {self.rotated} rotated, "
+                f"{self.current} already current, {self.skipped} skipped, {self.changed} changed meanwhile, "
+                f"{self.rate:.0f} rows/s, ~{remaining:.0f}s left")
+
+class KeyRotator:
+    # max_rate caps rows per second across the whole job, so a rotation
+    # over a large table leaves room for live traffic; None runs flat out.
+    # Rows none of the keyring's keys can decrypt (e.g. ciphertext pushed
+    # by sync clients under their own keys) are skipped and counted.
+
+    def __init__(self, engine, encryption, batch_size: int = 1000, max_rate: float = None, log=print):
+        self.engine = engine
+        self.encryption = encryption
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.log = log
+
+    def _checkpoint(self, session, restart):
+        checkpoint = session.get(KeyRotation, self.encryption.primary_key_id)
+        if checkpoint is None:
+            checkpoint = KeyRotation(key_id=self.encryption.primary_key_id, last_id=0, rotated=0, skipped=0)
+            session.add(checkpoint)
+        elif restart:
+            checkpoint.last_id = checkpoint.rotated = checkpoint.skipped = 0
+            checkpoint.started_at, checkpoint.finished_at = datetime.now(timezone.utc), None
+        session.commit()
+        return checkpoint
+
+    def _prepare(self, after_id):
+        # Reads the page after after_id and re-encrypts it. Runs on the
+        # prefetch thread with its own connection.
+        credentials = Credential.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(credentials.c.id, credentials.c.encrypted_data)
+                                .where(credentials.c.id > after_id)
+                                .order_by(credentials.c.id)
+                                .limit(self.batch_size)).all()
+        rotated = self.encryption.rotate_many((row.encrypted_data for row in rows), errors='return')
+        return rows, rotated
+
+    def run(self, restart: bool = False, report_every: float = 5.0) -> RotationProgress:
+        with Session(self.engine) as session:
+            checkpoint = self._checkpoint(session, restart)
+            max_id = session.execute(select(func.max(Credential.id))).scalar() or 0
+            progress = RotationProgress(checkpoint, max_id)
+            if checkpoint.finished_at is not None:
+                self.log(f"Rotation to key {checkpoint.key_id} already finished; use --restart to run it again.")
+                return progress
+            self.log(f"Rotating credentials to key {checkpoint.key_id}, resuming after id {checkpoint.last_id}")
+
+            next_report = time.monotonic() + report_every
+            with ThreadPoolExecutor(max_workers=1) as prefetch:
+                pending = prefetch.submit(self._prepare, checkpoint.last_id)
+                while True:
+                    rows, rotated = pending.result()
+                    if not rows:
+                        break
+                    # Keyset pagination: the next page starts after this
+                    # one's last id, so it can be fetched right away.
+                    pending = prefetch.submit(self._prepare, rows[-1].id)
+
+                    changes, skipped = {}, 0
+                    for row, token in zip(rows, rotated):
+                        if isinstance(token, Exception):
+                            skipped += 1
+                        elif token != row.encrypted_data:
+                            changes[row.id] = (row.encrypted_data, token)
+                    updated = reencrypt_credentials(session, changes)
+                    checkpoint.last_id = rows[-1].id
+                    checkpoint.rotated += updated
+                    checkpoint.skipped += skipped
+                    session.commit()
+
+                    progress.last_id = checkpoint.last_id
+                    progress.rotated, progress.skipped = checkpoint.rotated, checkpoint.skipped
+                    progress.changed += len(changes) - updated
+                    progress.current += len(rows) - skipped - len(changes)
+                    progress.processed += len(rows)
+                    if time.monotonic() >= next_report:
+                        self.log(str(progress))
+                        next_report = time.monotonic() + report_every
+                    if self.max_rate:
+                        ahead = progress.processed / self.max_rate - (time.monotonic() - progress.started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+            checkpoint.finished_at = datetime.now(timezone.utc)
+            session.commit()
+            progress.max_id = max(progress.max_id, progress.last_id)
+            self.log(f"Done: {progress}")
+            return progress
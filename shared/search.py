@@ -0,0 +1,33 @@
+# shared/search.py
+
+import re
+
+# Trigram matching in the style of pg_trgm: names are lowercased, split into
+# words and each word is padded as "  word " before being cut into
+# trigrams. Queries are padded at the start only, so a partly typed word
+# still matches ("gith" -> "  g", " gi", "git", "ith" are all in "github").
+MIN_SIMILARITY = 0.3
+
+# Cap on the index entries read per query trigram
+POSTINGS_PER_TRIGRAM = 1000
+
+_WORD = re.compile(r'\w+')
+
+def _trigrams(text, end_padding):
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f"  {word}{end_padding}"
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def name_trigrams(name):
+    return _trigrams(name, ' ')
+
+def query_trigrams(query):
+    return _trigrams(query, '')
+
+def similarity(query_grams, name):
+    # Share of the query's trigrams found in the name
+    if not query_grams:
+        return 0.0
+    return len(query_grams & name_trigrams(name)) / len(query_grams)
@@ -0,0 +1,176 @@
+# shared/sharding.py
+#
+# Horizontal sharding of the server's users. Every user, with all of their
+# rows, lives on one of several databases (shards). A directory table in
+# the main database records each user's shard and hands out user ids, so
+# ids are unique across shards and survive a move, and usernames and
+# emails stay unique over all of them. New users are placed by rendezvous
+# hashing of their public id: appending a shard moves only the users that
+# now hash to it (see shared/rebalance.py).
+#
+# A RoutingSession sends every statement to the shard of the user it was
+# routed to, and everything else (the directory, revoked tokens, sessions
+# not routed yet) to the main database. Workers cache placements for
+# placement_ttl seconds, so a request for a known user costs no directory
+# query.
+
+from sqlalchemy import Boolean, Column, Integer, String, select, update
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from shared.models import RevokedToken
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import uuid
+
+DirectoryBase = declarative_base()
+
+class UserPlacement(DirectoryBase):
+    __tablename__ = 'user_placements'
+
+    id = Column(Integer, primary_key=True)  # the user's id on their shard
+    public_id = Column(String(36), unique=True, nullable=False)
+    username = Column(String(50), unique=True, nullable=False)
+    email = Column(String(120), unique=True, nullable=False)
+    shard = Column(Integer, nullable=False, index=True)
+    # Set while the user's rows are copied to another shard; requests for
+    # the user are turned away until the move is done
+    moving = Column(Boolean, default=False, nullable=False)
+
+# Tables kept in the main database only
+DIRECTORY_TABLES = {UserPlacement.__table__, RevokedToken.__table__}
+
+class UserMoving(Exception):
+    def __init__(self, user_id):
+        super().__init__(f"User {user_id} is being moved to another shard")
+        self.user_id = user_id
+
+def home_shard(public_id, count):
+    # Rendezvous hashing: the shard with the highest hash of (shard,
+    # public_id). Adding a shard takes about 1/count of the users from each
+    # of the others and leaves the rest where they are.
+    return max(range(count), key=lambda shard: hashlib.blake2b(f"{shard}:{public_id}".encode(),
+                                                                digest_size=8).digest())
+
+class RoutingSession(Session):
+    def __init__(self, router=None, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        shard = self.info.get('shard')
+        if shard is None or (mapper is not None and mapper.local_table in DIRECTORY_TABLES):
+            return self.router.directory
+        return self.router.shards[shard]
+
+class ShardRouter:
+    def __init__(self, directory, shards, placement_ttl=5.0, maxsize=10000, create_directory=True):
+        # directory is the main database's engine; shards lists one engine
+        # per shard, in SHARD_DATABASE_URLS order, and may include it
+        self.directory = directory
+        self.shards = shards
+        self.placement_ttl = placement_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._placements = OrderedDict()
+        self._lock = threading.Lock()
+        if create_directory:
+            DirectoryBase.metadata.create_all(directory)
+
+    def sessionmaker(self, **kwargs):
+        return sessionmaker(class_=RoutingSession, router=self, **kwargs)
+
+    def _cache(self, user_id, shard, moving):
+        with self._lock:
+            self._placements[user_id] = (shard, moving, time.monotonic() + self.placement_ttl)
+            self._placements.move_to_end(user_id)
+            while len(self._placements) > self.maxsize:
+                self._placements.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._placements.pop(user_id, None)
+
+    def _lookup(self, condition):
+        with Session(self.directory) as session:
+            row = session.execute(select(UserPlacement.id, UserPlacement.shard, UserPlacement.moving)
+                                  .where(condition)).first()
+        if row is not None:
+            self._cache(row.id, row.shard, row.moving)
+        return row
+
+    def locate(self, user_id):
+        # The user's shard, or None for an unknown user. Raises UserMoving
+        # while the user is being moved.
+        with self._lock:
+            entry = self._placements.get(user_id)
+            if entry is not None and entry[2] > time.monotonic():
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if entry is None:
+            row = self._lookup(UserPlacement.id == user_id)
+            if row is None:
+                return None
+            entry = (row.shard, row.moving)
+        if entry[1]:
+            raise UserMoving(user_id)
+        return entry[0]
+
+    def find(self, public_id=None, username=None):
+        # The id of the user with this public id or username, or None
+        condition = UserPlacement.public_id == public_id if public_id is not None else UserPlacement.username == username
+        row = self._lookup(condition)
+        return row.id if row is not None else None
+
+    def route(self, session, user_id):
+        # Sends the session's statements to the user's shard; False if the
+        # user is unknown
+        shard = self.locate(user_id)
+        if shard is None:
+            return False
+        session.info['shard'] = shard
+        return True
+
+    def place(self, session, user):
+        # Registers a new user in the directory, which checks that the
+        # username and email are free on every shard, and routes the session
+        # to the user's shard. Raises IntegrityError if they are taken.
+        if user.public_id is None:
+            user.public_id = str(uuid.uuid4())
+        placement = UserPlacement(public_id=user.public_id, username=user.username, email=user.email,
+                                  shard=home_shard(user.public_id, len(self.shards)))
+        with Session(self.directory) as directory:
+            directory.add(placement)
+            directory.commit()
+            user.id = placement.id
+            shard = placement.shard
+        self._cache(user.id, shard, False)
+        session.info['shard'] = shard
+
+    def unplace(self, user):
+        # Undoes place() when the user could not be created on the shard
+        if user.id is None:
+            return
+        with Session(self.directory) as directory:
+            directory.query(UserPlacement).filter_by(id=user.id, public_id=user.public_id).delete()
+            directory.commit()
+        self.forget(user.id)
+
+    def set_placement(self, connection, user_id, **values):
+        connection.execute(update(UserPlacement.__table__).where(UserPlacement.id == user_id).values(**values))
+        self.forget(user_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'shards': len(self.shards),
+                'cached_placements': len(self._placements),
+                'placement_ttl': self.placement_ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
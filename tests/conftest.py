@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The web modules import each other by their bare names, as when run from
+# data_vault_web/
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'data_vault_web')]
+
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+
+@pytest.fixture(scope='session')
+def watch_bus(tmp_path_factory):
+    # The change notifier is a process-wide singleton with one listener
+    # thread, so every app in the session shares one bus file
+    return str(tmp_path_factory.mktemp('watch') / 'watch.db')
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch, watch_bus):
+    # create_app() writes logs/ to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    def make(**config):
+        database = f"sqlite:///{tmp_path / 'vault.db'}"
+        settings = dict(TESTING=True, RATELIMIT_ENABLED=False, SQLALCHEMY_DATABASE_URI=database,
+                        SQLALCHEMY_ASYNC_DATABASE_URI=database, WATCH_BUS_PATH=watch_bus,
+                        PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+        settings.update(config)
+        return create_app(type('TestConfig', (Config,), settings))
+    return make
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def register(client, username='alice', password='secret'):
+    response = client.post('/auth/register', json={'username': username, 'email': f'{username}@example.com',
+                                                   'password': password})
+    assert response.status_code == 201, response.get_json()
+    response = client.post('/auth/login', json={'username': username, 'password': password})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+@pytest.fixture
+def tokens(client):
+    return register(client)
+
+@pytest.fixture
+def headers(tokens):
+    return {'Authorization': f"Bearer {tokens['access_token']}"}
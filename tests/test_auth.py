@@ -0,0 +1,21 @@
+from tests.conftest import register
+
+def test_logout_revokes_the_access_token(client, tokens, headers):
+    assert client.get('/api/get_credentials', headers=headers).status_code == 200
+    response = client.post('/auth/logout', json={'refresh_token': tokens['refresh_token']}, headers=headers)
+    assert response.status_code == 200
+
+    assert client.get('/api/get_credentials', headers=headers).status_code == 401
+    refresh = client.post('/auth/refresh', headers={'Authorization': f"Bearer {tokens['refresh_token']}"})
+    assert refresh.status_code == 401
+
+def test_logout_leaves_other_sessions_signed_in(client, tokens, headers):
+    other = client.post('/auth/login', json={'username': 'alice', 'password': 'secret'}).get_json()
+    client.post('/auth/logout', headers=headers)
+    assert client.get('/api/get_credentials', headers={
+        'Authorization': f"Bearer {other['access_token']}"}).status_code == 200
+
+def test_bad_password_is_rejected(client):
+    register(client, 'bob', 'hunter2')
+    response = client.post('/auth/login', json={'username': 'bob', 'password': 'wrong'})
+    assert response.status_code == 401
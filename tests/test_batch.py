@@ -0,0 +1,31 @@
+def _batch(client, headers, operations):
+    response = client.post('/api/credentials/batch', json={'operations': operations}, headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['results']
+
+def test_valid_operations_apply_when_others_fail(client, headers):
+    existing = _batch(client, headers, [{'op': 'create', 'name': 'github', 'data': 'one'}])[0]['id']
+
+    results = _batch(client, headers, [
+        {'op': 'create', 'name': 'gitlab', 'data': 'two'},
+        {'op': 'rename', 'id': existing},
+        {'op': 'update', 'id': 'missing', 'data': 'three'},
+        {'op': 'update', 'id': existing, 'name': 'github.com'},
+        {'op': 'create', 'name': 'no data'},
+    ])
+    assert [result['status'] for result in results] == ['created', 'error', 'error', 'updated', 'error']
+    assert [result.get('msg') for result in results] == [
+        None, 'Unknown operation', 'Credential not found', None, 'Missing name or data']
+    assert [result['index'] for result in results] == list(range(5))
+
+    changes = client.get('/api/get_credentials?since=0', headers=headers).get_json()['changes']
+    assert sorted(change['name'] for change in changes) == ['github.com', 'gitlab']
+
+def test_delete_and_missing_operations(client, headers):
+    created = _batch(client, headers, [{'op': 'create', 'name': 'github', 'data': 'one'}])[0]['id']
+    results = _batch(client, headers, [{'op': 'delete', 'id': created}, {'op': 'delete', 'id': created}])
+    assert results[0] == {'index': 0, 'status': 'deleted', 'id': created}
+    assert results[1]['status'] == 'error'
+
+    response = client.post('/api/credentials/batch', json={}, headers=headers)
+    assert response.status_code == 400
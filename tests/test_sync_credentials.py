@@ -0,0 +1,49 @@
+from tests.conftest import register
+
+def _sync(client, headers, changes, key=None):
+    if key is not None:
+        headers = dict(headers, **{'Idempotency-Key': key})
+    response = client.post('/api/sync_credentials', json={'changes': changes}, headers=headers)
+    assert response.status_code == 200
+    return response
+
+def _names(client, headers):
+    changes = client.get('/api/get_credentials?since=0', headers=headers).get_json()['changes']
+    return sorted(change['name'] for change in changes if not change.get('deleted'))
+
+def test_retry_with_the_same_key_replays_the_response(client, headers):
+    changes = [{'name': 'github', 'data': 'one', 'last_modified': '2024-01-01T00:00:00Z'}]
+    first = _sync(client, headers, changes, key='batch-1')
+    assert first.get_json()['results'][0]['status'] == 'created'
+    assert 'Idempotent-Replayed' not in first.headers
+
+    retry = _sync(client, headers, changes, key='batch-1')
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert _names(client, headers) == ['github']
+
+def test_batch_with_failed_items_is_not_replayed(client, headers):
+    bad = {'name': 'gitlab', 'data': 'two', 'last_modified': 'yesterday'}
+    first = _sync(client, headers, [bad], key='batch-2')
+    assert first.get_json()['results'][0] == {'index': 0, 'status': 'error', 'msg': 'Invalid last_modified'}
+
+    # The retry under the same key is applied rather than replaying the error
+    fixed = dict(bad, last_modified='2024-01-01T00:00:00Z')
+    retry = _sync(client, headers, [fixed], key='batch-2')
+    assert 'Idempotent-Replayed' not in retry.headers
+    assert retry.get_json()['results'][0]['status'] == 'created'
+    assert _names(client, headers) == ['gitlab']
+
+def test_expired_key_is_not_replayed(make_app):
+    client = make_app(IDEMPOTENCY_KEY_TTL=0).test_client()
+    headers = {'Authorization': f"Bearer {register(client)['access_token']}"}
+    changes = [{'name': 'github', 'data': 'one', 'last_modified': '2024-01-01T00:00:00Z'}]
+    _sync(client, headers, changes, key='batch-3')
+    retry = _sync(client, headers, changes, key='batch-3')
+    assert 'Idempotent-Replayed' not in retry.headers
+    assert retry.get_json()['results'][0]['status'] == 'unchanged'
+
+def test_invalid_key_is_rejected(client, headers):
+    response = client.post('/api/sync_credentials', json={'changes': []},
+                           headers=dict(headers, **{'Idempotency-Key': 'x' * 65}))
+    assert response.status_code == 400
@@ -0,0 +1,66 @@
+def _add(client, headers, name):
+    response = client.post('/api/credentials', json={'name': name, 'data': f'secret {name}'}, headers=headers)
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def _feed(client, headers, since, **params):
+    response = client.get('/api/get_credentials', query_string=dict(since=since, **params), headers=headers)
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_feed_returns_changes_after_the_cursor(client, headers):
+    first = _add(client, headers, 'github')
+    page = _feed(client, headers, 0)
+    assert [change['id'] for change in page['changes']] == [first]
+    assert page['has_more'] is False
+
+    second = _add(client, headers, 'gitlab')
+    later = _feed(client, headers, page['cursor'])
+    assert [change['id'] for change in later['changes']] == [second]
+    assert later['cursor'] > page['cursor']
+
+    assert _feed(client, headers, later['cursor']) == {'changes': [], 'cursor': later['cursor'], 'has_more': False}
+
+def test_feed_reports_deletions_as_tombstones(client, headers):
+    kept = _add(client, headers, 'kept')
+    deleted = _add(client, headers, 'deleted')
+    cursor = _feed(client, headers, 0)['cursor']
+    assert client.delete(f'/api/credentials/{deleted}', headers=headers).status_code == 200
+
+    page = _feed(client, headers, cursor)
+    assert page['changes'] == [{'id': deleted, 'name': 'deleted', 'deleted': True, 'seq': page['cursor']}]
+    # A full sync from the start no longer has the credential itself
+    ids = {change['id'] for change in _feed(client, headers, 0)['changes'] if not change.get('deleted')}
+    assert ids == {kept}
+
+def test_feed_pages_with_has_more(client, headers):
+    created = [_add(client, headers, f'site{i}') for i in range(5)]
+    seen, cursor, pages = [], 0, 0
+    while True:
+        page = _feed(client, headers, cursor, limit=2)
+        seen += [change['id'] for change in page['changes']]
+        cursor = page['cursor']
+        pages += 1
+        if not page['has_more']:
+            break
+        assert len(page['changes']) == 2
+    assert seen == created
+    assert pages == 3
+
+def test_feed_resets_a_cursor_from_the_future(client, headers):
+    _add(client, headers, 'github')
+    page = _feed(client, headers, 1000)
+    assert page['reset'] is True
+    assert page['cursor'] == 0
+
+def test_feed_etag_answers_304_until_the_vault_changes(client, headers):
+    _add(client, headers, 'github')
+    response = client.get('/api/get_credentials?since=0', headers=headers)
+    etag = response.headers['ETag']
+    unchanged = client.get('/api/get_credentials?since=0', headers=dict(headers, **{'If-None-Match': etag}))
+    assert unchanged.status_code == 304
+
+    _add(client, headers, 'gitlab')
+    changed = client.get('/api/get_credentials?since=0', headers=dict(headers, **{'If-None-Match': etag}))
+    assert changed.status_code == 200
+    assert len(changed.get_json()['changes']) == 2
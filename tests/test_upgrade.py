@@ -0,0 +1,100 @@
+import sqlite3
+
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+
+from shared.models import Credential, MerkleNode, User, init_engine, rebuild_merkle_tree
+
+# The users and credentials tables as created before change feeds, digests
+# and the Merkle tree existed
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL,
+    public_id VARCHAR(36),
+    username VARCHAR(50) NOT NULL,
+    email VARCHAR(120) NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
+    is_active BOOLEAN NOT NULL,
+    created_at DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    updated_at DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE (public_id)
+);
+CREATE UNIQUE INDEX ix_users_email ON users (email);
+CREATE UNIQUE INDEX ix_users_username ON users (username);
+CREATE TABLE credentials (
+    id INTEGER NOT NULL,
+    public_id VARCHAR(36),
+    name VARCHAR(100) NOT NULL,
+    encrypted_data TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    created_at DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    updated_at DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE (public_id),
+    FOREIGN KEY(user_id) REFERENCES users (id)
+);
+"""
+
+UPDATED_AT = '2024-01-02 03:04:05.000000'
+
+def _baseline_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    for user_id, username in ((1, 'alice'), (2, 'bob')):
+        conn.execute('INSERT INTO users (id, public_id, username, email, password_hash, is_active, updated_at) '
+                     'VALUES (?, ?, ?, ?, ?, 1, ?)',
+                     (user_id, f'{user_id:08x}-0000-4000-8000-000000000000', username, f'{username}@example.com',
+                      generate_password_hash('secret', 'pbkdf2:sha256:1000'), UPDATED_AT))
+        for i in range(3):
+            conn.execute('INSERT INTO credentials (public_id, name, encrypted_data, user_id, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (f'{user_id:08x}-0000-4000-8000-{i:012x}', f'{username}{i}', f'gAAAAtoken{i}',
+                          user_id, UPDATED_AT))
+    conn.commit()
+    conn.close()
+
+def _merkle_nodes(session, user_id):
+    return {node.prefix: (node.hash, node.count)
+            for node in session.query(MerkleNode).filter(MerkleNode.user_id == user_id)}
+
+def test_existing_database_is_migrated(tmp_path):
+    path = tmp_path / 'vault.db'
+    _baseline_database(path)
+    engine = init_engine(f'sqlite:///{path}')
+
+    with engine.connect() as conn:
+        indexes = set(conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'credentials'").scalars())
+    assert {'ix_credentials_user_change_seq', 'ix_credentials_user_public_id'} <= indexes
+
+    with Session(engine) as session:
+        for user in session.query(User):
+            credentials = session.query(Credential).filter(Credential.user_id == user.id).order_by(Credential.id).all()
+            assert user.change_seq == 3
+            assert [cred.change_seq for cred in credentials] == [1, 2, 3]
+            assert all(cred.digest == cred.compute_digest() for cred in credentials)
+            # The backfill leaves the sync timestamps alone
+            assert {str(cred.updated_at) for cred in credentials} == {'2024-01-02 03:04:05'}
+
+            nodes = _merkle_nodes(session, user.id)
+            assert nodes[''][1] == 3
+            rebuild_merkle_tree(session, user.id)
+            assert _merkle_nodes(session, user.id) == nodes
+    engine.dispose()
+
+def test_migrated_database_serves_the_sync_feed(tmp_path, make_app):
+    _baseline_database(tmp_path / 'vault.db')
+    client = make_app().test_client()
+    token = client.post('/auth/login', json={'username': 'alice', 'password': 'secret'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    page = client.get('/api/get_credentials?since=0', headers=headers).get_json()
+    assert [change['name'] for change in page['changes']] == ['alice0', 'alice1', 'alice2']
+    assert page['cursor'] == 3
+
+    response = client.post('/api/credentials', json={'name': 'alice3', 'data': 'new'}, headers=headers)
+    assert response.status_code == 201
+    later = client.get(f"/api/get_credentials?since={page['cursor']}", headers=headers).get_json()
+    assert [change['name'] for change in later['changes']] == ['alice3']
+    assert later['cursor'] == 4